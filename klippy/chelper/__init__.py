@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, logging
+import os, logging, imp
 import cffi
 
 
@@ -21,9 +21,10 @@ SOURCE_FILES = [
     'pollreactor.c', 'msgblock.c', 'trdispatch.c',
     'kin_cartesian.c', 'kin_corexy.c', 'kin_corexz.c', 'kin_delta.c',
     'kin_polar.c', 'kin_rotary_delta.c', 'kin_winch.c', 'kin_extruder.c',
-    'kin_shaper.c',
+    'kin_shaper.c', 'bedmesh.c',
 ]
 DEST_LIB = "c_helper.so"
+DEST_FFI = "c_helper_ffi"
 OTHER_FILES = [
     'list.h', 'serialqueue.h', 'stepcompress.h', 'itersolve.h', 'pyhelper.h',
     'trapq.h', 'pollreactor.h', 'msgblock.h'
@@ -147,6 +148,12 @@ defs_kin_shaper = """
     struct stepper_kinematics * input_shaper_alloc(void);
 """
 
+defs_bedmesh = """
+    void bedmesh_calc_z(double *coeffs, int x_cells, int y_cells
+        , double min_x, double min_y, double dist_x, double dist_y
+        , double *xs, double *ys, double *out, int count);
+"""
+
 defs_serialqueue = """
     #define MESSAGE_MAX 64
     struct pull_queue_message {
@@ -205,7 +212,7 @@ defs_all = [
     defs_itersolve, defs_trapq, defs_trdispatch,
     defs_kin_cartesian, defs_kin_corexy, defs_kin_corexz, defs_kin_delta,
     defs_kin_polar, defs_kin_rotary_delta, defs_kin_winch, defs_kin_extruder,
-    defs_kin_shaper,
+    defs_kin_shaper, defs_bedmesh,
 ]
 
 # Update filenames to an absolute path
@@ -236,6 +243,30 @@ def check_gcc_option(option):
     res = os.system(cmd)
     return res == 0
 
+# Build a python module with the pre-parsed cdef declarations (parsing
+# the declarations with cffi on every startup is slow on small hosts)
+def build_ffi_module(dest):
+    ffi = cffi.FFI()
+    for d in defs_all:
+        ffi.cdef(d)
+    ffi.set_source(DEST_FFI, None)
+    ffi.emit_python_code(dest)
+
+# Load the cffi declarations, preferably from the pre-parsed module
+def load_ffi(srcdir):
+    destffi = get_abs_files(srcdir, [DEST_FFI + ".py"])[0]
+    try:
+        if check_build_code([__file__], destffi):
+            logging.info("Building C code declarations %s", DEST_FFI)
+            build_ffi_module(destffi)
+        return imp.load_source(DEST_FFI, destffi).ffi
+    except Exception:
+        logging.exception("Unable to use pre-parsed C declarations")
+    ffi = cffi.FFI()
+    for d in defs_all:
+        ffi.cdef(d)
+    return ffi
+
 # Check if the current gcc version supports a particular command-line option
 def do_build_code(cmd):
     res = os.system(cmd)
@@ -267,9 +298,7 @@ def get_ffi():
                 cmd = "%s %s" % (GCC_CMD, COMPILE_ARGS)
             logging.info("Building C code module %s", DEST_LIB)
             do_build_code(cmd % (destlib, ' '.join(srcfiles)))
-        FFI_main = cffi.FFI()
-        for d in defs_all:
-            FFI_main.cdef(d)
+        FFI_main = load_ffi(srcdir)
         FFI_lib = FFI_main.dlopen(destlib)
         # Setup error logging
         pyhelper_logging_callback = FFI_main.callback("void func(const char *)",
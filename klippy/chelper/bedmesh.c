@@ -0,0 +1,49 @@
+// Bed mesh z-adjustment lookups
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <math.h> // floor
+#include "compiler.h" // __visible
+
+// The coefficient table contains four values for each mesh cell
+// (ordered by row, then column) such that the bilinear interpolated
+// height within the cell is:
+//   z = c0 + c1*tx + c2*ty + c3*tx*ty
+// where tx and ty are the normalized (0..1) positions within the cell.
+
+static inline int
+constrain_index(int idx, int cells)
+{
+    if (idx < 0)
+        return 0;
+    if (idx > cells - 1)
+        return cells - 1;
+    return idx;
+}
+
+static inline double
+constrain_t(double t)
+{
+    if (t < 0.)
+        return 0.;
+    if (t > 1.)
+        return 1.;
+    return t;
+}
+
+// Calculate the mesh height for a batch of x/y coordinates
+void __visible
+bedmesh_calc_z(double *coeffs, int x_cells, int y_cells
+               , double min_x, double min_y, double dist_x, double dist_y
+               , double *xs, double *ys, double *out, int count)
+{
+    int i;
+    for (i = 0; i < count; i++) {
+        double px = (xs[i] - min_x) / dist_x, py = (ys[i] - min_y) / dist_y;
+        int xidx = constrain_index((int)floor(px), x_cells);
+        int yidx = constrain_index((int)floor(py), y_cells);
+        double tx = constrain_t(px - xidx), ty = constrain_t(py - yidx);
+        double *c = &coeffs[(yidx * x_cells + xidx) * 4];
+        out[i] = c[0] + c[1] * tx + (c[2] + c[3] * tx) * ty;
+    }
+}
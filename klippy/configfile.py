@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import sys, os, glob, re, time, logging, configparser, io
+import sys, os, glob, re, time, logging, configparser, io, hashlib, shutil
 
 error = configparser.Error
 
@@ -141,6 +141,19 @@ AUTOSAVE_HEADER = """
 #*#
 """
 
+# Cache of parsed config data (persists across restarts).  Each file is
+# stored as a list of parsed chunks and include directives keyed by the
+# file contents, so unchanged files are not parsed again.
+PARSE_CACHE_SIZE = 64
+parse_cache = {}
+file_cache = {}
+
+def _new_fileconfig():
+    if sys.version_info.major >= 3:
+        return configparser.RawConfigParser(
+            strict=False, inline_comment_prefixes=(';', '#'))
+    return configparser.RawConfigParser()
+
 class PrinterConfig:
     def __init__(self, printer):
         self.printer = printer
@@ -150,12 +163,23 @@ class PrinterConfig:
         self.status_settings = {}
         self.status_warnings = []
         self.save_config_pending = False
+        self.status_version = 0
+        self.status = None
+        self.parse_stats = [0, 0]
         gcode = self.printer.lookup_object('gcode')
         gcode.register_command("SAVE_CONFIG", self.cmd_SAVE_CONFIG,
                                desc=self.cmd_SAVE_CONFIG_help)
     def get_printer(self):
         return self.printer
     def _read_config_file(self, filename):
+        # Reuse the contents of unchanged (same mtime and size) files
+        try:
+            st = os.stat(filename)
+            cached = file_cache.get(filename)
+            if cached is not None and cached[:2] == (st.st_mtime, st.st_size):
+                return cached[2]
+        except os.error:
+            st = None
         try:
             f = open(filename, 'r')
             data = f.read()
@@ -164,7 +188,10 @@ class PrinterConfig:
             msg = "Unable to open config file %s" % (filename,)
             logging.exception(msg)
             raise error(msg)
-        return data.replace('\r\n', '\n')
+        data = data.replace('\r\n', '\n')
+        if st is not None:
+            file_cache[filename] = (st.st_mtime, st.st_size, data)
+        return data
     def _find_autosave_data(self, data):
         regular_data = data
         autosave_data = ""
@@ -213,13 +240,27 @@ class PrinterConfig:
                 is_dup_field = True
                 lines[lineno] = '#' + lines[lineno]
         return "\n".join(lines)
-    def _parse_config_buffer(self, buffer, filename, fileconfig):
+    def _parse_config_buffer(self, buffer, filename, ops):
         if not buffer:
             return
         data = '\n'.join(buffer)
         del buffer[:]
         sbuffer = io.StringIO(data)
-        fileconfig.readfp(sbuffer, filename)
+        chunk = _new_fileconfig()
+        chunk.readfp(sbuffer, filename)
+        if chunk.defaults():
+            # Defaults can not be replayed - parse directly on every use
+            ops.append(('raw', data))
+            return
+        ops.append(('data', [(section, [(option, chunk.get(section, option))
+                                        for option in chunk.options(section)])
+                             for section in chunk.sections()]))
+    def _apply_parsed(self, section_data, fileconfig):
+        for section, options in section_data:
+            if not fileconfig.has_section(section):
+                fileconfig.add_section(section)
+            for option, value in options:
+                fileconfig.set(section, option, value)
     def _resolve_include(self, source_filename, include_spec, fileconfig,
                          visited):
         dirname = os.path.dirname(source_filename)
@@ -235,11 +276,17 @@ class PrinterConfig:
             self._parse_config(include_data, include_filename, fileconfig,
                                visited)
         return include_filenames
-    def _parse_config(self, data, filename, fileconfig, visited):
-        path = os.path.abspath(filename)
-        if path in visited:
-            raise error("Recursive include of config file '%s'" % (filename))
-        visited.add(path)
+    def _get_parsed_ops(self, data, filename):
+        bdata = data
+        if not isinstance(bdata, bytes):
+            bdata = bdata.encode('utf-8')
+        key = (filename, hashlib.sha1(bdata).hexdigest())
+        ops = parse_cache.get(key)
+        if ops is not None:
+            self.parse_stats[0] += 1
+            return ops
+        self.parse_stats[1] += 1
+        ops = []
         lines = data.split('\n')
         # Buffer lines between includes and parse as a unit so that overrides
         # in includes apply linearly as they do within a single file
@@ -253,20 +300,30 @@ class PrinterConfig:
             mo = configparser.RawConfigParser.SECTCRE.match(line)
             header = mo and mo.group('header')
             if header and header.startswith('include '):
-                self._parse_config_buffer(buffer, filename, fileconfig)
-                include_spec = header[8:].strip()
-                self._resolve_include(filename, include_spec, fileconfig,
-                                      visited)
+                self._parse_config_buffer(buffer, filename, ops)
+                ops.append(('include', header[8:].strip()))
             else:
                 buffer.append(line)
-        self._parse_config_buffer(buffer, filename, fileconfig)
+        self._parse_config_buffer(buffer, filename, ops)
+        if len(parse_cache) >= PARSE_CACHE_SIZE:
+            parse_cache.clear()
+        parse_cache[key] = ops
+        return ops
+    def _parse_config(self, data, filename, fileconfig, visited):
+        path = os.path.abspath(filename)
+        if path in visited:
+            raise error("Recursive include of config file '%s'" % (filename))
+        visited.add(path)
+        for op, value in self._get_parsed_ops(data, filename):
+            if op == 'data':
+                self._apply_parsed(value, fileconfig)
+            elif op == 'include':
+                self._resolve_include(filename, value, fileconfig, visited)
+            else:
+                fileconfig.readfp(io.StringIO(value), filename)
         visited.remove(path)
     def _build_config_wrapper(self, data, filename):
-        if sys.version_info.major >= 3:
-            fileconfig = configparser.RawConfigParser(
-                strict=False, inline_comment_prefixes=(';', '#'))
-        else:
-            fileconfig = configparser.RawConfigParser()
+        fileconfig = _new_fileconfig()
         self._parse_config(data, filename, fileconfig, set())
         return ConfigWrapper(self.printer, fileconfig, {}, 'printer')
     def _build_config_string(self, config):
@@ -284,6 +341,8 @@ class PrinterConfig:
         autosave_data = self._strip_duplicates(autosave_data, regular_config)
         self.autosave = self._build_config_wrapper(autosave_data, filename)
         cfg = self._build_config_wrapper(regular_data + autosave_data, filename)
+        logging.info("Config parse: %d cached, %d parsed",
+                     self.parse_stats[0], self.parse_stats[1])
         return cfg
     def check_unused_options(self, config):
         fileconfig = config.fileconfig
@@ -316,7 +375,8 @@ class PrinterConfig:
     def deprecate(self, section, option, value=None, msg=None):
         self.deprecated[(section, option, value)] = msg
     def _build_status(self, config):
-        self.status_raw_config.clear()
+        self.status_version += 1
+        self.status_raw_config = {}
         for section in config.get_prefix_sections(''):
             self.status_raw_config[section.get_name()] = section_status = {}
             for option in section.get_prefix_options(''):
@@ -335,10 +395,18 @@ class PrinterConfig:
             res['option'] = option
             self.status_warnings.append(res)
     def get_status(self, eventtime):
-        return {'config': self.status_raw_config,
+        # The status is only rebuilt when its content changes
+        status = self.status
+        if status is None or status[0] != self.status_version:
+            status = self.status = (self.status_version, {
+                'config': self.status_raw_config,
                 'settings': self.status_settings,
                 'warnings': self.status_warnings,
-                'save_config_pending': self.save_config_pending}
+                'save_config_pending': self.save_config_pending})
+        return status[1]
+    def get_status_version(self):
+        # Changes whenever get_status() would report new content
+        return self.status_version
     # Autosave functions
     def set(self, section, option, value):
         if not self.autosave.fileconfig.has_section(section):
@@ -346,10 +414,12 @@ class PrinterConfig:
         svalue = str(value)
         self.autosave.fileconfig.set(section, option, svalue)
         self.save_config_pending = True
+        self.status_version += 1
         logging.info("save_config: set [%s] %s = %s", section, option, svalue)
     def remove_section(self, section):
         self.autosave.fileconfig.remove_section(section)
         self.save_config_pending = True
+        self.status_version += 1
     def _disallow_include_conflicts(self, regular_data, cfgname, gcode):
         config = self._build_config_wrapper(regular_data, cfgname)
         for section in self.autosave.fileconfig.sections():
@@ -358,6 +428,18 @@ class PrinterConfig:
                     msg = ("SAVE_CONFIG section '%s' option '%s' conflicts "
                            "with included value" % (section, option))
                     raise gcode.error(msg)
+    def _sync_dir(self, dirname):
+        # Make the rename durable
+        try:
+            fd = os.open(dirname, os.O_RDONLY)
+        except os.error:
+            return
+        try:
+            os.fsync(fd)
+        except os.error:
+            pass
+        finally:
+            os.close(fd)
     cmd_SAVE_CONFIG_help = "Overwrite config file and restart"
     def cmd_SAVE_CONFIG(self, gcmd):
         if not self.autosave.fileconfig.sections():
@@ -390,18 +472,23 @@ class PrinterConfig:
         if cfgname.endswith(".cfg"):
             backup_name = cfgname[:-4] + datestr + ".cfg"
             temp_name = cfgname[:-4] + "_autosave.cfg"
-        # Create new config file with temporary name and swap with main config
+        # Create new config file with temporary name and atomically
+        # replace the main config with it
         logging.info("SAVE_CONFIG to '%s' (backup in '%s')",
                      cfgname, backup_name)
         try:
             f = open(temp_name, 'w')
             f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
             f.close()
-            os.system("sync")
-            os.rename(cfgname, backup_name)
-            os.system("sync")
+            try:
+                os.link(cfgname, backup_name)
+            except os.error:
+                # Filesystem without hard links - copy the old config
+                shutil.copyfile(cfgname, backup_name)
             os.rename(temp_name, cfgname)
-            os.system("sync")
+            self._sync_dir(os.path.dirname(os.path.abspath(cfgname)))
         except:
             msg = "Unable to write config file during SAVE_CONFIG"
             logging.exception(msg)
@@ -4,6 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging, time, collections, threading, multiprocessing, os
+import struct, base64, json
 from . import bus, motion_report
 
 # ADXL345 registers
@@ -29,6 +30,109 @@ SCALE = 0.0039 * FREEFALL_ACCEL # 3.9mg/LSB * Earth gravity in mm/s**2
 Accel_Measurement = collections.namedtuple(
     'Accel_Measurement', ('time', 'accel_x', 'accel_y', 'accel_z'))
 
+# Fixed size storage of decoded samples shared by all chip clients
+class AccelSampleRing:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.samples = [None] * capacity
+        self.write_count = 0
+    def append(self, samples):
+        capacity = self.capacity
+        count = len(samples)
+        if count > capacity:
+            self.write_count += count - capacity
+            samples = samples[-capacity:]
+            count = capacity
+        pos = self.write_count % capacity
+        first = min(count, capacity - pos)
+        self.samples[pos:pos+first] = samples[:first]
+        self.samples[:count-first] = samples[first:]
+        self.write_count += count
+    def add_reader(self):
+        return AccelRingReader(self)
+
+# Read cursor into an AccelSampleRing
+class AccelRingReader:
+    def __init__(self, ring):
+        self.ring = ring
+        self.read_count = ring.write_count
+        self.overruns = 0
+    def read(self):
+        ring = self.ring
+        write_count = ring.write_count
+        avail = write_count - self.read_count
+        if avail > ring.capacity:
+            # Reader fell behind - oldest samples were overwritten
+            self.overruns += avail - ring.capacity
+            avail = ring.capacity
+        self.read_count = write_count
+        if not avail:
+            return []
+        pos = (write_count - avail) % ring.capacity
+        end = pos + avail
+        if end <= ring.capacity:
+            return ring.samples[pos:end]
+        return ring.samples[pos:] + ring.samples[:end-ring.capacity]
+
+# Internal APIDumpHelper client that drains a ring reader on each update
+class AccelRingClient:
+    def __init__(self, reader, max_batches=10000):
+        self.reader = reader
+        self.max_batches = max_batches
+        self.batches = []
+        self.is_done = False
+    def get_samples(self):
+        return [s for batch in self.batches for s in batch]
+    def get_overruns(self):
+        return self.reader.overruns
+    def finalize(self):
+        if not self.is_done:
+            self.drain()
+        self.is_done = True
+    def is_closed(self):
+        return self.is_done
+    def drain(self):
+        samples = self.reader.read()
+        if samples:
+            self.batches.append(samples)
+        if len(self.batches) >= self.max_batches:
+            # Avoid filling up memory with too many samples
+            self.is_done = True
+    def send(self, msg):
+        self.drain()
+
+# APIDumpHelper client that streams ring samples to a webhooks client
+class AccelRingStreamClient:
+    def __init__(self, cconn, reader, template, encoding, encode_cb):
+        self.cconn = cconn
+        self.reader = reader
+        self.template = template
+        self.encoding = encoding
+        self.encode_cb = encode_cb
+    def is_closed(self):
+        return self.cconn.is_closed()
+    def send(self, msg):
+        if self.cconn.get_pending_bytes() > MAX_PENDING_DUMP_BYTES:
+            # Client is not keeping up - leave its samples in the ring
+            return
+        samples = self.reader.read()
+        if not samples:
+            return
+        jdata = self.encode_cb(self.encoding, samples, self.reader.read_count)
+        params = dict(msg['params'])
+        params['overruns'] = self.reader.overruns
+        if self.encoding == 'binary':
+            params['encoding'] = 'binary'
+        jparams = json.dumps(params, separators=(',', ':'))
+        jparams = jparams[:-1] + ',"data":' + jdata + '}'
+        tmp = dict(self.template)
+        tmp.pop('params', None)
+        jtmp = json.dumps(tmp, separators=(',', ':'))
+        sep = ','
+        if not tmp:
+            sep = ''
+        self.cconn.send_encoded(jtmp[:-1] + sep + '"params":' + jparams + '}')
+
 # Helper class to obtain measurements
 class ADXL345QueryHelper:
     def __init__(self, printer, cconn):
@@ -36,51 +140,31 @@ class ADXL345QueryHelper:
         self.cconn = cconn
         print_time = printer.lookup_object('toolhead').get_last_move_time()
         self.request_start_time = self.request_end_time = print_time
-        self.samples = self.raw_samples = []
+        self.samples = []
     def finish_measurements(self):
         toolhead = self.printer.lookup_object('toolhead')
         self.request_end_time = toolhead.get_last_move_time()
         toolhead.wait_moves()
         self.cconn.finalize()
-    def _get_raw_samples(self):
-        raw_samples = self.cconn.get_messages()
-        if raw_samples:
-            self.raw_samples = raw_samples
-        return self.raw_samples
+        overruns = self.cconn.get_overruns()
+        if overruns:
+            logging.warning("adxl345 client lost %d samples", overruns)
     def has_valid_samples(self):
-        raw_samples = self._get_raw_samples()
-        for msg in raw_samples:
-            data = msg['params']['data']
-            first_sample_time = data[0][0]
-            last_sample_time = data[-1][0]
-            if (first_sample_time > self.request_end_time
-                    or last_sample_time < self.request_start_time):
-                continue
-            # The time intervals [first_sample_time, last_sample_time]
-            # and [request_start_time, request_end_time] have non-zero
-            # intersection. It is still theoretically possible that none
-            # of the samples from raw_samples fall into the time interval
-            # [request_start_time, request_end_time] if it is too narrow
-            # or on very heavy data losses. In practice, that interval
-            # is at least 1 second, so this possibility is negligible.
-            return True
+        # It is still theoretically possible that none of the samples
+        # fall into the time interval [request_start_time,
+        # request_end_time] if it is too narrow or on very heavy data
+        # losses. In practice, that interval is at least 1 second.
+        for batch in self.cconn.batches:
+            if (batch[0][0] <= self.request_end_time
+                    and batch[-1][0] >= self.request_start_time):
+                return True
         return False
     def get_samples(self):
-        raw_samples = self._get_raw_samples()
-        if not raw_samples:
-            return self.samples
-        total = sum([len(m['params']['data']) for m in raw_samples])
-        count = 0
-        self.samples = samples = [None] * total
-        for msg in raw_samples:
-            for samp_time, x, y, z in msg['params']['data']:
-                if samp_time < self.request_start_time:
-                    continue
-                if samp_time > self.request_end_time:
-                    break
-                samples[count] = Accel_Measurement(samp_time, x, y, z)
-                count += 1
-        del samples[count:]
+        start_time = self.request_start_time
+        end_time = self.request_end_time
+        self.samples = [Accel_Measurement(*s)
+                        for s in self.cconn.get_samples()
+                        if start_time <= s[0] <= end_time]
         return self.samples
     def write_to_file(self, filename):
         def write_impl():
@@ -222,6 +306,11 @@ MIN_MSG_TIME = 0.100
 BYTES_PER_SAMPLE = 5
 SAMPLES_PER_BLOCK = 10
 
+# Binary dump encoding: little-endian doubles (time, x, y, z) per sample
+BINARY_SAMPLE_FORMAT = '<dddd'
+# Dump clients with more unsent data than this are skipped for an update
+MAX_PENDING_DUMP_BYTES = 512 * 1024
+
 # Printer class that controls ADXL345 chip
 class ADXL345:
     def __init__(self, config):
@@ -240,6 +329,10 @@ class ADXL345:
         # Measurement storage (accessed from background thread)
         self.lock = threading.Lock()
         self.raw_samples = []
+        # Decoded sample storage shared by all clients
+        ring_size = config.getint('sample_buffer_size', 32768, minval=1024)
+        self.sample_ring = AccelSampleRing(ring_size)
+        self.dump_cache = {}
         # Setup mcu sensor_adxl345 bulk query code
         self.spi = bus.MCU_SPI_from_config(config, 3, default_speed=5000000)
         self.mcu = mcu = self.spi.get_mcu()
@@ -415,19 +508,48 @@ class ADXL345:
         samples = self._extract_samples(raw_samples)
         if not samples:
             return {}
-        return {'data': samples, 'errors': self.last_error_count,
+        self.sample_ring.append(samples)
+        self.dump_cache.clear()
+        # Clients read the new samples from the ring
+        return {'errors': self.last_error_count,
                 'overflows': self.last_limit_count}
+    def _encode_samples(self, encoding, samples, end_count):
+        # Clients at the same ring position share the encoded samples
+        key = (encoding, end_count - len(samples))
+        jdata = self.dump_cache.get(key)
+        if jdata is not None:
+            return jdata
+        if encoding == 'binary':
+            fmt = '<' + BINARY_SAMPLE_FORMAT[1:] * len(samples)
+            data = struct.pack(fmt, *[v for s in samples for v in s])
+            jdata = json.dumps(base64.b64encode(data).decode())
+        else:
+            jdata = json.dumps(samples, separators=(',', ':'))
+        self.dump_cache[key] = jdata
+        return jdata
     def _api_startstop(self, is_start):
         if is_start:
             self._start_measurements()
         else:
             self._finish_measurements()
     def _handle_dump_adxl345(self, web_request):
-        self.api_dump.add_client(web_request)
+        encoding = web_request.get_str('encoding', 'json')
+        if encoding not in ('json', 'binary'):
+            raise web_request.error("Invalid adxl345 dump encoding")
+        template = web_request.get_dict('response_template', {})
+        cconn = AccelRingStreamClient(
+            web_request.get_client_connection(), self.sample_ring.add_reader(),
+            template, encoding, self._encode_samples)
+        self.api_dump.add_internal_client(cconn)
         hdr = ('time', 'x_acceleration', 'y_acceleration', 'z_acceleration')
-        web_request.send({'header': hdr})
+        resp = {'header': hdr}
+        if encoding == 'binary':
+            resp['encoding'] = 'binary'
+            resp['format'] = BINARY_SAMPLE_FORMAT
+        web_request.send(resp)
     def start_internal_client(self):
-        cconn = self.api_dump.add_internal_client()
+        cconn = AccelRingClient(self.sample_ring.add_reader())
+        self.api_dump.add_internal_client(cconn)
         return ADXL345QueryHelper(self.printer, cconn)
 
 def load_config(config):
@@ -4,7 +4,8 @@
 # Copyright (C) 2018-2019 Eric Callahan <arksine.code@gmail.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, math, json, collections
+import logging, math, json, collections, importlib
+import chelper
 from . import probe
 
 PROFILE_VERSION = 1
@@ -35,6 +36,140 @@ def constrain(val, min_val, max_val):
 def lerp(t, v0, v1):
     return (1. - t) * v0 + t * v1
 
+# numpy is optional - it is only used to speed up mesh calculations
+NUMPY_UNLOADED = object()
+numpy = NUMPY_UNLOADED
+def get_numpy():
+    global numpy
+    if numpy is NUMPY_UNLOADED:
+        try:
+            numpy = importlib.import_module('numpy')
+        except ImportError:
+            logging.info("bed_mesh: numpy not available, using C helpers")
+            numpy = None
+    return numpy
+
+# Extract the xy bounds of the extruding moves in a gcode file.  The
+# bounds reported in a slicer header are used when available,
+# otherwise extruding moves are scanned up to the given z height.
+SLICER_HEADER_LINES = 200
+SLICER_BOUNDS = {';MINX:': 0, ';MINY:': 1, ';MAXX:': 2, ';MAXY:': 3}
+def get_gcode_bounds(filename, max_z):
+    bounds = [None] * 4
+    with open(filename, 'r') as f:
+        for i, line in enumerate(f):
+            if i >= SLICER_HEADER_LINES:
+                break
+            for prefix, idx in SLICER_BOUNDS.items():
+                if line.startswith(prefix):
+                    bounds[idx] = float(line[len(prefix):])
+        if None not in bounds:
+            return tuple(bounds)
+        # Pre-scan the extruding moves of the first layers
+        f.seek(0)
+        pos = {'X': 0., 'Y': 0., 'Z': 0., 'E': 0.}
+        absolute_coord = absolute_extrude = True
+        min_x = min_y = 99999999.
+        max_x = max_y = -99999999.
+        for line in f:
+            cpos = line.find(';')
+            if cpos >= 0:
+                line = line[:cpos]
+            parts = line.split()
+            if not parts:
+                continue
+            cmd = parts[0].upper()
+            if cmd == 'G90':
+                absolute_coord = absolute_extrude = True
+            elif cmd == 'G91':
+                absolute_coord = absolute_extrude = False
+            elif cmd == 'M82':
+                absolute_extrude = True
+            elif cmd == 'M83':
+                absolute_extrude = False
+            elif cmd == 'G92':
+                for p in parts[1:]:
+                    axis = p[:1].upper()
+                    if axis in pos:
+                        pos[axis] = float(p[1:] or 0.)
+            elif cmd not in ('G0', 'G1', 'G2', 'G3'):
+                continue
+            else:
+                last_x, last_y = pos['X'], pos['Y']
+                extrude = 0.
+                for p in parts[1:]:
+                    axis = p[:1].upper()
+                    if axis not in pos:
+                        continue
+                    val = float(p[1:])
+                    if axis == 'E':
+                        if absolute_extrude:
+                            val -= pos['E']
+                        extrude = val
+                        pos['E'] += val
+                    elif absolute_coord:
+                        pos[axis] = val
+                    else:
+                        pos[axis] += val
+                if pos['Z'] > max_z and max_x >= min_x:
+                    break
+                if extrude <= 0.:
+                    continue
+                for x, y in ((last_x, last_y), (pos['X'], pos['Y'])):
+                    min_x = min(min_x, x)
+                    min_y = min(min_y, y)
+                    max_x = max(max_x, x)
+                    max_y = max(max_y, y)
+    if max_x < min_x:
+        return None
+    return min_x, min_y, max_x, max_y
+
+# Default height to pre-scan a gcode file for an adaptive mesh
+ADAPTIVE_SCAN_HEIGHT = 5.
+
+# Order probe points with a nearest neighbor tour improved by 2-opt
+def optimize_probe_path(points, start):
+    def dist(a, b):
+        return math.sqrt((a[0] - b[0])**2 + (a[1] - b[1])**2)
+    remaining = list(range(len(points)))
+    order = []
+    cur = start
+    while remaining:
+        idx = min(remaining, key=lambda i: dist(cur, points[i]))
+        remaining.remove(idx)
+        order.append(idx)
+        cur = points[idx]
+    # The path is open - it starts at the toolhead and may end anywhere
+    count = len(order)
+    for _ in range(10):
+        improved = False
+        for i in range(count - 1):
+            a = start if not i else points[order[i-1]]
+            b = points[order[i]]
+            for j in range(i + 1, count):
+                c = points[order[j]]
+                old_d = dist(a, b)
+                new_d = dist(a, c)
+                if j + 1 < count:
+                    d = points[order[j+1]]
+                    old_d += dist(c, d)
+                    new_d += dist(b, d)
+                if new_d < old_d - 1e-6:
+                    order[i:j+1] = order[i:j+1][::-1]
+                    b = points[order[i]]
+                    improved = True
+        if not improved:
+            break
+    return order
+
+def calc_path_length(points, start):
+    length = 0.
+    cur = start
+    for pt in points:
+        length += math.sqrt((pt[0] - cur[0])**2 + (pt[1] - cur[1])**2)
+        cur = pt
+    return length
+
 # retreive commma separated pair from config
 def parse_config_pair(config, option, default, minval=None, maxval=None):
     pair = config.getintlist(option, (default, default))
@@ -104,7 +239,10 @@ class BedMesh:
         self.base_fade_target = config.getfloat('fade_target', None)
         self.fade_target = 0.
         self.gcode = self.printer.lookup_object('gcode')
-        self.splitter = MoveSplitter(config, self.gcode)
+        split_methods = {'cell': CellMoveSplitter, 'distance': MoveSplitter}
+        split_method = config.getchoice('split_method', split_methods,
+                                      'distance')
+        self.splitter = split_method(config, self.gcode)
         # setup persistent storage
         self.pmgr = ProfileManager(config, self)
         self.save_profile = self.pmgr.save_profile
@@ -203,14 +341,10 @@ class BedMesh:
                     % (z, self.fade_target))
             self.toolhead.move([x, y, z + self.fade_target, e], speed)
         else:
-            self.splitter.build_move(self.last_position, newpos, factor)
-            while not self.splitter.traverse_complete:
-                split_move = self.splitter.split()
-                if split_move:
-                    self.toolhead.move(split_move, speed)
-                else:
-                    raise self.gcode.error(
-                        """{"code":"key235", "msg":"Mesh Leveling: Error splitting move ", "values": []}""")
+            split_moves = self.splitter.split_move(
+                self.last_position, newpos, factor)
+            for split_move in split_moves:
+                self.toolhead.move(split_move, speed)
         self.last_position[:] = newpos
     def get_status(self, eventtime=None):
         status = {
@@ -289,6 +423,14 @@ class BedMeshCalibrate:
         self._generate_points(config.error)
         self._profile_name = None
         self.orig_points = self.points
+        self.probe_order = None
+        # Adaptive (region limited) mesh settings
+        self.adaptive_margin = config.getfloat(
+            'adaptive_margin', 5., minval=0.)
+        self.adaptive_curvature = config.getfloat(
+            'adaptive_curvature', .01, above=0.)
+        self.adaptive_base = self.adaptive_full_params = None
+        self.adaptive_rri = None
         self.probe_helper = probe.ProbePointsHelper(
             config, self.probe_finalize, self._get_adjusted_points())
         self.probe_helper.minimum_points(3)
@@ -560,13 +702,18 @@ class BedMeshCalibrate:
             self.mesh_config['algo'] = gcmd.get('ALGORITHM').strip().lower()
             need_cfg_update = True
 
+        self.adaptive_base = self.adaptive_full_params = None
+        self.adaptive_rri = None
+        if gcmd.get_int('ADAPTIVE', 0):
+            if self._set_adaptive_region(gcmd):
+                need_cfg_update = True
+
         if need_cfg_update:
             self._verify_algorithm(gcmd.error)
             self._generate_points(gcmd.error)
             gcmd.respond_info("Generating new points...")
             self.print_generated_points(gcmd.respond_info)
-            pts = self._get_adjusted_points()
-            self.probe_helper.update_probe_points(pts, 3)
+            self._set_probe_path(self._get_adjusted_points())
             msg = "relative_reference_index: %s\n" % \
                 (self.relative_reference_index)
             msg += "\n".join(["%s: %s" % (k, v) for k, v
@@ -574,8 +721,202 @@ class BedMeshCalibrate:
             logging.info("Updated Mesh Configuration:\n" + msg)
         else:
             self.points = self.orig_points
-            pts = self._get_adjusted_points()
-            self.probe_helper.update_probe_points(pts, 3)
+            self._set_probe_path(self._get_adjusted_points())
+    def _set_probe_path(self, pts):
+        # Visit the probe points in the shortest order found
+        self.probe_order = None
+        x_offset = y_offset = 0.
+        probe = self.printer.lookup_object('probe', None)
+        if probe is not None:
+            x_offset, y_offset = probe.get_offsets()[:2]
+        toolhead = self.printer.lookup_object('toolhead')
+        pos = toolhead.get_position()
+        start = (pos[0] + x_offset, pos[1] + y_offset)
+        order = optimize_probe_path(pts, start)
+        path = [pts[i] for i in order]
+        orig_len = calc_path_length(pts, start)
+        path_len = calc_path_length(path, start)
+        if path_len < orig_len - 1.:
+            logging.info("bed_mesh: optimized probe path %.1fmm -> %.1fmm"
+                         % (orig_len, path_len))
+            self.probe_order = order
+            pts = path
+        self.probe_helper.update_probe_points(pts, 3)
+    def _set_adaptive_region(self, gcmd):
+        # Limit probing to the area used by the print
+        if self.radius is not None:
+            gcmd.respond_info("bed_mesh: adaptive meshing is not supported"
+                              " on round beds, probing full mesh")
+            return False
+        if 'PRINT_MIN' in gcmd.get_command_parameters():
+            bounds = (parse_gcmd_coord(gcmd, 'PRINT_MIN')
+                      + parse_gcmd_coord(gcmd, 'PRINT_MAX'))
+        else:
+            bounds = None
+            sdcard = self.printer.lookup_object('virtual_sdcard', None)
+            filename = None
+            if sdcard is not None:
+                filename = sdcard.file_path()
+            if filename is not None:
+                scan_z = self.bedmesh.fade_end
+                if scan_z == self.bedmesh.FADE_DISABLE:
+                    scan_z = ADAPTIVE_SCAN_HEIGHT
+                try:
+                    bounds = get_gcode_bounds(filename, scan_z)
+                except (IOError, ValueError):
+                    logging.exception("bed_mesh: unable to scan %s"
+                                      % (filename,))
+        if bounds is None:
+            gcmd.respond_info("bed_mesh: unable to determine print area,"
+                              " probing full mesh")
+            return False
+        margin = gcmd.get_float('ADAPTIVE_MARGIN', self.adaptive_margin,
+                                minval=0.)
+        (full_min_x, full_min_y), (full_max_x, full_max_y) = \
+            self.mesh_min, self.mesh_max
+        min_x = max(bounds[0] - margin, full_min_x)
+        min_y = max(bounds[1] - margin, full_min_y)
+        max_x = min(bounds[2] + margin, full_max_x)
+        max_y = min(bounds[3] + margin, full_max_y)
+        full_x_cnt = self.mesh_config['x_count']
+        full_y_cnt = self.mesh_config['y_count']
+        x_spacing = (full_max_x - full_min_x) / (full_x_cnt - 1)
+        y_spacing = (full_max_y - full_min_y) / (full_y_cnt - 1)
+        # Keep the region large enough for at least a 3x3 grid
+        min_size_x = min(2. * x_spacing, full_max_x - full_min_x)
+        min_size_y = min(2. * y_spacing, full_max_y - full_min_y)
+        if max_x - min_x < min_size_x:
+            min_x = max(full_min_x, .5 * (min_x + max_x - min_size_x))
+            max_x = min(full_max_x, min_x + min_size_x)
+            min_x = max_x - min_size_x
+        if max_y - min_y < min_size_y:
+            min_y = max(full_min_y, .5 * (min_y + max_y - min_size_y))
+            max_y = min(full_max_y, min_y + min_size_y)
+            min_y = max_y - min_size_y
+        # Reduce the probe count while keeping the configured density
+        min_cnt = 3
+        if self.mesh_config['algo'] == 'bicubic':
+            min_cnt = 4
+        x_cnt = max(min_cnt, int(math.ceil((max_x - min_x) / x_spacing)) + 1)
+        y_cnt = max(min_cnt, int(math.ceil((max_y - min_y) / y_spacing)) + 1)
+        x_cnt = min(x_cnt, full_x_cnt)
+        y_cnt = min(y_cnt, full_y_cnt)
+        # Use the stored profile to find areas needing more density
+        base = self.bedmesh.pmgr.build_profile_mesh(self._profile_name)
+        if base is None and self.relative_reference_index is not None:
+            # The reference point may be outside of the probed region
+            gcmd.respond_info("bed_mesh: adaptive meshing with a"
+                              " relative_reference_index requires a stored"
+                              " profile, probing full mesh")
+            return False
+        if base is not None:
+            if self._calc_max_curvature(base, (min_x, min_y), (max_x, max_y),
+                                        x_cnt, y_cnt, 0) > \
+                                        self.adaptive_curvature:
+                x_cnt = full_x_cnt
+            if self._calc_max_curvature(base, (min_x, min_y), (max_x, max_y),
+                                        x_cnt, y_cnt, 1) > \
+                                        self.adaptive_curvature:
+                y_cnt = full_y_cnt
+        if (x_cnt == full_x_cnt and y_cnt == full_y_cnt
+            and max_x - min_x >= full_max_x - full_min_x - x_spacing
+            and max_y - min_y >= full_max_y - full_min_y - y_spacing):
+            # Region covers most of the bed, just probe the full mesh
+            return False
+        self._verify_algorithm(gcmd.error)
+        self.adaptive_full_params = full_params = dict(self.mesh_config)
+        full_params['min_x'], full_params['min_y'] = self.mesh_min
+        full_params['max_x'], full_params['max_y'] = self.mesh_max
+        self.adaptive_base = base
+        self.mesh_min = (min_x, min_y)
+        self.mesh_max = (max_x, max_y)
+        self.mesh_config['x_count'] = x_cnt
+        self.mesh_config['y_count'] = y_cnt
+        # The reference index refers to the full mesh - it is applied
+        # once the probed region has been merged into the full mesh
+        self.adaptive_rri = self.relative_reference_index
+        self.relative_reference_index = None
+        gcmd.respond_info(
+            "bed_mesh: adaptive mesh (%.1f, %.1f) - (%.1f, %.1f), %dx%d points"
+            % (min_x, min_y, max_x, max_y, x_cnt, y_cnt))
+        return True
+    def _calc_max_curvature(self, mesh, mesh_min, mesh_max, x_cnt, y_cnt,
+                            axis):
+        # Compare the stored mesh between probe points with a straight
+        # line between those points along the given axis
+        x_dist = (mesh_max[0] - mesh_min[0]) / (x_cnt - 1)
+        y_dist = (mesh_max[1] - mesh_min[1]) / (y_cnt - 1)
+        xs = []
+        ys = []
+        for j in range(y_cnt):
+            for i in range(x_cnt):
+                x = mesh_min[0] + i * x_dist
+                y = mesh_min[1] + j * y_dist
+                if axis == 0 and i < x_cnt - 1:
+                    xs.extend((x, x + .5 * x_dist, x + x_dist))
+                    ys.extend((y, y, y))
+                elif axis == 1 and j < y_cnt - 1:
+                    xs.extend((x, x, x))
+                    ys.extend((y, y + .5 * y_dist, y + y_dist))
+        zs = mesh.calc_z_batch(xs, ys)
+        max_curvature = 0.
+        for i in range(0, len(zs), 3):
+            z0, zmid, z1 = zs[i:i+3]
+            max_curvature = max(max_curvature, abs(zmid - .5 * (z0 + z1)))
+        return max_curvature
+    def _merge_adaptive_mesh(self, z_mesh):
+        # Fill the area outside of the probed region from the stored
+        # profile, shifted to match the newly probed region
+        base = self.adaptive_base
+        params = self.adaptive_full_params
+        x_cnt = params['x_count']
+        y_cnt = params['y_count']
+        x_dist = math.floor((params['max_x'] - params['min_x'])
+                            / (x_cnt - 1) * 100) / 100
+        y_dist = math.floor((params['max_y'] - params['min_y'])
+                            / (y_cnt - 1) * 100) / 100
+        params['max_x'] = params['min_x'] + x_dist * (x_cnt - 1)
+        params['max_y'] = params['min_y'] + y_dist * (y_cnt - 1)
+        region_pts = [(z_mesh.get_x_coordinate(i), z_mesh.get_y_coordinate(j))
+                      for j in range(z_mesh.mesh_y_count)
+                      for i in range(z_mesh.mesh_x_count)]
+        region_z = z_mesh.calc_z_batch([p[0] for p in region_pts],
+                                       [p[1] for p in region_pts])
+        base_z = base.calc_z_batch([p[0] for p in region_pts],
+                                   [p[1] for p in region_pts])
+        shift = sum([r - b for r, b in zip(region_z, base_z)]) / len(region_z)
+        region_min = (z_mesh.mesh_x_min, z_mesh.mesh_y_min)
+        region_max = (z_mesh.mesh_x_max, z_mesh.mesh_y_max)
+        probed_matrix = []
+        for j in range(y_cnt):
+            y = params['min_y'] + j * y_dist
+            row = []
+            for i in range(x_cnt):
+                x = params['min_x'] + i * x_dist
+                if within((x, y), region_min, region_max, tol=.01):
+                    row.append(z_mesh.calc_z(x, y))
+                else:
+                    row.append(base.calc_z(x, y) + shift)
+            probed_matrix.append(row)
+        merged = ZMesh(params)
+        merged.build_mesh(probed_matrix)
+        rri = self.adaptive_rri
+        if rri is not None:
+            # Zero the merged mesh at the reference point of the full mesh
+            # (points are generated in a zig-zag pattern)
+            row, col = divmod(rri, x_cnt)
+            if row % 2:
+                col = x_cnt - 1 - col
+            z_ref = merged.calc_z(params['min_x'] + col * x_dist,
+                                  params['min_y'] + row * y_dist)
+            probed_matrix = [[z - z_ref for z in row_z]
+                             for row_z in probed_matrix]
+            merged = ZMesh(params)
+            merged.build_mesh(probed_matrix)
+            shift -= z_ref
+        logging.info("bed_mesh: merged adaptive region with stored profile"
+                     " (offset %.4f)" % (shift,))
+        return merged
     def _get_adjusted_points(self):
         if not self.substituted_indices:
             return self.points
@@ -596,6 +937,12 @@ class BedMeshCalibrate:
         self.update_config(gcmd)
         self.probe_helper.start_probe(gcmd)
     def probe_finalize(self, offsets, positions):
+        if self.probe_order is not None:
+            # Restore the generated order of the probed points
+            ordered = [None] * len(positions)
+            for pos, idx in zip(positions, self.probe_order):
+                ordered[idx] = pos
+            positions = ordered
         x_offset, y_offset, z_offset = offsets
         positions = [[round(p[0], 2), round(p[1], 2), p[2]]
                      for p in positions]
@@ -705,6 +1052,8 @@ class BedMeshCalibrate:
         z_mesh = ZMesh(params)
         try:
             z_mesh.build_mesh(probed_matrix)
+            if self.adaptive_base is not None:
+                z_mesh = self._merge_adaptive_mesh(z_mesh)
         except BedMeshError as e:
             raise self.gcode.error(str(e))
         self.bedmesh.set_mesh(z_mesh)
@@ -753,10 +1102,30 @@ class MoveSplitter:
         axes_d = [self.next_pos[i] - self.prev_pos[i] for i in range(4)]
         self.total_move_length = math.sqrt(sum([d*d for d in axes_d[:3]]))
         self.axis_move = [not isclose(d, 0., abs_tol=1e-10) for d in axes_d]
+        self.check_offsets = []
+        self.check_index = 0
+        if self.axis_move[0] or self.axis_move[1]:
+            self._calc_check_offsets()
     def _calc_z_offset(self, pos):
         z = self.z_mesh.calc_z(pos[0], pos[1])
         offset = self.fade_offset
         return self.z_factor * (z - offset) + offset
+    def _calc_check_offsets(self):
+        # Lookup the mesh z at every check point of the move in one batch
+        count = int(self.total_move_length / self.move_check_distance)
+        if count * self.move_check_distance >= self.total_move_length:
+            count -= 1
+        if count <= 0:
+            return
+        inv_length = 1. / self.total_move_length
+        ts = [(i + 1) * self.move_check_distance * inv_length
+              for i in range(count)]
+        xs = [lerp(t, self.prev_pos[0], self.next_pos[0]) for t in ts]
+        ys = [lerp(t, self.prev_pos[1], self.next_pos[1]) for t in ts]
+        offset = self.fade_offset
+        factor = self.z_factor
+        self.check_offsets = [factor * (z - offset) + offset
+                              for z in self.z_mesh.calc_z_batch(xs, ys)]
     def _set_next_move(self, distance_from_prev):
         t = distance_from_prev / self.total_move_length
         if t > 1. or t < 0.:
@@ -766,16 +1135,27 @@ class MoveSplitter:
             if self.axis_move[i]:
                 self.current_pos[i] = lerp(
                     t, self.prev_pos[i], self.next_pos[i])
+    def split_move(self, prev_pos, next_pos, factor):
+        self.build_move(prev_pos, next_pos, factor)
+        moves = []
+        while not self.traverse_complete:
+            split_move = self.split()
+            if not split_move:
+                raise self.gcode.error(
+                    """{"code":"key235", "msg":"Mesh Leveling: Error splitting move ", "values": []}""")
+            moves.append(list(split_move))
+        return moves
     def split(self):
         if not self.traverse_complete:
             if self.axis_move[0] or self.axis_move[1]:
                 # X and/or Y axis move, traverse if necessary
-                while self.distance_checked + self.move_check_distance \
-                        < self.total_move_length:
+                check_offsets = self.check_offsets
+                while self.check_index < len(check_offsets):
+                    next_z = check_offsets[self.check_index]
+                    self.check_index += 1
                     self.distance_checked += self.move_check_distance
-                    self._set_next_move(self.distance_checked)
-                    next_z = self._calc_z_offset(self.current_pos)
                     if abs(next_z - self.z_offset) >= self.split_delta_z:
+                        self._set_next_move(self.distance_checked)
                         self.z_offset = next_z
                         return self.current_pos[0], self.current_pos[1], \
                             self.current_pos[2] + self.z_offset, \
@@ -793,9 +1173,103 @@ class MoveSplitter:
             return None
 
 
+# Split moves at the exact crossings of mesh cell boundaries
+class CellMoveSplitter:
+    def __init__(self, config, gcode):
+        self.split_delta_z = config.getfloat(
+            'split_delta_z', .025, minval=0.01)
+        self.z_mesh = None
+        self.fade_offset = 0.
+        self.gcode = gcode
+    def initialize(self, mesh, fade_offset):
+        self.z_mesh = mesh
+        self.fade_offset = fade_offset
+    def _calc_crossings(self, start, delta, mesh_min, mesh_dist, count):
+        # Return the move times (0..1) that cross a mesh line on an axis
+        if isclose(delta, 0., abs_tol=1e-10):
+            return []
+        inv_delta = 1. / delta
+        end = start + delta
+        lo = int(math.ceil((min(start, end) - mesh_min) / mesh_dist))
+        hi = int(math.floor((max(start, end) - mesh_min) / mesh_dist))
+        lo = max(lo, 0)
+        hi = min(hi, count - 1)
+        return [(mesh_min + i * mesh_dist - start) * inv_delta
+                for i in range(lo, hi + 1)]
+    def _calc_times(self, prev_pos, next_pos):
+        mesh = self.z_mesh
+        x_min = mesh.mesh_x_min - mesh.mesh_offsets[0]
+        y_min = mesh.mesh_y_min - mesh.mesh_offsets[1]
+        times = self._calc_crossings(
+            prev_pos[0], next_pos[0] - prev_pos[0], x_min,
+            mesh.mesh_x_dist, mesh.mesh_x_count)
+        times.extend(self._calc_crossings(
+            prev_pos[1], next_pos[1] - prev_pos[1], y_min,
+            mesh.mesh_y_dist, mesh.mesh_y_count))
+        times.sort()
+        # Bilinear z is quadratic between crossings - also sample the
+        # midpoint of each interval to detect curvature within a cell
+        out = [0.]
+        for t in times:
+            last_t = out[-1]
+            if t - last_t <= 1e-9 or t >= 1.:
+                continue
+            out.append(.5 * (last_t + t))
+            out.append(t)
+        out.append(.5 * (out[-1] + 1.))
+        out.append(1.)
+        return out
+    def split_move(self, prev_pos, next_pos, factor):
+        x0, y0, z0, e0 = prev_pos
+        x1, y1, z1, e1 = next_pos
+        offset = self.fade_offset
+        if isclose(x0, x1, abs_tol=1e-10) and isclose(y0, y1, abs_tol=1e-10):
+            z = self.z_mesh.calc_z(x1, y1)
+            return [[x1, y1, z1 + factor * (z - offset) + offset, e1]]
+        # Lookup the mesh z at all interesting points in one batch
+        times = self._calc_times(prev_pos, next_pos)
+        dx, dy, dz, de = x1 - x0, y1 - y0, z1 - z0, e1 - e0
+        zs = self.z_mesh.calc_z_batch([x0 + t * dx for t in times],
+                                      [y0 + t * dy for t in times])
+        zs = [factor * (z - offset) + offset for z in zs]
+        # Greedily choose the longest segments whose straight line
+        # z-adjustment stays within split_delta_z of the mesh
+        tol = self.split_delta_z
+        moves = []
+        anchor = 0
+        count = len(times)
+        while anchor < count - 1:
+            ta, za = times[anchor], zs[anchor]
+            min_slope, max_slope = -1e300, 1e300
+            end = i = anchor + 1
+            while i < count:
+                dt = times[i] - ta
+                slope = (zs[i] - za) / dt
+                if slope < min_slope or slope > max_slope:
+                    break
+                end = i
+                slope_tol = tol / dt
+                if slope - slope_tol > min_slope:
+                    min_slope = slope - slope_tol
+                if slope + slope_tol < max_slope:
+                    max_slope = slope + slope_tol
+                i += 1
+            # Prefer stopping at a cell crossing (odd indexes are midpoints)
+            if end < count - 1 and end & 1 and end - 1 > anchor:
+                end -= 1
+            t = times[end]
+            moves.append([x0 + t * dx, y0 + t * dy, z0 + t * dz + zs[end],
+                          e0 + t * de])
+            anchor = end
+        moves[-1] = [x1, y1, z1 + zs[-1], e1]
+        return moves
+
+
 class ZMesh:
     def __init__(self, params):
         self.probed_matrix = self.mesh_matrix = None
+        self.mesh_coeffs = self.np_coeffs = self.c_coeffs = None
+        self.rounded_mesh_matrix = None
         self.mesh_params = params
         self.avg_z = 0.
         self.mesh_offsets = [0., 0.]
@@ -834,8 +1308,10 @@ class ZMesh:
                            (self.mesh_y_count - 1)
     def get_mesh_matrix(self):
         if self.mesh_matrix is not None:
-            return [[round(z, 6) for z in line]
-                    for line in self.mesh_matrix]
+            if self.rounded_mesh_matrix is None:
+                self.rounded_mesh_matrix = [[round(z, 6) for z in line]
+                                            for line in self.mesh_matrix]
+            return self.rounded_mesh_matrix
         return [[]]
     def get_probed_matrix(self):
         if self.probed_matrix is not None:
@@ -877,14 +1353,17 @@ class ZMesh:
             print_func("bed_mesh: Z Mesh not generated")
     def build_mesh(self, z_matrix):
         self.probed_matrix = z_matrix
+        self.rounded_mesh_matrix = None
         self._sample(z_matrix)
+        self._build_coefficients()
         self.avg_z = (sum([sum(x) for x in self.mesh_matrix]) /
                       sum([len(x) for x in self.mesh_matrix]))
         # Round average to the nearest 100th.  This
         # should produce an offset that is divisible by common
         # z step distances
         self.avg_z = round(self.avg_z, 2)
-        self.print_mesh(logging.debug)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            self.print_mesh(logging.debug)
     def set_mesh_offsets(self, offsets):
         for i, o in enumerate(offsets):
             if o is not None:
@@ -894,16 +1373,72 @@ class ZMesh:
     def get_y_coordinate(self, index):
         return self.mesh_y_min + self.mesh_y_dist * index
     def calc_z(self, x, y):
-        if self.mesh_matrix is not None:
-            tbl = self.mesh_matrix
-            tx, xidx = self._get_linear_index(x + self.mesh_offsets[0], 0)
-            ty, yidx = self._get_linear_index(y + self.mesh_offsets[1], 1)
-            z0 = lerp(tx, tbl[yidx][xidx], tbl[yidx][xidx+1])
-            z1 = lerp(tx, tbl[yidx+1][xidx], tbl[yidx+1][xidx+1])
-            return lerp(ty, z0, z1)
-        else:
+        coeffs = self.mesh_coeffs
+        if coeffs is None:
             # No mesh table generated, no z-adjustment
             return 0.
+        tx, xidx = self._get_linear_index(x + self.mesh_offsets[0], 0)
+        ty, yidx = self._get_linear_index(y + self.mesh_offsets[1], 1)
+        i = (yidx * (self.mesh_x_count - 1) + xidx) * 4
+        return coeffs[i] + coeffs[i+1] * tx + (
+            coeffs[i+2] + coeffs[i+3] * tx) * ty
+    def calc_z_batch(self, xs, ys):
+        # Calculate z-adjustment for a sequence of coordinates
+        count = len(xs)
+        if self.mesh_coeffs is None:
+            return [0.] * count
+        min_x = self.mesh_x_min - self.mesh_offsets[0]
+        min_y = self.mesh_y_min - self.mesh_offsets[1]
+        x_cells = self.mesh_x_count - 1
+        y_cells = self.mesh_y_count - 1
+        np = get_numpy()
+        if np is not None:
+            px = (np.asarray(xs, dtype=float) - min_x) / self.mesh_x_dist
+            py = (np.asarray(ys, dtype=float) - min_y) / self.mesh_y_dist
+            xidx = np.clip(np.floor(px).astype(int), 0, x_cells - 1)
+            yidx = np.clip(np.floor(py).astype(int), 0, y_cells - 1)
+            tx = np.clip(px - xidx, 0., 1.)
+            ty = np.clip(py - yidx, 0., 1.)
+            c = self.np_coeffs[yidx * x_cells + xidx]
+            z = c[:,0] + c[:,1] * tx + (c[:,2] + c[:,3] * tx) * ty
+            return z.tolist()
+        ffi_main, ffi_lib = chelper.get_ffi()
+        c_xs = ffi_main.new('double[]', list(xs))
+        c_ys = ffi_main.new('double[]', list(ys))
+        c_out = ffi_main.new('double[]', count)
+        ffi_lib.bedmesh_calc_z(
+            self.c_coeffs, x_cells, y_cells, min_x, min_y,
+            self.mesh_x_dist, self.mesh_y_dist, c_xs, c_ys, c_out, count)
+        return list(c_out)
+    def _build_coefficients(self):
+        # Precompute bilinear coefficients for every mesh cell
+        tbl = self.mesh_matrix
+        np = get_numpy()
+        if np is not None:
+            m = np.array(tbl)
+            z00 = m[:-1,:-1]
+            z10 = m[:-1,1:]
+            z01 = m[1:,:-1]
+            z11 = m[1:,1:]
+            self.np_coeffs = np.stack(
+                (z00, z10 - z00, z01 - z00, z11 - z10 - z01 + z00),
+                axis=-1).reshape(-1, 4)
+            self.mesh_coeffs = self.np_coeffs.ravel().tolist()
+            return
+        coeffs = []
+        for yidx in range(self.mesh_y_count - 1):
+            row0 = tbl[yidx]
+            row1 = tbl[yidx+1]
+            for xidx in range(self.mesh_x_count - 1):
+                z00 = row0[xidx]
+                z10 = row0[xidx+1]
+                z01 = row1[xidx]
+                z11 = row1[xidx+1]
+                coeffs.extend((z00, z10 - z00, z01 - z00,
+                               z11 - z10 - z01 + z00))
+        self.mesh_coeffs = coeffs
+        ffi_main, ffi_lib = chelper.get_ffi()
+        self.c_coeffs = ffi_main.new('double[]', coeffs)
     def get_z_range(self):
         if self.mesh_matrix is not None:
             mesh_min = min([min(x) for x in self.mesh_matrix])
@@ -932,31 +1467,14 @@ class ZMesh:
     def _sample_direct(self, z_matrix):
         self.mesh_matrix = z_matrix
     def _sample_lagrange(self, z_matrix):
-        x_mult = self.x_mult
-        y_mult = self.y_mult
-        self.mesh_matrix = \
-            [[0. if ((i % x_mult) or (j % y_mult))
-             else z_matrix[j//y_mult][i//x_mult]
-             for i in range(self.mesh_x_count)]
-             for j in range(self.mesh_y_count)]
         xpts, ypts = self._get_lagrange_coords()
-        # Interpolate X coordinates
-        for i in range(self.mesh_y_count):
-            # only interpolate X-rows that have probed coordinates
-            if i % y_mult != 0:
-                continue
-            for j in range(self.mesh_x_count):
-                if j % x_mult == 0:
-                    continue
-                x = self.get_x_coordinate(j)
-                self.mesh_matrix[i][j] = self._calc_lagrange(xpts, x, i, 0)
-        # Interpolate Y coordinates
-        for i in range(self.mesh_x_count):
-            for j in range(self.mesh_y_count):
-                if j % y_mult == 0:
-                    continue
-                y = self.get_y_coordinate(j)
-                self.mesh_matrix[j][i] = self._calc_lagrange(ypts, y, i, 1)
+        x_weights = [self._calc_lagrange_weights(
+            xpts, self.get_x_coordinate(i), i, self.x_mult)
+            for i in range(self.mesh_x_count)]
+        y_weights = [self._calc_lagrange_weights(
+            ypts, self.get_y_coordinate(j), j, self.y_mult)
+            for j in range(self.mesh_y_count)]
+        self._apply_weights(z_matrix, x_weights, y_weights)
     def _get_lagrange_coords(self):
         xpts = []
         ypts = []
@@ -965,9 +1483,14 @@ class ZMesh:
         for j in range(self.mesh_params['y_count']):
             ypts.append(self.get_y_coordinate(j * self.y_mult))
         return xpts, ypts
-    def _calc_lagrange(self, lpts, c, vec, axis=0):
+    def _calc_lagrange_weights(self, lpts, c, index, mult):
+        # Weight of each probed point for the mesh point at index
         pt_cnt = len(lpts)
-        total = 0.
+        if index % mult == 0:
+            weights = [0.] * pt_cnt
+            weights[index // mult] = 1.
+            return weights
+        weights = []
         for i in range(pt_cnt):
             n = 1.
             d = 1.
@@ -976,111 +1499,71 @@ class ZMesh:
                     continue
                 n *= (c - lpts[j])
                 d *= (lpts[i] - lpts[j])
-            if axis == 0:
-                # Calc X-Axis
-                z = self.mesh_matrix[vec][i*self.x_mult]
-            else:
-                # Calc Y-Axis
-                z = self.mesh_matrix[i*self.y_mult][vec]
-            total += z * n / d
-        return total
+            weights.append(n / d)
+        return weights
     def _sample_bicubic(self, z_matrix):
         # should work for any number of probe points above 3x3
-        x_mult = self.x_mult
-        y_mult = self.y_mult
         c = self.mesh_params['tension']
-        self.mesh_matrix = \
-            [[0. if ((i % x_mult) or (j % y_mult))
-             else z_matrix[j//y_mult][i//x_mult]
-             for i in range(self.mesh_x_count)]
-             for j in range(self.mesh_y_count)]
-        # Interpolate X values
-        for y in range(self.mesh_y_count):
-            if y % y_mult != 0:
-                continue
-            for x in range(self.mesh_x_count):
-                if x % x_mult == 0:
-                    continue
-                pts = self._get_x_ctl_pts(x, y)
-                self.mesh_matrix[y][x] = self._cardinal_spline(pts, c)
-        # Interpolate Y values
-        for x in range(self.mesh_x_count):
-            for y in range(self.mesh_y_count):
-                if y % y_mult == 0:
-                    continue
-                pts = self._get_y_ctl_pts(x, y)
-                self.mesh_matrix[y][x] = self._cardinal_spline(pts, c)
-    def _get_x_ctl_pts(self, x, y):
-        # Fetch control points and t for a X value in the mesh
-        x_mult = self.x_mult
-        x_row = self.mesh_matrix[y]
-        last_pt = self.mesh_x_count - 1 - x_mult
-        if x < x_mult:
-            p0 = p1 = x_row[0]
-            p2 = x_row[x_mult]
-            p3 = x_row[2*x_mult]
-            t = x / float(x_mult)
-        elif x > last_pt:
-            p0 = x_row[last_pt - x_mult]
-            p1 = x_row[last_pt]
-            p2 = p3 = x_row[last_pt + x_mult]
-            t = (x - last_pt) / float(x_mult)
-        else:
-            found = False
-            for i in range(x_mult, last_pt, x_mult):
-                if x > i and x < (i + x_mult):
-                    p0 = x_row[i - x_mult]
-                    p1 = x_row[i]
-                    p2 = x_row[i + x_mult]
-                    p3 = x_row[i + 2*x_mult]
-                    t = (x - i) / float(x_mult)
-                    found = True
-                    break
-            if not found:
-                raise BedMeshError(
-                    """{"code":"key51", "msg":"bed_mesh: Error finding x control points", "values": []}""")
-        return p0, p1, p2, p3, t
-    def _get_y_ctl_pts(self, x, y):
-        # Fetch control points and t for a Y value in the mesh
-        y_mult = self.y_mult
-        last_pt = self.mesh_y_count - 1 - y_mult
-        y_col = self.mesh_matrix
-        if y < y_mult:
-            p0 = p1 = y_col[0][x]
-            p2 = y_col[y_mult][x]
-            p3 = y_col[2*y_mult][x]
-            t = y / float(y_mult)
-        elif y > last_pt:
-            p0 = y_col[last_pt - y_mult][x]
-            p1 = y_col[last_pt][x]
-            p2 = p3 = y_col[last_pt + y_mult][x]
-            t = (y - last_pt) / float(y_mult)
+        x_weights = [self._calc_bicubic_weights(
+            i, self.x_mult, self.mesh_params['x_count'], c)
+            for i in range(self.mesh_x_count)]
+        y_weights = [self._calc_bicubic_weights(
+            j, self.y_mult, self.mesh_params['y_count'], c)
+            for j in range(self.mesh_y_count)]
+        self._apply_weights(z_matrix, x_weights, y_weights)
+    def _calc_bicubic_weights(self, index, mult, pt_cnt, tension):
+        # Weight of each probed point for the mesh point at index
+        # using a cardinal spline between control points p0-p3
+        weights = [0.] * pt_cnt
+        if index % mult == 0:
+            weights[index // mult] = 1.
+            return weights
+        last_pt = pt_cnt - 2
+        pidx = index // mult
+        t = (index - pidx * mult) / float(mult)
+        if pidx < 1:
+            p0, p1, p2, p3 = 0, 0, 1, 2
+        elif pidx >= last_pt:
+            p0, p1, p2, p3 = last_pt - 1, last_pt, last_pt + 1, last_pt + 1
         else:
-            found = False
-            for i in range(y_mult, last_pt, y_mult):
-                if y > i and y < (i + y_mult):
-                    p0 = y_col[i - y_mult][x]
-                    p1 = y_col[i][x]
-                    p2 = y_col[i + y_mult][x]
-                    p3 = y_col[i + 2*y_mult][x]
-                    t = (y - i) / float(y_mult)
-                    found = True
-                    break
-            if not found:
-                raise BedMeshError(
-                    """{"code":"key241", "msg":"bed_mesh: Error finding y control points", "values": []}""")
-        return p0, p1, p2, p3, t
-    def _cardinal_spline(self, p, tension):
-        t = p[4]
+            p0, p1, p2, p3 = pidx - 1, pidx, pidx + 1, pidx + 2
+        if p3 >= pt_cnt:
+            raise BedMeshError(
+                """{"code":"key51", "msg":"bed_mesh: Error finding x control points", "values": []}""")
         t2 = t*t
         t3 = t2*t
-        m1 = tension * (p[2] - p[0])
-        m2 = tension * (p[3] - p[1])
-        a = p[1] * (2*t3 - 3*t2 + 1)
-        b = p[2] * (-2*t3 + 3*t2)
-        c = m1 * (t3 - 2*t2 + t)
-        d = m2 * (t3 - t2)
-        return a + b + c + d
+        c = tension * (t3 - 2*t2 + t)
+        d = tension * (t3 - t2)
+        weights[p1] += 2*t3 - 3*t2 + 1
+        weights[p2] += -2*t3 + 3*t2
+        weights[p2] += c
+        weights[p0] -= c
+        weights[p3] += d
+        weights[p1] -= d
+        return weights
+    def _apply_weights(self, z_matrix, x_weights, y_weights):
+        # The upsampled mesh is y_weights * z_matrix * x_weights^T
+        np = get_numpy()
+        if np is not None:
+            mesh = np.dot(np.dot(np.array(y_weights), np.array(z_matrix)),
+                          np.array(x_weights).T)
+            self.mesh_matrix = mesh.tolist()
+            return
+        # Interpolate X values along each probed row
+        x_sparse = [[(k, w) for k, w in enumerate(row) if w]
+                    for row in x_weights]
+        x_rows = [[sum([w * z_row[k] for k, w in wrow]) for wrow in x_sparse]
+                  for z_row in z_matrix]
+        # Interpolate Y values from the X interpolated rows
+        self.mesh_matrix = mesh = []
+        for wrow in y_weights:
+            line = [0.] * self.mesh_x_count
+            for k, w in enumerate(wrow):
+                if not w:
+                    continue
+                x_row = x_rows[k]
+                line = [l + w * z for l, z in zip(line, x_row)]
+            mesh.append(line)
 
 
 class ProfileManager:
@@ -1171,6 +1654,22 @@ class ProfileManager:
             "for the current session.  The SAVE_CONFIG command will\n"
             "update the printer config file and restart the printer."
             % (prof_name))
+    def build_profile_mesh(self, prof_name=None):
+        # Return a mesh built from a stored profile, defaulting to the
+        # current profile.  Returns None if there is no such profile.
+        if prof_name is None:
+            prof_name = self.current_profile
+        profile = self.profiles.get(prof_name, None)
+        if profile is None:
+            return None
+        z_mesh = ZMesh(profile['mesh_params'])
+        try:
+            z_mesh.build_mesh(profile['points'])
+        except BedMeshError:
+            logging.exception("bed_mesh: unable to build profile [%s]"
+                              % (prof_name,))
+            return None
+        return z_mesh
     def load_profile(self, prof_name):
         profile = self.profiles.get(prof_name, None)
         if profile is None:
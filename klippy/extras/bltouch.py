@@ -64,7 +64,9 @@ class BLTouchEndstopWrapper:
         self.add_stepper = self.mcu_endstop.add_stepper
         self.get_steppers = self.mcu_endstop.get_steppers
         self.home_wait = self.mcu_endstop.home_wait
+        self.home_wait_batch = self.mcu_endstop.home_wait_batch
         self.query_endstop = self.mcu_endstop.query_endstop
+        self.add_query_endstop = self.mcu_endstop.add_query_endstop
         # Register BLTOUCH_DEBUG command
         self.gcode = self.printer.lookup_object('gcode')
         self.gcode.register_command("BLTOUCH_DEBUG", self.cmd_BLTOUCH_DEBUG,
@@ -100,6 +100,13 @@ class MCU_SPI:
         return self.spi_transfer_cmd.send_with_preface(
             self.spi_send_cmd, [self.oid, preface_data], [self.oid, data],
             minclock=minclock, reqclock=reqclock)
+    def spi_transfer_batch(self, data_list, minclock=0, reqclock=0):
+        # Issue several transfers before waiting for their responses
+        batch = self.mcu.create_query_batch()
+        for data in data_list:
+            batch.add_query(self.spi_transfer_cmd, [self.oid, data],
+                            minclock=minclock, reqclock=reqclock)
+        return batch.send()
 
 # Helper to setup an spi bus from settings in a config section
 def MCU_SPI_from_config(config, mode, pin_option="cs_pin",
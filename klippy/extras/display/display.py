@@ -53,6 +53,72 @@ class DisplayTemplate:
         context.update(params)
         return self.template.render(context)
 
+# Wrapper around an object's status that records which fields are read
+ALL_FIELDS = '*'
+class TrackedStatus:
+    def __init__(self, status, fields):
+        self._status = status
+        self._fields = fields
+    def __getitem__(self, key):
+        self._fields.add(key)
+        return self._status[key]
+    def __getattr__(self, key):
+        if key.startswith('__'):
+            raise AttributeError(key)
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+    def __contains__(self, key):
+        self._fields.add(key)
+        return key in self._status
+    def get(self, key, default=None):
+        self._fields.add(key)
+        return self._status.get(key, default)
+    def _get_all(self):
+        self._fields.add(ALL_FIELDS)
+        return self._status
+    def __iter__(self):
+        return iter(self._get_all())
+    def __len__(self):
+        return len(self._get_all())
+    def keys(self):
+        return self._get_all().keys()
+    def values(self):
+        return self._get_all().values()
+    def items(self):
+        return self._get_all().items()
+
+# Wrapper around the template "printer" variable that records the status
+# fields a template depends on
+class StatusTracker:
+    def __init__(self, status):
+        self.status = status
+        self.fields = None
+        self.untracked = False
+    def start(self):
+        self.fields = {}
+        self.untracked = False
+    def __getitem__(self, val):
+        res = self.status[val]
+        if self.fields is None or not isinstance(res, dict):
+            return res
+        fields = self.fields.setdefault(str(val).strip(), set())
+        return TrackedStatus(res, fields)
+    def __contains__(self, val):
+        res = val in self.status
+        if res and self.fields is not None:
+            self.fields.setdefault(str(val).strip(), set())
+        return res
+    def __iter__(self):
+        self.untracked = True
+        return iter(self.status)
+
+def calc_status_signature(status, fields):
+    if ALL_FIELDS in fields:
+        return status
+    return [status.get(field) for field in fields]
+
 # Store [display_data my_group my_item] sections (one instance per group name)
 class DisplayGroup:
     def __init__(self, config, name, data_configs):
@@ -76,16 +142,70 @@ class DisplayGroup:
             if c.get('text'):
                 template = gcode_macro.load_template(c, 'text')
                 self.data_items.append((row, col, template))
+        # Per item (dependencies, draw operations) of the last render
+        self.item_states = [None] * len(self.data_items)
+    def invalidate(self):
+        self.item_states = [None] * len(self.data_items)
+    def _is_dirty(self, state, status):
+        if state is None or state[0] is None:
+            return True
+        for name, (fields, signature) in state[0].items():
+            try:
+                cur_status = status[name]
+            except KeyError:
+                return True
+            if calc_status_signature(cur_status, fields) != signature:
+                return True
+        return False
     def show(self, display, templates, eventtime):
+        # Only items whose status dependencies changed are rendered.
+        # Returns True if the screen content needs to be redrawn.
+        if not self.data_items:
+            return False
         context = self.data_items[0][2].create_template_context(eventtime)
-        context['draw_progress_bar'] = display.draw_progress_bar
+        status = context['printer']
+        tracker = context['printer'] = StatusTracker(status)
+        ops = []
+        def draw_progress_bar(row, col, width, value):
+            ops.append((display.draw_progress_bar, (row, col, width, value)))
+            return ""
+        context['draw_progress_bar'] = draw_progress_bar
         def render(name, **kwargs):
             return templates[name].render(context, **kwargs)
         context['render'] = render
-        for row, col, template in self.data_items:
-            text = template.render(context)
-            display.draw_text(row, col, text.replace('\n', ''), eventtime)
-        context.clear() # Remove circular references for better gc
+        is_dirty = False
+        try:
+            for i, (row, col, template) in enumerate(self.data_items):
+                if not self._is_dirty(self.item_states[i], status):
+                    continue
+                is_dirty = True
+                self.item_states[i] = None
+                del ops[:]
+                tracker.start()
+                text = template.render(context)
+                ops.append((display.draw_text, (row, col,
+                                                text.replace('\n', ''),
+                                                eventtime)))
+                # Items that iterate over all objects are always rendered
+                deps = None
+                if not tracker.untracked:
+                    deps = {}
+                    for name, fields in tracker.fields.items():
+                        fields = sorted(fields)
+                        deps[name] = (fields, calc_status_signature(
+                            status[name], fields))
+                self.item_states[i] = (deps, list(ops))
+        finally:
+            context.clear() # Remove circular references for better gc
+        if not is_dirty:
+            return False
+        # Redraw the screen from the stored draw operations
+        display.lcd_chip.clear()
+        for state in self.item_states:
+            if state is not None:
+                for func, args in state[1]:
+                    func(*args)
+        return True
 
 class PrinterLCD:
     def __init__(self, config):
@@ -203,19 +323,22 @@ class PrinterLCD:
         if self.redraw_request_pending:
             self.redraw_request_pending = False
             self.redraw_time = eventtime + REDRAW_MIN_TIME
-        self.lcd_chip.clear()
         # update menu component
-        if self.menu is not None:
-            ret = self.menu.screen_update_event(eventtime)
-            if ret:
-                self.lcd_chip.flush()
-                return eventtime + REDRAW_TIME
-        # Update normal display
+        if self.menu is not None and self.menu.is_running():
+            self.lcd_chip.clear()
+            self.menu.screen_update_event(eventtime)
+            self.lcd_chip.flush()
+            self.show_data_group.invalidate()
+            return eventtime + REDRAW_TIME
+        # Update normal display (only flushed if something changed)
         try:
-            self.show_data_group.show(self, self.display_templates, eventtime)
+            if self.show_data_group.show(self, self.display_templates,
+                                         eventtime):
+                self.lcd_chip.flush()
         except:
             logging.exception("Error during display screen update")
-        self.lcd_chip.flush()
+            self.show_data_group.invalidate()
+            self.lcd_chip.flush()
         return eventtime + REDRAW_TIME
     def request_redraw(self):
         if self.redraw_request_pending:
@@ -247,6 +370,7 @@ class PrinterLCD:
         if new_dg is None:
             raise gcmd.error("""{"code":"key220", "msg":"Unknown display_data group '%s'", "values": ["%s"]}""" % (group,group))
         self.show_data_group = new_dg
+        new_dg.invalidate()
 
 def load_config(config):
     return PrinterLCD(config)
@@ -3,20 +3,64 @@
 # Copyright (C) 2018-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import traceback, logging, ast, copy
-import jinja2
+import traceback, logging, ast, copy, hashlib
 
 
 ######################################################################
 # Template handling
 ######################################################################
 
+# Read-only containers used for status snapshots.  A frozen snapshot
+# may be shared between template renders as it can not be modified.
+class FrozenStatusDict(dict):
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Printer status is read-only")
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+    def __copy__(self):
+        return self
+    def __deepcopy__(self, memo):
+        return self
+
+class FrozenStatusList(list):
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Printer status is read-only")
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = _read_only
+    __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = reverse = sort = _read_only
+    def __copy__(self):
+        return self
+    def __deepcopy__(self, memo):
+        return self
+
+IMMUTABLE_TYPES = (str, unicode, int, long, float, bool, type(None))
+
+# Return a read-only copy of a get_status() result
+def freeze_status(value):
+    if isinstance(value, IMMUTABLE_TYPES + (FrozenStatusDict,
+                                            FrozenStatusList)):
+        return value
+    if isinstance(value, dict):
+        return FrozenStatusDict([(k, freeze_status(v))
+                                 for k, v in value.items()])
+    if isinstance(value, list):
+        return FrozenStatusList([freeze_status(v) for v in value])
+    if isinstance(value, tuple):
+        for v in value:
+            if not isinstance(v, IMMUTABLE_TYPES):
+                return tuple([freeze_status(v) for v in value])
+        return value
+    return copy.deepcopy(value)
+
 # Wrapper for access to printer object get_status() methods
 class GetStatusWrapper:
-    def __init__(self, printer, eventtime=None):
+    def __init__(self, printer, eventtime=None, snapshots=None):
         self.printer = printer
         self.eventtime = eventtime
         self.cache = {}
+        if snapshots is None:
+            snapshots = {}
+        self.snapshots = snapshots
     def __getitem__(self, val):
         sval = str(val).strip()
         if sval in self.cache:
@@ -26,7 +70,19 @@ class GetStatusWrapper:
             raise KeyError(val)
         if self.eventtime is None:
             self.eventtime = self.printer.get_reactor().monotonic()
-        self.cache[sval] = res = copy.deepcopy(po.get_status(self.eventtime))
+        # Objects reporting a status version only need a new snapshot
+        # when that version changes; others are snapshot per eventtime
+        if hasattr(po, 'get_status_version'):
+            version = ('version', po.get_status_version())
+        else:
+            version = ('eventtime', self.eventtime)
+        snapshot = self.snapshots.get(sval)
+        if snapshot is not None and snapshot[0] == version:
+            res = snapshot[1]
+        else:
+            res = freeze_status(po.get_status(self.eventtime))
+            self.snapshots[sval] = (version, res)
+        self.cache[sval] = res
         return res
     def __contains__(self, val):
         try:
@@ -41,14 +97,17 @@ class GetStatusWrapper:
 
 # Wrapper around a Jinja2 template
 class TemplateWrapper:
-    def __init__(self, printer, env, name, script):
+    def __init__(self, printer, name, script):
         self.printer = printer
         self.name = name
         self.gcode = self.printer.lookup_object('gcode')
         gcode_macro = self.printer.lookup_object('gcode_macro')
         self.create_template_context = gcode_macro.create_template_context
+        self.compile_template = gcode_macro.compile_template
+        # Syntax errors are reported at config load, but the template
+        # is only compiled on first use
         try:
-            self.template = env.from_string(script)
+            gcode_macro.parse_template(script)
         except Exception as e:
             # msg = "Error loading template '%s': %s" % (
             #      name, traceback.format_exception_only(type(e), e)[-1])
@@ -57,7 +116,22 @@ class TemplateWrapper:
             )
             logging.exception(msg)
             raise printer.config_error(msg)
+        self.script = script
+        self.template = None
+    def _load_template(self):
+        try:
+            self.template = self.compile_template(self.script)
+        except Exception as e:
+            # msg = "Error loading template '%s': %s" % (
+            #      name, traceback.format_exception_only(type(e), e)[-1])
+            msg = """{"code":"key164", "msg": "Error loading template '%s': %s", "values": ["%s", "%s"]}""" % (
+                self.name, traceback.format_exception_only(type(e), e)[-1], self.name, traceback.format_exception_only(type(e), e)[-1]
+            )
+            logging.exception(msg)
+            raise self.gcode.error(msg)
     def render(self, context=None):
+        if self.template is None:
+            self._load_template()
         if context is None:
             context = self.create_template_context()
         try:
@@ -78,14 +152,77 @@ class TemplateWrapper:
 class PrinterGCodeMacro:
     def __init__(self, config):
         self.printer = config.get_printer()
+        # The jinja2 environment is created when the first template is
+        # compiled (avoids importing jinja2 at startup)
+        self.env = self.bytecode_cache = None
+        self.status_snapshots = {}
+        self.template_count = self.compile_count = self.cache_hits = 0
+        self.parse_time = self.compile_time = 0.
+        self.printer.register_event_handler("klippy:ready",
+                                            self._handle_ready)
+        self.printer.register_event_handler("klippy:disconnect",
+                                            self._handle_disconnect)
+    def _handle_ready(self):
+        logging.info("gcode_macro: %d templates checked in %.3fs",
+                     self.template_count, self.parse_time)
+    def _handle_disconnect(self):
+        logging.info("gcode_macro: %d of %d templates compiled"
+                     " (%d from cache) in %.3fs",
+                     self.compile_count, self.template_count,
+                     self.cache_hits, self.compile_time)
+    def _setup_env(self):
+        import jinja2, jinja2.bccache
         self.env = jinja2.Environment('{%', '%}', '{', '}')
+        # On disk cache of compiled templates (keyed by template source)
+        try:
+            self.bytecode_cache = jinja2.bccache.FileSystemBytecodeCache()
+        except Exception:
+            logging.exception("Unable to create template bytecode cache")
+    def parse_template(self, script):
+        reactor = self.printer.get_reactor()
+        start_time = reactor.monotonic()
+        if self.env is None:
+            self._setup_env()
+        self.env.parse(script)
+        self.parse_time += reactor.monotonic() - start_time
+    def compile_template(self, script):
+        reactor = self.printer.get_reactor()
+        start_time = reactor.monotonic()
+        if self.env is None:
+            self._setup_env()
+        bcc = self.bytecode_cache
+        bucket = code = None
+        if bcc is not None:
+            key = hashlib.sha1(script.encode('utf-8')).hexdigest()
+            try:
+                bucket = bcc.get_bucket(self.env, key, None, script)
+                code = bucket.code
+            except Exception:
+                logging.exception("Unable to read template bytecode cache")
+        if code is None:
+            code = self.env.compile(script)
+            if bucket is not None:
+                bucket.code = code
+                try:
+                    bcc.set_bucket(bucket)
+                except Exception:
+                    logging.exception("Unable to write template bytecode"
+                                      " cache")
+        else:
+            self.cache_hits += 1
+        template = self.env.template_class.from_code(
+            self.env, code, self.env.make_globals(None))
+        self.compile_count += 1
+        self.compile_time += reactor.monotonic() - start_time
+        return template
     def load_template(self, config, option, default=None):
         name = "%s:%s" % (config.get_name(), option)
         if default is None:
             script = config.get(option)
         else:
             script = config.get(option, default)
-        return TemplateWrapper(self.printer, self.env, name, script)
+        self.template_count += 1
+        return TemplateWrapper(self.printer, name, script)
     def _action_emergency_stop(self, msg="action_emergency_stop"):
         self.printer.invoke_shutdown("""{"code":"key170", "msg": "Shutdown due to %s", "values": ["%s"]}""" % (msg, msg))
         return ""
@@ -103,7 +240,8 @@ class PrinterGCodeMacro:
         return ""
     def create_template_context(self, eventtime=None):
         return {
-            'printer': GetStatusWrapper(self.printer, eventtime),
+            'printer': GetStatusWrapper(self.printer, eventtime,
+                                        self.status_snapshots),
             'action_emergency_stop': self._action_emergency_stop,
             'action_respond_info': self._action_respond_info,
             'action_raise_error': self._action_raise_error,
@@ -152,6 +290,7 @@ class GCodeMacro:
                                         name, self.cmd_SET_GCODE_VARIABLE,
                                         desc=self.cmd_SET_GCODE_VARIABLE_help)
         self.in_script = False
+        self.status_version = 0
         self.variables = {}
         prefix = 'variable_'
         for option in config.get_prefix_options(prefix):
@@ -175,6 +314,8 @@ class GCodeMacro:
         self.gcode.register_command(self.alias, self.cmd, desc=self.cmd_desc)
     def get_status(self, eventtime):
         return self.variables
+    def get_status_version(self):
+        return self.status_version
     cmd_SET_GCODE_VARIABLE_help = "Set the value of a G-Code macro variable"
     def cmd_SET_GCODE_VARIABLE(self, gcmd):
         variable = gcmd.get('VARIABLE')
@@ -188,6 +329,7 @@ class GCodeMacro:
         v = dict(self.variables)
         v[variable] = literal
         self.variables = v
+        self.status_version += 1
     def cmd(self, gcmd):
         if self.in_script:
             # raise gcmd.error("Macro %s called recursively" % (self.alias,))
@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, logging, threading
+import os, logging, threading, array
 
 
 ######################################################################
@@ -14,6 +14,7 @@ KELVIN_TO_CELSIUS = -273.15
 MAX_HEAT_TIME = 5.0
 AMBIENT_TEMP = 25.
 PID_PARAM_BASE = 255.
+PWM_STEPS = 255.
 
 class Heater:
     def __init__(self, config, sensor):
@@ -25,6 +26,8 @@ class Heater:
         self.max_temp = config.getfloat('max_temp', above=self.min_temp)
         self.sensor.setup_minmax(self.min_temp, self.max_temp)
         self.sensor.setup_callback(self.temperature_callback)
+        pheaters = self.printer.lookup_object('heaters')
+        self.control_engine = pheaters.get_control_engine()
         self.pwm_delay = self.sensor.get_report_time_delta()
         # Setup temperature checks
         self.min_extrude_temp = config.getfloat(
@@ -42,8 +45,15 @@ class Heater:
         # pwm caching
         self.next_pwm_time = 0.
         self.last_pwm_value = 0.
+        # Control loop timing statistics
+        self.reactor = self.printer.get_reactor()
+        self.sample_count = self.pwm_update_count = self.pwm_skip_count = 0
+        self.update_time = self.max_update_time = 0.
+        self.max_sample_interval = self.max_queue_time = 0.
+        self.control_stats = {}
         # Setup control algorithm sub-class
-        algos = {'watermark': ControlBangBang, 'pid': ControlPID}
+        algos = {'watermark': ControlBangBang, 'pid': ControlPID,
+                 'mpc': ControlMPC}
         algo = config.getchoice('control', algos)
         self.control = algo(self, config)
         # Setup output heater pin
@@ -57,6 +67,7 @@ class Heater:
         # Load additional modules
         self.printer.load_object(config, "verify_heater %s" % (self.name,))
         self.printer.load_object(config, "pid_calibrate")
+        self.printer.load_object(config, "mpc_calibrate")
         gcode = self.printer.lookup_object("gcode")
         gcode.register_mux_command("SET_HEATER_TEMPERATURE", "HEATER",
                                    self.name, self.cmd_SET_HEATER_TEMPERATURE,
@@ -64,10 +75,15 @@ class Heater:
     def set_pwm(self, read_time, value):
         if self.target_temp <= 0.:
             value = 0.
-        if ((read_time < self.next_pwm_time or not self.last_pwm_value)
-            and abs(value - self.last_pwm_value) < 0.05):
-            # No significant change in value - can suppress update
+        # Quantize the output so that updates that do not change it are
+        # coalesced until the max duration refresh
+        value = int(max(0., min(1., value)) * PWM_STEPS + .5) / PWM_STEPS
+        if value == self.last_pwm_value and (read_time < self.next_pwm_time
+                                             or not value):
+            # No change in output - can suppress update
+            self.pwm_skip_count += 1
             return
+        self.pwm_update_count += 1
         pwm_time = read_time + self.pwm_delay
         self.next_pwm_time = pwm_time + 0.75 * MAX_HEAT_TIME
         self.last_pwm_value = value
@@ -76,6 +92,10 @@ class Heater:
         #              self.name, value, pwm_time,
         #              self.last_temp, self.last_temp_time, self.target_temp)
     def temperature_callback(self, read_time, temp):
+        self.control_engine.queue_sample(self, read_time, temp)
+    def update_temperature(self, read_time, temp, queue_time):
+        # Process a sample (called from the control engine)
+        start_time = self.reactor.monotonic()
         with self.lock:
             time_diff = read_time - self.last_temp_time
             self.last_temp = temp
@@ -85,6 +105,14 @@ class Heater:
             adj_time = min(time_diff * self.inv_smooth_time, 1.)
             self.smoothed_temp += temp_diff * adj_time
             self.can_extrude = (self.smoothed_temp >= self.min_extrude_temp)
+            # Note timing statistics
+            if self.sample_count and time_diff > self.max_sample_interval:
+                self.max_sample_interval = time_diff
+            self.sample_count += 1
+            self.max_queue_time = max(self.max_queue_time, queue_time)
+            update_time = self.reactor.monotonic() - start_time
+            self.update_time += update_time
+            self.max_update_time = max(self.max_update_time, update_time)
         #logging.debug("temp: %.3f %f = %f", read_time, temp)
     # External commands
     def get_pwm_delay(self):
@@ -120,11 +148,23 @@ class Heater:
         if target_temp:
             target_temp = max(self.min_temp, min(self.max_temp, target_temp))
         self.target_temp = target_temp
+    def _update_control_stats(self):
+        # Summarize control loop timing (called with self.lock held)
+        count = self.sample_count
+        self.control_stats = {
+            'samples': count,
+            'pwm_updates': self.pwm_update_count,
+            'pwm_suppressed': self.pwm_skip_count,
+            'avg_update_time': self.update_time / max(count, 1),
+            'max_update_time': self.max_update_time,
+            'max_sample_interval': self.max_sample_interval,
+            'max_queue_time': self.max_queue_time}
     def stats(self, eventtime):
         with self.lock:
             target_temp = self.target_temp
             last_temp = self.last_temp
             last_pwm_value = self.last_pwm_value
+            self._update_control_stats()
         is_active = target_temp or last_temp > 50.
         return is_active, '%s: target=%.0f temp=%.1f pwm=%.3f' % (
             self.name, target_temp, last_temp, last_pwm_value)
@@ -133,8 +173,9 @@ class Heater:
             target_temp = self.target_temp
             smoothed_temp = self.smoothed_temp
             last_pwm_value = self.last_pwm_value
+            control_stats = self.control_stats
         return {'temperature': round(smoothed_temp, 2), 'target': target_temp,
-                'power': last_pwm_value}
+                'power': last_pwm_value, 'control_stats': control_stats}
     cmd_SET_HEATER_TEMPERATURE_help = "Sets a heater temperature"
     def cmd_SET_HEATER_TEMPERATURE(self, gcmd):
         temp = gcmd.get_float('TARGET', 0.)
@@ -174,48 +215,169 @@ PID_SETTLE_SLOPE = .1
 
 class ControlPID:
     def __init__(self, heater, config):
+        self.heater = heater
+        heater_max_power = heater.get_max_power()
+        Kp = config.getfloat('pid_Kp') / PID_PARAM_BASE
+        Ki = config.getfloat('pid_Ki') / PID_PARAM_BASE
+        Kd = config.getfloat('pid_Kd') / PID_PARAM_BASE
+        # The controller state is kept by the shared control engine
+        self.engine = heater.control_engine
+        self.slot = self.engine.add_pid(Kp, Ki, Kd, heater.get_smooth_time(),
+                                        heater_max_power)
+    def temperature_update(self, read_time, temp, target_temp):
+        co = self.engine.pid_update(self.slot, read_time, temp, target_temp)
+        self.heater.set_pwm(read_time, co)
+    def check_busy(self, eventtime, smoothed_temp, target_temp):
+        temp_diff = target_temp - smoothed_temp
+        return (abs(temp_diff) > PID_SETTLE_DELTA
+                or abs(self.engine.pid_prev_deriv[self.slot])
+                > PID_SETTLE_SLOPE)
+
+
+######################################################################
+# Model predictive control (MPC) algo
+######################################################################
+
+MPC_MAX_MODEL_GAP = 5.
+
+class ControlMPC:
+    def __init__(self, heater, config):
+        self.printer = config.get_printer()
         self.heater = heater
         self.heater_max_power = heater.get_max_power()
-        self.Kp = config.getfloat('pid_Kp') / PID_PARAM_BASE
-        self.Ki = config.getfloat('pid_Ki') / PID_PARAM_BASE
-        self.Kd = config.getfloat('pid_Kd') / PID_PARAM_BASE
-        self.min_deriv_time = heater.get_smooth_time()
-        self.temp_integ_max = 0.
-        if self.Ki:
-            self.temp_integ_max = self.heater_max_power / self.Ki
-        self.prev_temp = AMBIENT_TEMP
+        # Thermal model parameters
+        self.heater_power = config.getfloat('heater_power', above=0.)
+        self.block_heat_capacity = config.getfloat('block_heat_capacity',
+                                                   above=0.)
+        self.ambient_transfer = config.getfloat('ambient_transfer', minval=0.)
+        self.fan_ambient_transfer = config.getfloat('fan_ambient_transfer',
+                                                    0., minval=0.)
+        self.ambient_temp = config.getfloat('ambient_temp', AMBIENT_TEMP)
+        self.target_reach_time = config.getfloat('target_reach_time', 2.,
+                                                 above=0.)
+        self.smoothing = config.getfloat('smoothing', .5, above=0.,
+                                         maxval=1.)
+        # Optional part cooling fan feed-forward
+        self.fan_name = config.get('cooling_fan', None)
+        self.fan = None
+        if self.fan_name is not None:
+            self.printer.register_event_handler("klippy:connect",
+                                                self._handle_connect)
+        # Model state
+        self.model_temp = None
+        self.model_deriv = 0.
         self.prev_temp_time = 0.
-        self.prev_temp_deriv = 0.
-        self.prev_temp_integ = 0.
+        self.last_power = 0.
+    def _handle_connect(self):
+        self.fan = self.printer.lookup_object(self.fan_name)
+    def _get_transfer(self, read_time):
+        transfer = self.ambient_transfer
+        if self.fan is not None and self.fan_ambient_transfer:
+            fan_speed = self.fan.get_status(read_time)['speed']
+            transfer += self.fan_ambient_transfer * fan_speed
+        return transfer
     def temperature_update(self, read_time, temp, target_temp):
         time_diff = read_time - self.prev_temp_time
+        self.prev_temp_time = read_time
+        transfer = self._get_transfer(read_time)
+        # Advance the thermal model and correct it towards the sensor
+        if (self.model_temp is None or time_diff <= 0.
+            or time_diff > MPC_MAX_MODEL_GAP):
+            self.model_temp = temp
+            self.model_deriv = 0.
+        else:
+            loss = transfer * (self.model_temp - self.ambient_temp)
+            self.model_deriv = ((self.last_power - loss)
+                                / self.block_heat_capacity)
+            self.model_temp += self.model_deriv * time_diff
+            adj = 1. - (1. - self.smoothing) ** time_diff
+            self.model_temp += (temp - self.model_temp) * adj
+        # Power needed to reach target in target_reach_time and hold it
+        power = 0.
+        if target_temp > 0.:
+            power = (self.block_heat_capacity * (target_temp - self.model_temp)
+                     / self.target_reach_time
+                     + transfer * (target_temp - self.ambient_temp))
+        co = max(0., min(self.heater_max_power, power / self.heater_power))
+        self.last_power = co * self.heater_power
+        self.heater.set_pwm(read_time, co)
+    def check_busy(self, eventtime, smoothed_temp, target_temp):
+        temp_diff = target_temp - smoothed_temp
+        return (abs(temp_diff) > PID_SETTLE_DELTA
+                or abs(self.model_deriv) > PID_SETTLE_SLOPE)
+
+
+######################################################################
+# Heater control engine
+######################################################################
+
+# Temperature samples of all heaters are queued by the sensor callbacks
+# and processed together once per reactor tick
+class HeaterControlEngine:
+    def __init__(self, printer):
+        self.reactor = printer.get_reactor()
+        self.lock = threading.Lock()
+        self.samples = []
+        # PID controller state (one slot per PID controlled heater)
+        self.pid_params = []
+        self.pid_prev_temp = array.array('d')
+        self.pid_prev_time = array.array('d')
+        self.pid_prev_deriv = array.array('d')
+        self.pid_prev_integ = array.array('d')
+    def queue_sample(self, heater, read_time, temp):
+        # May be called from the serial reader thread
+        queue_time = self.reactor.monotonic()
+        with self.lock:
+            self.samples.append((heater, read_time, temp, queue_time))
+            if len(self.samples) > 1:
+                # An update is already scheduled
+                return
+        self.reactor.register_async_callback(self._process_samples)
+    def _process_samples(self, eventtime):
+        with self.lock:
+            samples = self.samples
+            self.samples = []
+        for heater, read_time, temp, queue_time in samples:
+            heater.update_temperature(read_time, temp, eventtime - queue_time)
+    # PID control
+    def add_pid(self, Kp, Ki, Kd, min_deriv_time, max_power):
+        temp_integ_max = 0.
+        if Ki:
+            temp_integ_max = max_power / Ki
+        self.pid_params.append((Kp, Ki, Kd, min_deriv_time, temp_integ_max,
+                                max_power))
+        self.pid_prev_temp.append(AMBIENT_TEMP)
+        self.pid_prev_time.append(0.)
+        self.pid_prev_deriv.append(0.)
+        self.pid_prev_integ.append(0.)
+        return len(self.pid_params) - 1
+    def pid_update(self, slot, read_time, temp, target_temp):
+        Kp, Ki, Kd, min_deriv_time, temp_integ_max, max_power = (
+            self.pid_params[slot])
+        time_diff = read_time - self.pid_prev_time[slot]
         # Calculate change of temperature
-        temp_diff = temp - self.prev_temp
-        if time_diff >= self.min_deriv_time:
+        temp_diff = temp - self.pid_prev_temp[slot]
+        if time_diff >= min_deriv_time:
             temp_deriv = temp_diff / time_diff
         else:
-            temp_deriv = (self.prev_temp_deriv * (self.min_deriv_time-time_diff)
-                          + temp_diff) / self.min_deriv_time
+            temp_deriv = (self.pid_prev_deriv[slot] * (min_deriv_time-time_diff)
+                          + temp_diff) / min_deriv_time
         # Calculate accumulated temperature "error"
         temp_err = target_temp - temp
-        temp_integ = self.prev_temp_integ + temp_err * time_diff
-        temp_integ = max(0., min(self.temp_integ_max, temp_integ))
+        temp_integ = self.pid_prev_integ[slot] + temp_err * time_diff
+        temp_integ = max(0., min(temp_integ_max, temp_integ))
         # Calculate output
-        co = self.Kp*temp_err + self.Ki*temp_integ - self.Kd*temp_deriv
+        co = Kp*temp_err + Ki*temp_integ - Kd*temp_deriv
         #logging.debug("pid: %f@%.3f -> diff=%f deriv=%f err=%f integ=%f co=%d",
         #    temp, read_time, temp_diff, temp_deriv, temp_err, temp_integ, co)
-        bounded_co = max(0., min(self.heater_max_power, co))
-        self.heater.set_pwm(read_time, bounded_co)
+        bounded_co = max(0., min(max_power, co))
         # Store state for next measurement
-        self.prev_temp = temp
-        self.prev_temp_time = read_time
-        self.prev_temp_deriv = temp_deriv
+        self.pid_prev_temp[slot] = temp
+        self.pid_prev_time[slot] = read_time
+        self.pid_prev_deriv[slot] = temp_deriv
         if co == bounded_co:
-            self.prev_temp_integ = temp_integ
-    def check_busy(self, eventtime, smoothed_temp, target_temp):
-        temp_diff = target_temp - smoothed_temp
-        return (abs(temp_diff) > PID_SETTLE_DELTA
-                or abs(self.prev_temp_deriv) > PID_SETTLE_SLOPE)
+            self.pid_prev_integ[slot] = temp_integ
+        return bounded_co
 
 
 ######################################################################
@@ -231,6 +393,7 @@ class PrinterHeaters:
         self.available_heaters = []
         self.available_sensors = []
         self.has_started = self.have_load_sensors = False
+        self.control_engine = HeaterControlEngine(self.printer)
         self.printer.register_event_handler("klippy:ready", self._handle_ready)
         self.printer.register_event_handler("gcode:request_restart",
                                             self.turn_off_all_heaters)
@@ -266,6 +429,8 @@ class PrinterHeaters:
         self.register_sensor(config, heater, gcode_id)
         self.available_heaters.append(config.get_name())
         return heater
+    def get_control_engine(self):
+        return self.control_engine
     def get_all_heaters(self):
         return self.available_heaters
     def lookup_heater(self, heater_name):
@@ -4,6 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging, math
+import mcu
 
 HOMING_START_DELAY = 0.001
 ENDSTOP_SAMPLE_TIME = .000015
@@ -42,6 +43,7 @@ class HomingMove:
             toolhead = printer.lookup_object('toolhead')
         self.toolhead = toolhead
         self.stepper_positions = []
+        self.phase_times = {}
     def get_mcu_endstops(self):
         return [es for es, name in self.endstops]
     def _calc_endstop_rate(self, mcu_endstop, movepos, speed):
@@ -64,8 +66,34 @@ class HomingMove:
             kin_spos[sname] += offsets.get(sname, 0) * stepper.get_step_dist()
         thpos = self.toolhead.get_position()
         return list(kin.calc_position(kin_spos))[:3] + thpos[3:]
+    def _wait_endstops(self, move_end_print_time):
+        # Wait for all endstops and then gather the trsync, stepper, and
+        # endstop state with one round-trip per phase on each mcu
+        batches = mcu.MCUQueryBatches(self.printer)
+        pending = []
+        for mcu_endstop, name in self.endstops:
+            home_wait_batch = getattr(mcu_endstop, 'home_wait_batch', None)
+            if home_wait_batch is None:
+                # Endstop without batch support - wait for it directly
+                tt = mcu_endstop.home_wait(move_end_print_time)
+                note_stopped = (lambda b, tt=tt: (lambda: tt))
+            else:
+                note_stopped = home_wait_batch(move_end_print_time, batches)
+            pending.append((name, note_stopped))
+        reactor = self.printer.get_reactor()
+        query_start = reactor.monotonic()
+        self.phase_times['move'] = query_start - self.phase_times['move']
+        batches.send()
+        pending = [(name, note_stopped(batches))
+                   for name, note_stopped in pending]
+        batches.send()
+        trigger_times = [(name, get_trigger_time())
+                         for name, get_trigger_time in pending]
+        self.phase_times['query'] = reactor.monotonic() - query_start
+        return trigger_times
     def homing_move(self, movepos, speed, probe_pos=False,
                     triggered=True, check_triggered=True):
+        self.phase_times = {'move': self.printer.get_reactor().monotonic()}
         # Notify start of homing/probing move
         self.printer.send_event("homing:homing_move_begin", self)
         # Note start location
@@ -96,8 +124,7 @@ class HomingMove:
         # Wait for endstops to trigger
         trigger_times = {}
         move_end_print_time = self.toolhead.get_last_move_time()
-        for mcu_endstop, name in self.endstops:
-            trigger_time = mcu_endstop.home_wait(move_end_print_time)
+        for name, trigger_time in self._wait_endstops(move_end_print_time):
             if trigger_time > 0.:
                 trigger_times[name] = trigger_time
             elif trigger_time < 0. and error is None:
@@ -152,6 +179,7 @@ class Homing:
         self.changed_axes = []
         self.trigger_mcu_pos = {}
         self.adjust_pos = {}
+        self.phase_times = {}
     def set_axes(self, axes):
         self.changed_axes = axes
     def get_axes(self):
@@ -160,6 +188,11 @@ class Homing:
         return self.trigger_mcu_pos[stepper_name]
     def set_stepper_adjustment(self, stepper_name, adjustment):
         self.adjust_pos[stepper_name] = adjustment
+    def get_phase_times(self):
+        return dict(self.phase_times)
+    def _note_phase_times(self, prefix, phase_times):
+        for phase, phase_time in phase_times.items():
+            self.phase_times[prefix + phase] = round(phase_time, 6)
     def _fill_coord(self, coord):
         # Fill in any None entries in 'coord' with current toolhead position
         thcoord = list(self.toolhead.get_position())
@@ -182,6 +215,8 @@ class Homing:
         hi = rails[0].get_homing_info()
         hmove = HomingMove(self.printer, endstops)
         hmove.homing_move(homepos, hi.speed)
+        rail_name = rails[0].get_name()
+        self._note_phase_times(rail_name + ":first_", hmove.phase_times)
         # Perform second home
         if hi.retract_dist:
             # Retract
@@ -199,11 +234,14 @@ class Homing:
             self.toolhead.set_position(startpos)
             hmove = HomingMove(self.printer, endstops)
             hmove.homing_move(homepos, hi.second_homing_speed)
+            self._note_phase_times(rail_name + ":second_", hmove.phase_times)
             if hmove.check_no_movement() is not None:
                 raise self.printer.command_error(
                     """{"code":"key23", "msg":"Endstop %s still triggered after retract", "values": ["%s"]}"""
                     % (hmove.check_no_movement(), hmove.check_no_movement()))
         # Signal home operation complete
+        reactor = self.printer.get_reactor()
+        finish_start = reactor.monotonic()
         self.toolhead.flush_step_generation()
         self.trigger_mcu_pos = {sp.stepper_name: sp.trig_pos
                                 for sp in hmove.stepper_positions}
@@ -220,13 +258,18 @@ class Homing:
             for axis in homing_axes:
                 homepos[axis] = newpos[axis]
             self.toolhead.set_position(homepos)
+        self._note_phase_times(rail_name + ":", {
+            'finish': reactor.monotonic() - finish_start})
 
 class PrinterHoming:
     def __init__(self, config):
         self.printer = config.get_printer()
+        self.phase_times = {}
         # Register g-code commands
         gcode = self.printer.lookup_object('gcode')
         gcode.register_command('G28', self.cmd_G28)
+    def get_status(self, eventtime):
+        return {'phase_times': self.phase_times}
     def manual_home(self, toolhead, endstops, pos, speed,
                     triggered, check_triggered):
         hmove = HomingMove(self.printer, endstops, toolhead)
@@ -271,6 +314,10 @@ class PrinterHoming:
                     '{"code": "key4", "msg": "Homing failed due to printer shutdown"}')
             self.printer.lookup_object('stepper_enable').motor_off()
             raise
+        finally:
+            self.phase_times = homing_state.get_phase_times()
+        logging.info("Homing phase times: %s", " ".join(
+            ["%s=%.3f" % (k, v) for k, v in sorted(self.phase_times.items())]))
 
 def load_config(config):
     return PrinterHoming(config)
@@ -0,0 +1,92 @@
+# Shared SET_LED handling and batched transmission of LED updates
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+class LEDHelper:
+    def __init__(self, config, update_func, send_func, led_count=1,
+                 has_white=False):
+        self.printer = config.get_printer()
+        self.mutex = self.printer.get_reactor().mutex()
+        self.update_func = update_func
+        self.send_func = send_func
+        self.led_count = led_count
+        self.has_white = has_white
+        max_rate = config.getfloat('max_update_rate', 25., above=0.)
+        self.min_frame_time = 1. / max_rate
+        self.next_frame_time = 0.
+        self.pled = self.printer.load_object(config, 'led')
+        # Register commands
+        name = config.get_name().split()[-1]
+        gcode = self.printer.lookup_object('gcode')
+        gcode.register_mux_command("SET_LED", "LED", name, self.cmd_SET_LED,
+                                   desc=self.cmd_SET_LED_help)
+    def transmit(self, eventtime, print_time):
+        with self.mutex:
+            self.next_frame_time = eventtime + self.min_frame_time
+            self.send_func(print_time)
+    cmd_SET_LED_help = "Set the color of an LED"
+    def cmd_SET_LED(self, gcmd):
+        # Parse parameters
+        red = gcmd.get_float('RED', 0., minval=0., maxval=1.)
+        green = gcmd.get_float('GREEN', 0., minval=0., maxval=1.)
+        blue = gcmd.get_float('BLUE', 0., minval=0., maxval=1.)
+        white = 0.
+        if self.has_white:
+            white = gcmd.get_float('WHITE', 0., minval=0., maxval=1.)
+        index = gcmd.get_int('INDEX', None, minval=1, maxval=self.led_count)
+        transmit = gcmd.get_int('TRANSMIT', 1)
+        sync = gcmd.get_int('SYNC', 1)
+        # Update color data and queue a (batched) transmit
+        def reactor_bgfunc(print_time):
+            with self.mutex:
+                self.update_func(red, green, blue, white, index)
+            if transmit:
+                self.pled.request_transmit(self, print_time)
+        def lookahead_bgfunc(print_time):
+            reactor = self.printer.get_reactor()
+            reactor.register_callback(lambda et: reactor_bgfunc(print_time))
+        if sync:
+            #Sync LED Update with print time and send
+            toolhead = self.printer.lookup_object('toolhead')
+            toolhead.register_lookahead_callback(lookahead_bgfunc)
+        else:
+            #Send update now (so as not to wake toolhead and reset idle_timeout)
+            lookahead_bgfunc(None)
+
+# Coalesce pending LED updates so that a burst of SET_LED commands
+# results in a single transmission per chain (at most one per frame)
+class PrinterLED:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.pending = {}
+        self.flush_timer = self.reactor.register_timer(self._flush_event)
+        self.next_flush = self.reactor.NEVER
+    def _schedule(self, waketime):
+        if waketime < self.next_flush:
+            self.next_flush = waketime
+            self.reactor.update_timer(self.flush_timer, waketime)
+    def request_transmit(self, helper, print_time):
+        if helper in self.pending:
+            # Merge with the update already waiting for this chain
+            prev_time = self.pending[helper]
+            if prev_time is not None and print_time is not None:
+                print_time = max(prev_time, print_time)
+        self.pending[helper] = print_time
+        eventtime = self.reactor.monotonic()
+        self._schedule(max(eventtime, helper.next_frame_time))
+    def _flush_event(self, eventtime):
+        next_flush = self.reactor.NEVER
+        for helper, print_time in list(self.pending.items()):
+            if helper.next_frame_time <= eventtime:
+                del self.pending[helper]
+                helper.transmit(eventtime, print_time)
+        # Frame rate limit - keep accumulating changes until the next frame
+        # (transmits may block, so check for requests added meanwhile)
+        for helper in self.pending:
+            next_flush = min(next_flush, helper.next_frame_time)
+        self.next_flush = next_flush
+        return next_flush
+
+def load_config(config):
+    return PrinterLED(config)
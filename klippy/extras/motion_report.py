@@ -3,7 +3,7 @@
 # Copyright (C) 2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging
+import logging, collections, array, base64, sys, json
 import chelper
 
 API_UPDATE_INTERVAL = 0.500
@@ -11,7 +11,7 @@ API_UPDATE_INTERVAL = 0.500
 # Helper to periodically transmit data to a set of API clients
 class APIDumpHelper:
     def __init__(self, printer, data_cb, startstop_cb=None,
-                 update_interval=API_UPDATE_INTERVAL):
+                 update_interval=API_UPDATE_INTERVAL, history_size=0):
         self.printer = printer
         self.data_cb = data_cb
         if startstop_cb is None:
@@ -20,8 +20,12 @@ class APIDumpHelper:
         self.update_interval = update_interval
         self.update_timer = None
         self.clients = {}
+        # Recent messages that late joining clients may request
+        self.history = collections.deque(maxlen=history_size)
     def _stop(self):
         self.clients.clear()
+        # Messages from a previous session are not recent history
+        self.history.clear()
         if self.update_timer is None:
             return
         reactor = self.printer.get_reactor()
@@ -45,14 +49,29 @@ class APIDumpHelper:
         systime = reactor.monotonic()
         waketime = systime + self.update_interval
         self.update_timer = reactor.register_timer(self._update, waketime)
-    def add_client(self, web_request):
+    def add_client(self, web_request, format_cb=None, backfill=False):
         cconn = web_request.get_client_connection()
         template = web_request.get_dict('response_template', {})
-        self.clients[cconn] = template
+        self.clients[cconn] = (template, format_cb)
         self._start()
-    def add_internal_client(self):
-        cconn = InternalDumpClient()
-        self.clients[cconn] = {}
+        if backfill and self.history:
+            # Send the history after the response to the subscription
+            history = list(self.history)
+            reactor = self.printer.get_reactor()
+            reactor.register_callback(
+                (lambda e: self._send_history(cconn, template, format_cb,
+                                              history)))
+    def _send_history(self, cconn, template, format_cb, history):
+        if cconn.is_closed():
+            return
+        for msg in history:
+            if format_cb is not None:
+                msg = format_cb(msg)
+            self._send(cconn, template, msg, {})
+    def add_internal_client(self, cconn=None):
+        if cconn is None:
+            cconn = InternalDumpClient()
+        self.clients[cconn] = ({}, None)
         self._start()
         return cconn
     def _update(self, eventtime):
@@ -63,16 +82,42 @@ class APIDumpHelper:
             return self._stop()
         if not msg:
             return eventtime + self.update_interval
-        for cconn, template in list(self.clients.items()):
+        if self.history.maxlen:
+            self.history.append(msg)
+        # Each alternate message format is only generated (and json
+        # encoded) once per update
+        formatted = {None: msg}
+        encoded = {}
+        for cconn, (template, format_cb) in list(self.clients.items()):
             if cconn.is_closed():
                 del self.clients[cconn]
                 if not self.clients:
                     return self._stop()
                 continue
+            fmsg = formatted.get(format_cb)
+            if fmsg is None:
+                fmsg = formatted[format_cb] = format_cb(msg)
+            self._send(cconn, template, fmsg, encoded.setdefault(format_cb, {}))
+        return eventtime + self.update_interval
+    def _send(self, cconn, template, fmsg, encoded):
+        send_encoded = getattr(cconn, 'send_encoded', None)
+        if send_encoded is None:
             tmp = dict(template)
-            tmp['params'] = msg
+            tmp['params'] = fmsg
             cconn.send(tmp)
-        return eventtime + self.update_interval
+            return
+        # Splice the shared encoding of the params into the template
+        jparams = encoded.get('params')
+        if jparams is None:
+            jparams = encoded['params'] = json.dumps(fmsg,
+                                                     separators=(',', ':'))
+        tmp = dict(template)
+        tmp.pop('params', None)
+        jtmp = json.dumps(tmp, separators=(',', ':'))
+        sep = ','
+        if not tmp:
+            sep = ''
+        send_encoded(jtmp[:-1] + sep + '"params":' + jparams + '}')
 
 # An "internal webhooks" wrapper for using APIDumpHelper internally
 class InternalDumpClient:
@@ -126,26 +171,32 @@ class DumpStepper:
                        % (i, s.first_clock, s.start_position, s.interval,
                           s.step_count, s.add))
         logging.info('\n'.join(out))
-    def _api_update(self, eventtime):
-        data, cdata = self.get_step_queue(self.last_api_clock, 1<<63)
+    def get_api_data(self, start_clock):
+        data, cdata = self.get_step_queue(start_clock, 1<<63)
         if not data:
-            return {}
+            return None, data
         clock_to_print_time = self.mcu_stepper.get_mcu().clock_to_print_time
         first = data[0]
         first_clock = first.first_clock
         first_time = clock_to_print_time(first_clock)
-        self.last_api_clock = last_clock = data[-1].last_clock
+        last_clock = data[-1].last_clock
         last_time = clock_to_print_time(last_clock)
         mcu_pos = first.start_position
         start_position = self.mcu_stepper.mcu_to_commanded_position(mcu_pos)
         step_dist = self.mcu_stepper.get_step_dist()
         if self.mcu_stepper.is_dir_inverted():
             step_dist = -step_dist
-        d = [(s.interval, s.step_count, s.add) for s in data]
-        return {"data": d, "start_position": start_position,
+        return {"start_position": start_position,
                 "start_mcu_position": mcu_pos, "step_distance": step_dist,
                 "first_clock": first_clock, "first_step_time": first_time,
-                "last_clock": last_clock, "last_step_time": last_time}
+                "last_clock": last_clock, "last_step_time": last_time}, data
+    def _api_update(self, eventtime):
+        msg, data = self.get_api_data(self.last_api_clock)
+        if not data:
+            return {}
+        self.last_api_clock = msg['last_clock']
+        msg['data'] = [(s.interval, s.step_count, s.add) for s in data]
+        return msg
     def _add_api_client(self, web_request):
         self.api_dump.add_client(web_request)
         hdr = ('interval', 'count', 'add')
@@ -202,17 +253,21 @@ class DumpTrapQ:
                move.start_z + move.z_r * dist)
         velocity = move.start_v + move.accel * move_time
         return pos, velocity
-    def _api_update(self, eventtime):
-        qtime = self.last_api_msg[0] + min(self.last_api_msg[1], 0.100)
+    def get_api_moves(self, last_move):
+        # Return moves after last_move (a (print_time, move_t) tuple)
+        qtime = last_move[0] + min(last_move[1], 0.100)
         data, cdata = self.extract_trapq(qtime, NEVER_TIME)
+        if data and (data[0].print_time, data[0].move_t) == last_move:
+            data.pop(0)
+        return data
+    def _api_update(self, eventtime):
+        data = self.get_api_moves(self.last_api_msg)
+        if not data:
+            return {}
+        self.last_api_msg = (data[-1].print_time, data[-1].move_t)
         d = [(m.print_time, m.move_t, m.start_v, m.accel,
               (m.start_x, m.start_y, m.start_z), (m.x_r, m.y_r, m.z_r))
              for m in data]
-        if d and d[0] == self.last_api_msg:
-            d.pop(0)
-        if not d:
-            return {}
-        self.last_api_msg = d[-1]
         return {"data": d}
     def _add_api_client(self, web_request):
         self.api_dump.add_client(web_request)
@@ -220,6 +275,88 @@ class DumpTrapQ:
                'start_position', 'direction')
         web_request.send({'header': hdr})
 
+MOTION_HISTORY_SIZE = 20
+STEP_FIELDS = ('interval', 'count', 'add')
+TRAPQ_FIELDS = ('time', 'duration', 'start_velocity', 'acceleration',
+                'start_x', 'start_y', 'start_z', 'x_r', 'y_r', 'z_r')
+
+# Encode a column of values as base64 little-endian int32 or float64
+def _pack_column(typecode, values):
+    col = array.array(typecode, values)
+    if sys.byteorder != 'little':
+        col.byteswap()
+    return base64.b64encode(col.tostring()).decode()
+
+# Combined stream of all stepper queues and trapqs
+class DumpMotion:
+    def __init__(self, printer, steppers, trapqs):
+        self.printer = printer
+        self.steppers = steppers
+        self.trapqs = trapqs
+        self.last_clocks = {}
+        self.last_moves = {}
+        self.sequence = 0
+        self.api_dump = APIDumpHelper(printer, self._api_update,
+                                      history_size=MOTION_HISTORY_SIZE)
+        wh = self.printer.lookup_object('webhooks')
+        wh.register_endpoint("motion_report/dump_motion",
+                             self._add_api_client)
+    def _api_update(self, eventtime):
+        # Extract step and move data once for all clients (as columns)
+        steppers = {}
+        for name, dstepper in self.steppers.items():
+            info, data = dstepper.get_api_data(self.last_clocks.get(name, 0))
+            if not data:
+                continue
+            self.last_clocks[name] = info['last_clock']
+            info['interval'] = [s.interval for s in data]
+            info['count'] = [s.step_count for s in data]
+            info['add'] = [s.add for s in data]
+            steppers[name] = info
+        trapqs = {}
+        for name, dtrapq in self.trapqs.items():
+            data = dtrapq.get_api_moves(self.last_moves.get(name, (0., 0.)))
+            if not data:
+                continue
+            self.last_moves[name] = (data[-1].print_time, data[-1].move_t)
+            trapqs[name] = [
+                [m.print_time for m in data], [m.move_t for m in data],
+                [m.start_v for m in data], [m.accel for m in data],
+                [m.start_x for m in data], [m.start_y for m in data],
+                [m.start_z for m in data], [m.x_r for m in data],
+                [m.y_r for m in data], [m.z_r for m in data]]
+        if not steppers and not trapqs:
+            return {}
+        self.sequence += 1
+        return {"sequence": self.sequence, "steppers": steppers,
+                "trapq": trapqs}
+    def _format_json(self, msg):
+        trapqs = {name: dict(zip(TRAPQ_FIELDS, cols))
+                  for name, cols in msg['trapq'].items()}
+        return {"sequence": msg['sequence'], "steppers": msg['steppers'],
+                "trapq": trapqs}
+    def _format_binary(self, msg):
+        steppers = {}
+        for name, info in msg['steppers'].items():
+            info = dict(info)
+            for field in STEP_FIELDS:
+                info[field] = _pack_column('i', info[field])
+            steppers[name] = info
+        trapqs = {name: dict(zip(TRAPQ_FIELDS, [_pack_column('d', c)
+                                               for c in cols]))
+                  for name, cols in msg['trapq'].items()}
+        return {"sequence": msg['sequence'], "steppers": steppers,
+                "trapq": trapqs}
+    def _add_api_client(self, web_request):
+        formats = {'json': self._format_json, 'binary': self._format_binary}
+        fmt = web_request.get_str('format', 'binary')
+        if fmt not in formats:
+            raise web_request.error("Unknown format '%s'" % (fmt,))
+        backfill = web_request.get_int('history', 0)
+        self.api_dump.add_client(web_request, formats[fmt], backfill)
+        web_request.send({'format': fmt, 'step_fields': STEP_FIELDS,
+                          'trapq_fields': TRAPQ_FIELDS})
+
 STATUS_REFRESH_TIME = 0.250
 
 class PrinterMotionReport:
@@ -259,6 +396,9 @@ class PrinterMotionReport:
         # Populate 'trapq' and 'steppers' in get_status result
         self.last_status['steppers'] = list(sorted(self.steppers.keys()))
         self.last_status['trapq'] = list(sorted(self.trapqs.keys()))
+        # Combined stream of all motion data
+        self.dump_motion = DumpMotion(self.printer, self.steppers,
+                                      self.trapqs)
     # Shutdown handling
     def _dump_shutdown(self, eventtime):
         # Log stepper queue_steps on mcu that started shutdown (if any)
@@ -0,0 +1,269 @@
+# Identification of heater thermal models for MPC control
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import logging
+
+class MPCCalibrate:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        gcode = self.printer.lookup_object('gcode')
+        gcode.register_command('MPC_CALIBRATE', self.cmd_MPC_CALIBRATE,
+                               desc=self.cmd_MPC_CALIBRATE_help)
+    cmd_MPC_CALIBRATE_help = "Run MPC thermal model calibration test"
+    def cmd_MPC_CALIBRATE(self, gcmd):
+        heater_name = gcmd.get('HEATER')
+        target = gcmd.get_float('TARGET')
+        write_file = gcmd.get_int('WRITE_FILE', 0)
+        pheaters = self.printer.lookup_object('heaters')
+        try:
+            heater = pheaters.lookup_heater(heater_name)
+        except self.printer.config_error as e:
+            raise gcmd.error(str(e))
+        # Defaults from an existing mpc configuration (if any)
+        old_control = heater.control
+        heater_power = getattr(old_control, 'heater_power', None)
+        heater_power = gcmd.get_float('HEATER_POWER', heater_power, above=0.)
+        fan = getattr(old_control, 'fan', None)
+        fan_name = gcmd.get('FAN', getattr(old_control, 'fan_name', None))
+        if fan_name and fan is None:
+            fan = self.printer.lookup_object(fan_name, None)
+            if fan is None:
+                raise gcmd.error("Unknown fan '%s'" % (fan_name,))
+        self.printer.lookup_object('toolhead').get_last_move_time()
+        eventtime = self.printer.get_reactor().monotonic()
+        ambient_temp = gcmd.get_float('AMBIENT_TEMP',
+                                      heater.get_temp(eventtime)[0])
+        if target <= ambient_temp + MPC_MIN_RISE:
+            raise gcmd.error("Calibration target must be at least %.0f"
+                             " degrees above ambient" % (MPC_MIN_RISE,))
+        calibrate = ControlMPCAutoTune(heater, target, fan)
+        old_control = heater.set_control(calibrate)
+        try:
+            pheaters.set_temperature(heater, target, True)
+        except self.printer.command_error as e:
+            heater.set_control(old_control)
+            raise
+        heater.set_control(old_control)
+        if self.printer.get_start_args().get('debugoutput') is not None:
+            # No temperature reports in batch mode - nothing to fit
+            return
+        if write_file:
+            calibrate.write_file('/tmp/heattest.txt')
+        if calibrate.check_busy(0., 0., 0.):
+            raise gcmd.error("mpc_calibrate interrupted")
+        # Fit the model to the recorded samples
+        try:
+            model = fit_thermal_model(calibrate.get_samples(), heater_power,
+                                      ambient_temp)
+        except ValueError as e:
+            raise gcmd.error("MPC calibration failed: %s" % (str(e),))
+        logging.info("MPC autotune: %s", format_model(model))
+        msg = ("MPC parameters: %s\n"
+               "The SAVE_CONFIG command will update the printer config file\n"
+               "with these parameters and restart the printer."
+               % (format_model(model),))
+        if heater_power is None:
+            msg = ("HEATER_POWER not specified - model is relative to"
+                   " heater_power=1.0\n" + msg)
+        gcmd.respond_info(msg)
+        # Store results for SAVE_CONFIG
+        configfile = self.printer.lookup_object('configfile')
+        configfile.set(heater_name, 'control', 'mpc')
+        for name in ['heater_power', 'block_heat_capacity',
+                     'ambient_transfer', 'fan_ambient_transfer']:
+            if name in model:
+                configfile.set(heater_name, name, "%.4f" % (model[name],))
+        if fan_name:
+            configfile.set(heater_name, 'cooling_fan', fan_name)
+
+MPC_MIN_RISE = 20.
+MPC_COOL_FRACTION = .3
+MPC_COOL_TIME = 60.
+
+class ControlMPCAutoTune:
+    def __init__(self, heater, target, fan=None):
+        self.heater = heater
+        self.heater_max_power = heater.get_max_power()
+        self.calibrate_temp = target
+        self.fan = fan
+        # Test phases: heat at full power, then cool with the heater off
+        self.heating = True
+        self.start_temp = self.cool_temp = None
+        self.cool_start_time = 0.
+        self.done = False
+        # Sample recording
+        self.last_pwm = 0.
+        self.pwm_samples = []
+        self.temp_samples = []
+    # Heater control
+    def set_pwm(self, read_time, value):
+        if value != self.last_pwm:
+            self.pwm_samples.append(
+                (read_time + self.heater.get_pwm_delay(), value))
+            self.last_pwm = value
+        self.heater.set_pwm(read_time, value)
+    def _get_fan_speed(self, read_time):
+        if self.fan is None:
+            return 0.
+        return self.fan.get_status(read_time)['speed']
+    def temperature_update(self, read_time, temp, target_temp):
+        if self.done:
+            self.heater.set_pwm(read_time, 0.)
+            return
+        self.temp_samples.append((read_time, temp,
+                                  self._get_fan_speed(read_time)))
+        if self.start_temp is None:
+            self.start_temp = temp
+        if self.heating:
+            if temp >= target_temp:
+                # Cool until a fraction of the rise has been lost
+                self.heating = False
+                self.cool_start_time = read_time
+                rise = temp - self.start_temp
+                self.cool_temp = temp - rise * MPC_COOL_FRACTION
+        elif (temp <= self.cool_temp
+              or read_time - self.cool_start_time > MPC_COOL_TIME):
+            self.done = True
+        if self.heating:
+            self.set_pwm(read_time, self.heater_max_power)
+        else:
+            self.set_pwm(read_time, 0.)
+    def check_busy(self, eventtime, smoothed_temp, target_temp):
+        return not self.done
+    # Analysis
+    def get_samples(self):
+        return merge_pwm_samples(self.temp_samples, self.pwm_samples)
+    # Offline analysis helper
+    def write_file(self, filename):
+        pwm = ["pwm: %.3f %.3f" % (time, value)
+               for time, value in self.pwm_samples]
+        out = ["%.3f %.3f" % (time, temp)
+               for time, temp, fan_speed in self.temp_samples]
+        f = open(filename, "wb")
+        f.write('\n'.join(pwm + out))
+        f.close()
+
+
+######################################################################
+# Thermal model fitting
+######################################################################
+
+# Model: C * dT/dt = P * pwm - (h + hf * fan) * (T - T_ambient)
+MPC_MAX_SAMPLE_GAP = 5.
+MPC_MIN_DERIV_TIME = 1.
+MPC_MIN_FAN_RANGE = .2
+
+# Combine temperature samples with the pwm value in effect at each one
+def merge_pwm_samples(temp_samples, pwm_samples):
+    out = []
+    pwm = 0.
+    pos = 0
+    for sample in temp_samples:
+        while pos < len(pwm_samples) and pwm_samples[pos][0] <= sample[0]:
+            pwm = pwm_samples[pos][1]
+            pos += 1
+        fan_speed = 0.
+        if len(sample) > 2:
+            fan_speed = sample[2]
+        out.append((sample[0], sample[1], pwm, fan_speed))
+    return out
+
+# Solve a small linear system using Gaussian elimination
+def _solve_linear(matrix, vector):
+    size = len(vector)
+    rows = [list(matrix[i]) + [vector[i]] for i in range(size)]
+    for col in range(size):
+        pivot = max(range(col, size), key=lambda r: abs(rows[r][col]))
+        if abs(rows[pivot][col]) < 1e-12:
+            raise ValueError("insufficient excitation in samples")
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        for r in range(col + 1, size):
+            factor = rows[r][col] / rows[col][col]
+            for c in range(col, size + 1):
+                rows[r][c] -= factor * rows[col][c]
+    result = [0.] * size
+    for r in range(size - 1, -1, -1):
+        total = rows[r][size] - sum([rows[r][c] * result[c]
+                                     for c in range(r + 1, size)])
+        result[r] = total / rows[r][r]
+    return result
+
+# Estimate temperature change rates from (time, temp, pwm, fan) samples
+def _calc_derivs(samples):
+    out = []
+    start = 0
+    for i in range(1, len(samples)):
+        t1 = samples[i][0]
+        if t1 <= samples[i-1][0] or t1 - samples[i-1][0] > MPC_MAX_SAMPLE_GAP:
+            # Time discontinuity (eg, klippy restart) - start new segment
+            start = i
+            continue
+        if t1 - samples[start][0] < MPC_MIN_DERIV_TIME:
+            continue
+        t0, temp0, pwm, fan_speed = samples[start]
+        temp1 = samples[i][1]
+        # Use the average pwm and fan speed over the interval
+        pwms = [s[2] for s in samples[start:i]]
+        fans = [s[3] for s in samples[start:i]]
+        out.append(((temp1 - temp0) / (t1 - t0), .5 * (temp0 + temp1),
+                    sum(pwms) / len(pwms), sum(fans) / len(fans)))
+        start = i
+    return out
+
+def fit_thermal_model(samples, heater_power=None, ambient_temp=None):
+    derivs = _calc_derivs(samples)
+    if len(derivs) < 8:
+        raise ValueError("not enough temperature samples")
+    # The fan term is only identifiable with a known ambient temperature
+    # and samples covering a range of fan speeds
+    fit_fan = (ambient_temp is not None
+               and (max([d[3] for d in derivs]) - min([d[3] for d in derivs])
+                    >= MPC_MIN_FAN_RANGE))
+    # Build linear regressors for dT/dt
+    rows = []
+    for deriv, temp, pwm, fan_speed in derivs:
+        if ambient_temp is None:
+            row = [pwm, -temp, 1.]
+        else:
+            row = [pwm, -(temp - ambient_temp)]
+        if fit_fan:
+            row.append(-fan_speed * (temp - ambient_temp))
+        rows.append(row)
+    size = len(rows[0])
+    ata = [[sum([r[i] * r[j] for r in rows]) for j in range(size)]
+           for i in range(size)]
+    atb = [sum([r[i] * d[0] for r, d in zip(rows, derivs)])
+           for i in range(size)]
+    coeffs = _solve_linear(ata, atb)
+    gain, loss = coeffs[0], coeffs[1]
+    if gain <= 0. or loss <= 0.:
+        raise ValueError("samples do not describe a heating process")
+    if ambient_temp is None:
+        ambient_temp = coeffs[2] / loss
+    if heater_power is None:
+        heater_power = 1.
+    capacity = heater_power / gain
+    # Quality of the fit
+    sq_err = 0.
+    for r, d in zip(rows, derivs):
+        sq_err += (sum([c * v for c, v in zip(coeffs, r)]) - d[0])**2
+    model = {'heater_power': heater_power,
+             'block_heat_capacity': capacity,
+             'ambient_transfer': loss * capacity,
+             'ambient_temp': ambient_temp,
+             'rms_error': (sq_err / len(derivs))**.5}
+    if fit_fan:
+        model['fan_ambient_transfer'] = max(0., coeffs[-1] * capacity)
+    return model
+
+def format_model(model):
+    out = ["heater_power=%.3f block_heat_capacity=%.4f ambient_transfer=%.4f"
+           % (model['heater_power'], model['block_heat_capacity'],
+              model['ambient_transfer'])]
+    if 'fan_ambient_transfer' in model:
+        out.append("fan_ambient_transfer=%.4f"
+                   % (model['fan_ambient_transfer'],))
+    return " ".join(out)
+
+def load_config(config):
+    return MPCCalibrate(config)
@@ -3,59 +3,39 @@
 # Copyright (C) 2022  fengxs <1289244886@qq.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging
-
 PIN_MIN_TIME = 0.300
+BLINK_CYCLE_TIME = 2.
 
 
 class MyLed:
     def __init__(self, config):
-        self.toggle = False
-        self.is_active = True
-        self.last_print_time = 0.
         self.printer = config.get_printer()
         self.reactor = self.printer.get_reactor()
         ppins = self.printer.lookup_object('pins')
-        self.printer.register_event_handler("klippy:ready", self.handle_ready)
-        self.mcu_led = ppins.setup_pin('digital_out', config.get('pin'))
-        # # my led updating
-        self.myled_update_timer = self.reactor.register_timer(
-            self.led_update_event)
+        # Blink using a software pwm cycle so the mcu toggles the pin
+        self.mcu_led = ppins.setup_pin('pwm', config.get('pin'))
+        self.mcu_led.setup_cycle_time(BLINK_CYCLE_TIME)
+        self.mcu_led.setup_max_duration(0.)
         self.mcu_led.setup_start_value(0, 0)
-        self.print_stats = self.printer.load_object(config, 'print_stats')
-
-
-    def handle_ready(self):
-        # Start led update timer
-        self.reactor.update_timer(self.myled_update_timer,
-                                  self.reactor.NOW)
-
-    def led_update_event(self, eventtime):
+        self.last_value = 0.
+        self.last_print_time = 0.
+        self.printer.load_object(config, 'print_stats')
+        self.printer.register_event_handler("print_stats:state",
+                                            self.handle_print_state)
+
+    def handle_print_state(self, state):
+        value = 0.
+        if state == "printing":
+            value = .5
+        if value == self.last_value or self.printer.is_shutdown():
+            return
+        eventtime = self.reactor.monotonic()
         print_time = self.mcu_led.get_mcu().estimated_print_time(eventtime)
-        print_time = max(print_time, self.last_print_time + PIN_MIN_TIME)
-        logging.info("led_update_event state:%s" % self.print_stats.get_status(eventtime).get("state"))
-        if self.print_stats.get_status(eventtime).get("state") != "printing":
-            return eventtime + 1
-        logging.info("<<<<<<<<<<<<<<<<<<<<<<led test>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>%s"%print_time)
-        if self.toggle:
-            logging.info("......................led ON...........................")
-            self.set_led_on(print_time)
-            self.toggle = False
-        else:
-            logging.info("//////////////////////led OFF>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>")
-            self.set_led_off(print_time)
-            self.toggle = True
+        print_time = max(print_time + PIN_MIN_TIME,
+                         self.last_print_time + PIN_MIN_TIME)
+        self.mcu_led.set_pwm(print_time, value)
+        self.last_value = value
         self.last_print_time = print_time
-        if self.is_active:
-            return eventtime + 1
-        else:
-            return self.reactor.NEVER
-
-    def set_led_on(self, print_time):
-        self.mcu_led.set_digital(print_time + PIN_MIN_TIME, 1)
-
-    def set_led_off(self, print_time):
-        self.mcu_led.set_digital(print_time + PIN_MIN_TIME, 0)
 
 def load_config(config):
     return MyLed(config)
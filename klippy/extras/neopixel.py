@@ -4,6 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging
+from . import led
 
 BACKGROUND_PRIORITY_CLOCK = 0x7fffffff00000000
 
@@ -15,8 +16,6 @@ MAX_MCU_SIZE = 500  # Sanity check on LED chain length
 class PrinterNeoPixel:
     def __init__(self, config):
         self.printer = config.get_printer()
-        name = config.get_name().split()[1]
-        self.mutex = self.printer.get_reactor().mutex()
         # Configure neopixel
         ppins = self.printer.lookup_object('pins')
         pin_params = ppins.lookup_pin(config.get('pin'))
@@ -41,10 +40,10 @@ class PrinterNeoPixel:
         self.update_color_data(red, green, blue, white)
         self.old_color_data = bytearray([d ^ 1 for d in self.color_data])
         # Register commands
+        self.led_helper = led.LEDHelper(config, self.update_color_data,
+                                        self.send_data, self.chain_count,
+                                        has_white=(elem_size == 4))
         self.printer.register_event_handler("klippy:connect", self.send_data)
-        gcode = self.printer.lookup_object('gcode')
-        gcode.register_mux_command("SET_LED", "LED", name, self.cmd_SET_LED,
-                                   desc=self.cmd_SET_LED_help)
     def build_config(self):
         bmt = self.mcu.seconds_to_clock(BIT_MAX_TIME)
         rmt = self.mcu.seconds_to_clock(RESET_MIN_TIME)
@@ -110,32 +109,6 @@ class PrinterNeoPixel:
                 break
         else:
             logging.info("Neopixel update did not succeed")
-    cmd_SET_LED_help = "Set the color of an LED"
-    def cmd_SET_LED(self, gcmd):
-        # Parse parameters
-        red = gcmd.get_float('RED', 0., minval=0., maxval=1.)
-        green = gcmd.get_float('GREEN', 0., minval=0., maxval=1.)
-        blue = gcmd.get_float('BLUE', 0., minval=0., maxval=1.)
-        white = gcmd.get_float('WHITE', 0., minval=0., maxval=1.)
-        index = gcmd.get_int('INDEX', None, minval=1, maxval=self.chain_count)
-        transmit = gcmd.get_int('TRANSMIT', 1)
-        sync = gcmd.get_int('SYNC', 1)
-        # Update and transmit data
-        def reactor_bgfunc(print_time):
-            with self.mutex:
-                self.update_color_data(red, green, blue, white, index)
-                if transmit:
-                    self.send_data(print_time)
-        def lookahead_bgfunc(print_time):
-            reactor = self.printer.get_reactor()
-            reactor.register_callback(lambda et: reactor_bgfunc(print_time))
-        if sync:
-            #Sync LED Update with print time and send
-            toolhead = self.printer.lookup_object('toolhead')
-            toolhead.register_lookahead_callback(lookahead_bgfunc)
-        else:
-            #Send update now (so as not to wake toolhead and reset idle_timeout)
-            lookahead_bgfunc(None)
     def get_status(self, eventtime):
         cdata = []
         elem_size = len(self.color_order)
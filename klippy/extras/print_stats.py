@@ -6,9 +6,10 @@
 
 class PrintStats:
     def __init__(self, config):
-        printer = config.get_printer()
+        printer = self.printer = config.get_printer()
         self.gcode_move = printer.load_object(config, 'gcode_move')
         self.reactor = printer.get_reactor()
+        self.state = "standby"
         self.reset()
         if printer.start_args.get("apiserver")[-1] != "s":
             self.index = printer.start_args.get("apiserver")[-1]
@@ -36,7 +37,7 @@ class PrintStats:
         # Reset last e-position
         gc_status = self.gcode_move.get_status(curtime)
         self.last_epos = gc_status['position'].e
-        self.state = "printing"
+        self._set_state("printing")
         self.error_message = ""
         self.last_new_total_print_time = self.last_total_print_time = self.new_total_print_time = self.get_last_total_print_time()
     def note_pause(self):
@@ -46,7 +47,7 @@ class PrintStats:
             # update filament usage
             self._update_filament_usage(curtime)
         if self.state != "error":
-            self.state = "paused"
+            self._set_state("paused")
     def note_complete(self):
         self._note_finish("complete")
     def note_error(self, message):
@@ -56,7 +57,7 @@ class PrintStats:
     def _note_finish(self, state, error_message = ""):
         if self.print_start_time is None:
             return
-        self.state = state
+        self._set_state(state)
         self.error_message = error_message
         eventtime = self.reactor.monotonic()
         self.total_duration = eventtime - self.print_start_time
@@ -67,11 +68,15 @@ class PrintStats:
         self.print_start_time = None
     def reset(self):
         self.filename = self.error_message = ""
-        self.state = "standby"
+        self._set_state("standby")
         self.prev_pause_duration = self.last_epos = 0.
         self.filament_used = self.total_duration = 0.
         self.print_start_time = self.last_pause_time = None
         self.init_duration = 0.
+    def _set_state(self, state):
+        if state != self.state:
+            self.state = state
+            self.printer.send_event("print_stats:state", state)
     def get_status(self, eventtime):
         time_paused = self.prev_pause_duration
         if self.print_start_time is not None:
@@ -87,7 +92,9 @@ class PrintStats:
                 self.init_duration = self.total_duration - time_paused
         print_duration = self.total_duration - self.init_duration - time_paused
         self.new_total_print_time = print_duration/60 + self.last_total_print_time
-        if self.new_total_print_time > self.last_new_total_print_time:
+        # The file stores whole minutes - only write it when that changes
+        if (int(self.new_total_print_time)
+            > int(self.last_new_total_print_time)):
             self.set_total_print_time(self.new_total_print_time)
             self.last_new_total_print_time = self.new_total_print_time
             # self.last_total_print_time = self.new_total_print_time
@@ -4,7 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import json
-import logging
+import logging, math
 import pins
 from . import manual_probe
 
@@ -14,6 +14,11 @@ consider reducing the Z axis minimum position so the probe
 can travel further (the Z minimum position can be negative).
 """
 
+# Two-sided 95% t-distribution values indexed by degrees of freedom
+T_VALUES_95 = [0., 12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365,
+               2.306, 2.262, 2.228]
+T_VALUE_95_LARGE = 2.
+
 class PrinterProbe:
     def __init__(self, config, mcu_probe):
         self.printer = config.get_printer()
@@ -49,6 +54,11 @@ class PrinterProbe:
                                                  minval=0.)
         self.samples_retries = config.getint('samples_tolerance_retries', 0,
                                              minval=0)
+        smodes = {'fixed': 'fixed', 'statistical': 'statistical'}
+        self.samples_mode = config.getchoice('samples_mode', smodes, 'fixed')
+        # Sample statistics of the current multi-probe session
+        self.last_probe = {}
+        self.probe_points = []
         # Register z_virtual_endstop pin
         self.printer.lookup_object('pins').register_chip('probe', self)
         # Register homing event handlers
@@ -97,6 +107,7 @@ class PrinterProbe:
     def multi_probe_begin(self):
         self.mcu_probe.multi_probe_begin()
         self.multi_probe_pending = True
+        self.probe_points = []
     def multi_probe_end(self):
         if self.multi_probe_pending:
             self.multi_probe_pending = False
@@ -145,6 +156,38 @@ class PrinterProbe:
             return z_sorted[middle]
         # even number of samples
         return self._calc_mean(z_sorted[middle-1:middle+1])
+    def _calc_stddev(self, z_positions):
+        count = len(z_positions)
+        if count < 2:
+            return 0.
+        avg = sum(z_positions) / count
+        return math.sqrt(sum([(z - avg)**2 for z in z_positions])
+                         / (count - 1))
+    def _calc_confidence(self, z_positions):
+        # Half width of the 95% confidence interval of the mean
+        count = len(z_positions)
+        if count < 2:
+            return 0.
+        if count - 1 < len(T_VALUES_95):
+            t_value = T_VALUES_95[count - 1]
+        else:
+            t_value = T_VALUE_95_LARGE
+        return t_value * self._calc_stddev(z_positions) / math.sqrt(count)
+    def _find_outlier(self, positions):
+        median = self._calc_median(positions)[2]
+        return max(positions, key=(lambda p: abs(p[2] - median)))
+    def _note_probe_stats(self, result, positions, probe_count, retries,
+                          duration):
+        z_positions = [p[2] for p in positions]
+        self.last_probe = {
+            'x': result[0], 'y': result[1], 'z': result[2],
+            'samples': len(positions), 'probe_count': probe_count,
+            'retries': retries,
+            'range': max(z_positions) - min(z_positions),
+            'stddev': self._calc_stddev(z_positions),
+            'duration': duration}
+        if self.multi_probe_pending:
+            self.probe_points = self.probe_points + [self.last_probe]
     def run_probe(self, gcmd):
         speed = gcmd.get_float("PROBE_SPEED", self.speed, above=0.)
         lift_speed = self.get_lift_speed(gcmd)
@@ -156,33 +199,57 @@ class PrinterProbe:
         samples_retries = gcmd.get_int("SAMPLES_TOLERANCE_RETRIES",
                                        self.samples_retries, minval=0)
         samples_result = gcmd.get("SAMPLES_RESULT", self.samples_result)
+        samples_mode = gcmd.get("SAMPLES_MODE", self.samples_mode).lower()
+        if samples_mode not in ('fixed', 'statistical'):
+            raise gcmd.error("Unknown SAMPLES_MODE '%s'" % (samples_mode,))
+        statistical = samples_mode == 'statistical'
+        start_time = self.printer.get_reactor().monotonic()
         must_notify_multi_probe = not self.multi_probe_pending
         if must_notify_multi_probe:
             self.multi_probe_begin()
         probexy = self.printer.lookup_object('toolhead').get_position()[:2]
-        retries = 0
+        retries = probe_count = 0
         positions = []
         while len(positions) < sample_count:
             # Probe position
             pos = self._probe(speed)
             positions.append(pos)
+            probe_count += 1
             # Check samples tolerance
             z_positions = [p[2] for p in positions]
             if max(z_positions) - min(z_positions) > samples_tolerance:
                 if retries >= samples_retries:
                     raise gcmd.error("""{"code":"key97", "msg": "Probe samples exceed samples tolerance", "values": []}""")
-                gcmd.respond_info("Probe samples exceed tolerance. Retrying...")
                 retries += 1
-                positions = []
-            # Retract
+                if statistical and len(positions) >= 3:
+                    # Only retake the sample furthest from the median
+                    positions.remove(self._find_outlier(positions))
+                    gcmd.respond_info(
+                        "Probe sample exceeds tolerance. Retaking sample...")
+                else:
+                    gcmd.respond_info(
+                        "Probe samples exceed tolerance. Retrying...")
+                    positions = []
+            elif (statistical and len(positions) >= 2
+                  and 2. * self._calc_confidence(z_positions)
+                  <= samples_tolerance):
+                # Mean is known to within the tolerance
+                break
+            # Retract - the next probing move starts from the end of
+            # the queued retract without waiting for it to complete
             if len(positions) < sample_count:
                 self._move(probexy + [pos[2] + sample_retract_dist], lift_speed)
         if must_notify_multi_probe:
             self.multi_probe_end()
         # Calculate and return result
         if samples_result == 'median':
-            return self._calc_median(positions)
-        return self._calc_mean(positions)
+            result = self._calc_median(positions)
+        else:
+            result = self._calc_mean(positions)
+        duration = self.printer.get_reactor().monotonic() - start_time
+        self._note_probe_stats(result, positions, probe_count, retries,
+                               duration)
+        return result
     cmd_PROBE_help = "Probe Z-height at current XY position"
     def cmd_PROBE(self, gcmd):
         pos = self.run_probe(gcmd)
@@ -197,7 +264,9 @@ class PrinterProbe:
         gcmd.respond_info("probe: %s" % (["open", "TRIGGERED"][not not res],))
     def get_status(self, eventtime):
         return {'last_query': self.last_state,
-                'last_z_result': self.last_z_result}
+                'last_z_result': self.last_z_result,
+                'last_probe': self.last_probe,
+                'probe_points': self.probe_points}
     cmd_PROBE_ACCURACY_help = "Probe Z-height accuracy at current XY position"
     def cmd_PROBE_ACCURACY(self, gcmd):
         speed = gcmd.get_float("PROBE_SPEED", self.speed, above=0.)
@@ -340,7 +409,9 @@ class ProbeEndstopWrapper:
         self.get_steppers = self.mcu_endstop.get_steppers
         self.home_start = self.mcu_endstop.home_start
         self.home_wait = self.mcu_endstop.home_wait
+        self.home_wait_batch = self.mcu_endstop.home_wait_batch
         self.query_endstop = self.mcu_endstop.query_endstop
+        self.add_query_endstop = self.mcu_endstop.add_query_endstop
         # multi probes state
         self.multi = 'OFF'
     def _handle_mcu_identify(self):
@@ -19,6 +19,24 @@ class QueryEndstops:
         gcode.register_command("M119", self.cmd_QUERY_ENDSTOPS)
     def register_endstop(self, mcu_endstop, name):
         self.endstops.append((mcu_endstop, name))
+    def _query_endstops(self, print_time):
+        # Send the queries of all endstops on an mcu before waiting
+        batches = {}
+        results = []
+        for mcu_endstop, name in self.endstops:
+            add_query = getattr(mcu_endstop, 'add_query_endstop', None)
+            if add_query is None:
+                state = mcu_endstop.query_endstop(print_time)
+                results.append((name, (lambda s=state: s)))
+                continue
+            mcu = mcu_endstop.get_mcu()
+            batch = batches.get(mcu)
+            if batch is None:
+                batch = batches[mcu] = mcu.create_query_batch()
+            results.append((name, add_query(batch, print_time)))
+        for batch in batches.values():
+            batch.send()
+        return [(name, get_state()) for name, get_state in results]
     def get_status(self, eventtime):
         return {'last_query': {name: value for name, value in self.last_state}}
     def _handle_web_request(self, web_request):
@@ -26,16 +44,14 @@ class QueryEndstops:
         toolhead = self.printer.lookup_object('toolhead')
         with gc_mutex:
             print_time = toolhead.get_last_move_time()
-            self.last_state = [(name, mcu_endstop.query_endstop(print_time))
-                               for mcu_endstop, name in self.endstops]
+            self.last_state = self._query_endstops(print_time)
         web_request.send({name: ["open", "TRIGGERED"][not not t]
                           for name, t in self.last_state})
     cmd_QUERY_ENDSTOPS_help = "Report on the status of each endstop"
     def cmd_QUERY_ENDSTOPS(self, gcmd):
         # Query the endstops
         print_time = self.printer.lookup_object('toolhead').get_last_move_time()
-        self.last_state = [(name, mcu_endstop.query_endstop(print_time))
-                           for mcu_endstop, name in self.endstops]
+        self.last_state = self._query_endstops(print_time)
         # Report results
         msg = " ".join(["%s:%s" % (name, ["open", "TRIGGERED"][not not t])
                         for name, t in self.last_state])
@@ -85,6 +85,54 @@ class FieldHelper:
 # Periodic error checking
 ######################################################################
 
+# Poll all drivers sharing a bus (uart or spi chain) from one timer
+class TMCErrorPoller:
+    def __init__(self, printer):
+        self.printer = printer
+        self.checks = []
+        self.poll_timer = None
+    def add_check(self, echeck):
+        if echeck in self.checks:
+            return
+        self.checks.append(echeck)
+        if self.poll_timer is None:
+            reactor = self.printer.get_reactor()
+            self.poll_timer = reactor.register_timer(
+                self._do_periodic_check, reactor.monotonic() + 1.)
+    def remove_check(self, echeck):
+        if echeck not in self.checks:
+            return
+        self.checks.remove(echeck)
+        if not self.checks:
+            self.printer.get_reactor().unregister_timer(self.poll_timer)
+            self.poll_timer = None
+    def _do_periodic_check(self, eventtime):
+        for echeck in list(self.checks):
+            if echeck not in self.checks:
+                # Removed while an earlier driver was being queried
+                continue
+            try:
+                echeck.check_registers()
+            except self.printer.command_error as e:
+                self.printer.invoke_shutdown(str(e))
+                return self.printer.get_reactor().NEVER
+        return eventtime + 1.
+
+# Drivers that share a communication mutex share an error poller
+class PrinterTMCErrorPollers:
+    def __init__(self):
+        self.mutex_to_poller = {}
+def lookup_tmc_error_poller(printer, mutex):
+    ppollers = printer.lookup_object('tmc_error_poll', None)
+    if ppollers is None:
+        ppollers = PrinterTMCErrorPollers()
+        printer.add_object('tmc_error_poll', ppollers)
+    poller = ppollers.mutex_to_poller.get(mutex)
+    if poller is None:
+        poller = TMCErrorPoller(printer)
+        ppollers.mutex_to_poller[mutex] = poller
+    return poller
+
 class TMCErrorCheck:
     def __init__(self, config, mcu_tmc):
         self.printer = config.get_printer()
@@ -92,7 +140,8 @@ class TMCErrorCheck:
         self.stepper_name = ' '.join(name_parts[1:])
         self.mcu_tmc = mcu_tmc
         self.fields = mcu_tmc.get_fields()
-        self.check_timer = None
+        self.poller = lookup_tmc_error_poller(self.printer, mcu_tmc.mutex)
+        self.checks_active = False
         self.last_drv_status = self.last_status = None
         # Setup for GSTAT query
         reg_name = self.fields.lookup_register("drv_err")
@@ -122,13 +171,14 @@ class TMCErrorCheck:
                 if f in err_fields:
                     err_mask |= self.fields.all_fields[reg_name][f]
         self.drv_status_reg_info = [0, reg_name, mask, err_mask, cs_actual_mask]
-    def _query_register(self, reg_info, try_clear=False):
+    def _query_register(self, reg_info, try_clear=False, val=None):
         last_value, reg_name, mask, err_mask, cs_actual_mask = reg_info
         cleared_flags = 0
         count = 0
         while 1:
             try:
-                val = self.mcu_tmc.get_register(reg_name)
+                if val is None:
+                    val = self.mcu_tmc.get_register(reg_name)
             except self.printer.command_error as e:
                 count += 1
                 if count < 3 and str(e).startswith("Unable to read tmc uart"):
@@ -145,7 +195,7 @@ class TMCErrorCheck:
                 if not cs_actual_mask or val & cs_actual_mask:
                     break
                 irun = self.fields.get_field(self.irun_field)
-                if self.check_timer is None or irun < 4:
+                if not self.checks_active or irun < 4:
                     break
                 if (self.irun_field == "irun"
                     and not self.fields.get_field("ihold")):
@@ -160,40 +210,41 @@ class TMCErrorCheck:
                 try_clear = False
                 cleared_flags |= val & err_mask
                 self.mcu_tmc.set_register(reg_name, val & err_mask)
+            val = None
         return cleared_flags
-    def _do_periodic_check(self, eventtime):
+    def check_registers(self, try_clear=False):
+        # Read DRV_STATUS and GSTAT together (retries are done one by one)
+        reg_infos = [self.drv_status_reg_info]
+        if self.gstat_reg_info is not None:
+            reg_infos.append(self.gstat_reg_info)
         try:
-            self._query_register(self.drv_status_reg_info)
-            if self.gstat_reg_info is not None:
-                self._query_register(self.gstat_reg_info)
+            vals = self.mcu_tmc.get_registers([ri[1] for ri in reg_infos])
         except self.printer.command_error as e:
-            self.printer.invoke_shutdown(str(e))
-            return self.printer.get_reactor().NEVER
-        return eventtime + 1.
+            # Read the registers one by one (with the usual read retries)
+            vals = [None] * len(reg_infos)
+        cleared_flags = self._query_register(reg_infos[0], val=vals[0])
+        if len(reg_infos) > 1:
+            cleared_flags = self._query_register(reg_infos[1], try_clear,
+                                                 val=vals[1])
+        return cleared_flags
     def stop_checks(self):
-        if self.check_timer is None:
+        if not self.checks_active:
             return
-        self.printer.get_reactor().unregister_timer(self.check_timer)
-        self.check_timer = None
+        self.poller.remove_check(self)
+        self.checks_active = False
     def start_checks(self):
-        if self.check_timer is not None:
+        if self.checks_active:
             self.stop_checks()
-        cleared_flags = 0
-        self._query_register(self.drv_status_reg_info)
-        if self.gstat_reg_info is not None:
-            cleared_flags = self._query_register(self.gstat_reg_info,
-                                                 try_clear=self.clear_gstat)
-        reactor = self.printer.get_reactor()
-        curtime = reactor.monotonic()
-        self.check_timer = reactor.register_timer(self._do_periodic_check,
-                                                  curtime + 1.)
+        cleared_flags = self.check_registers(try_clear=self.clear_gstat)
+        self.checks_active = True
+        self.poller.add_check(self)
         if cleared_flags:
             reset_mask = self.fields.all_fields["GSTAT"]["reset"]
             if cleared_flags & reset_mask:
                 return True
         return False
     def get_status(self, eventtime=None):
-        if self.check_timer is None:
+        if not self.checks_active:
             return {'drv_status': None}
         last_value, reg_name = self.drv_status_reg_info[:2]
         if last_value != self.last_drv_status:
@@ -243,8 +294,8 @@ class TMCCommandHelper:
                                    desc=self.cmd_SET_TMC_CURRENT_help)
     def _init_registers(self, print_time=None):
         # Send registers
-        for reg_name, val in self.fields.registers.items():
-            self.mcu_tmc.set_register(reg_name, val, print_time)
+        self.mcu_tmc.set_registers(list(self.fields.registers.items()),
+                                   print_time)
     cmd_INIT_TMC_help = "Initialize TMC stepper driver registers"
     def cmd_INIT_TMC(self, gcmd):
         logging.info("INIT_TMC %s", self.name)
@@ -406,8 +457,8 @@ class TMCCommandHelper:
             if reg_name not in self.read_registers:
                 gcmd.respond_info(self.fields.pretty_format(reg_name, val))
         gcmd.respond_info("========== Queried registers ==========")
-        for reg_name in self.read_registers:
-            val = self.mcu_tmc.get_register(reg_name)
+        vals = self.mcu_tmc.get_registers(self.read_registers)
+        for reg_name, val in zip(self.read_registers, vals):
             if self.read_translate is not None:
                 reg_name, val = self.read_translate(reg_name, val)
             gcmd.respond_info(self.fields.pretty_format(reg_name, val))
@@ -170,16 +170,29 @@ class MCU_TMC_SPI_chain:
     def _build_cmd(self, data, chain_pos):
         return ([0x00] * ((self.chain_len - chain_pos) * 5) +
                 data + [0x00] * ((chain_pos - 1) * 5))
+    def _parse_response(self, params, chain_pos):
+        pr = bytearray(params['response'])
+        pr = pr[(self.chain_len - chain_pos) * 5 :
+                (self.chain_len - chain_pos + 1) * 5]
+        return (pr[1] << 24) | (pr[2] << 16) | (pr[3] << 8) | pr[4]
     def reg_read(self, reg, chain_pos):
         cmd = self._build_cmd([reg, 0x00, 0x00, 0x00, 0x00], chain_pos)
         self.spi.spi_send(cmd)
         if self.printer.get_start_args().get('debugoutput') is not None:
             return 0
         params = self.spi.spi_transfer(cmd)
-        pr = bytearray(params['response'])
-        pr = pr[(self.chain_len - chain_pos) * 5 :
-                (self.chain_len - chain_pos + 1) * 5]
-        return (pr[1] << 24) | (pr[2] << 16) | (pr[3] << 8) | pr[4]
+        return self._parse_response(params, chain_pos)
+    def reg_read_multi(self, regs, chain_pos):
+        # The response to each datagram holds the previously read register
+        cmds = [self._build_cmd([reg, 0x00, 0x00, 0x00, 0x00], chain_pos)
+                for reg in regs]
+        if self.printer.get_start_args().get('debugoutput') is not None:
+            self.spi.spi_send(cmds[0])
+            return [0] * len(regs)
+        # The first datagram is part of the batch (its response is not
+        # used) so that a retry restarts the whole pipelined sequence
+        params = self.spi.spi_transfer_batch(cmds + cmds[-1:])
+        return [self._parse_response(p, chain_pos) for p in params[1:]]
     def reg_write(self, reg, val, chain_pos, print_time=None):
         minclock = 0
         if print_time is not None:
@@ -193,10 +206,24 @@ class MCU_TMC_SPI_chain:
         dummy_read = self._build_cmd([0x00, 0x00, 0x00, 0x00, 0x00], chain_pos)
         params = self.spi.spi_transfer_with_preface(write_cmd, dummy_read,
                                                     minclock=minclock)
-        pr = bytearray(params['response'])
-        pr = pr[(self.chain_len - chain_pos) * 5 :
-                (self.chain_len - chain_pos + 1) * 5]
-        return (pr[1] << 24) | (pr[2] << 16) | (pr[3] << 8) | pr[4]
+        return self._parse_response(params, chain_pos)
+    def reg_write_multi(self, reg_vals, chain_pos, print_time=None):
+        # Returns the written values as echoed by the following datagrams
+        minclock = 0
+        if print_time is not None:
+            minclock = self.spi.get_mcu().print_time_to_clock(print_time)
+        cmds = [self._build_cmd([(reg | 0x80) & 0xff, (val >> 24) & 0xff,
+                                 (val >> 16) & 0xff, (val >> 8) & 0xff,
+                                 val & 0xff], chain_pos)
+                for reg, val in reg_vals]
+        if self.printer.get_start_args().get('debugoutput') is not None:
+            for cmd in cmds:
+                self.spi.spi_send(cmd, minclock)
+            return [val for reg, val in reg_vals]
+        dummy_read = self._build_cmd([0x00, 0x00, 0x00, 0x00, 0x00], chain_pos)
+        params = self.spi.spi_transfer_batch(cmds + [dummy_read],
+                                             minclock=minclock)
+        return [self._parse_response(p, chain_pos) for p in params[1:]]
 
 # Helper to setup an spi daisy chain bus from settings in a config section
 def lookup_tmc_spi_chain(config):
@@ -236,6 +263,12 @@ class MCU_TMC_SPI:
         with self.mutex:
             read = self.tmc_spi.reg_read(reg, self.chain_pos)
         return read
+    def get_registers(self, reg_names):
+        if not reg_names:
+            return []
+        regs = [self.name_to_reg[reg_name] for reg_name in reg_names]
+        with self.mutex:
+            return self.tmc_spi.reg_read_multi(regs, self.chain_pos)
     def set_register(self, reg_name, val, print_time=None):
         reg = self.name_to_reg[reg_name]
         with self.mutex:
@@ -245,6 +278,17 @@ class MCU_TMC_SPI:
                     return
         raise self.printer.command_error(
             "Unable to write tmc spi '%s' register %s" % (self.name, reg_name))
+    def set_registers(self, reg_vals, print_time=None):
+        if not reg_vals:
+            return
+        regs = [(self.name_to_reg[reg_name], val) for reg_name, val in reg_vals]
+        with self.mutex:
+            written = self.tmc_spi.reg_write_multi(regs, self.chain_pos,
+                                                   print_time)
+        # Retry any register that did not verify
+        for (reg_name, val), v in zip(reg_vals, written):
+            if v != val:
+                self.set_register(reg_name, val, print_time)
 
 
 ######################################################################
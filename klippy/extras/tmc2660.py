@@ -212,6 +212,11 @@ class MCU_TMC2660_SPI:
         msg = [((val >> 16) | reg) & 0xff, (val >> 8) & 0xff, val & 0xff]
         with self.mutex:
             self.spi.spi_send(msg, minclock)
+    def get_registers(self, reg_names):
+        return [self.get_register(reg_name) for reg_name in reg_names]
+    def set_registers(self, reg_vals, print_time=None):
+        for reg_name, val in reg_vals:
+            self.set_register(reg_name, val, print_time)
 
 
 ######################################################################
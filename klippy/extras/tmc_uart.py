@@ -216,6 +216,7 @@ class MCU_TMC_uart:
         self.name_to_reg = name_to_reg
         self.fields = fields
         self.ifcnt = None
+        self.written_regs = {}
         self.instance_id, self.addr, self.mcu_uart = lookup_tmc_uart_bitbang(
             config, max_addr)
         self.mutex = self.mcu_uart.mutex
@@ -234,6 +235,9 @@ class MCU_TMC_uart:
     def get_register(self, reg_name):
         with self.mutex:
             return self._do_get_register(reg_name)
+    def get_registers(self, reg_names):
+        with self.mutex:
+            return [self._do_get_register(reg_name) for reg_name in reg_names]
     def set_register(self, reg_name, val, print_time=None):
         reg = self.name_to_reg[reg_name]
         if self.printer.get_start_args().get('debugoutput') is not None:
@@ -247,6 +251,35 @@ class MCU_TMC_uart:
                                         print_time)
                 self.ifcnt = self._do_get_register("IFCNT")
                 if self.ifcnt == (ifcnt + 1) & 0xff:
+                    self.written_regs[reg_name] = val
                     return
         raise self.printer.command_error(
             "Unable to write tmc uart '%s' register %s" % (self.name, reg_name))
+    def set_registers(self, reg_vals, print_time=None):
+        if self.printer.get_start_args().get('debugoutput') is not None:
+            return
+        with self.mutex:
+            # The interface counter is reset on a driver reset and counts
+            # every write, so an unchanged non-zero count confirms that
+            # the previously written registers are still in effect.
+            ifcnt = self._do_get_register("IFCNT")
+            if not ifcnt or ifcnt != self.ifcnt:
+                self.written_regs.clear()
+            pending = [(reg_name, val) for reg_name, val in reg_vals
+                       if self.written_regs.get(reg_name) != val]
+            self.ifcnt = ifcnt
+            if not pending:
+                return
+            # Send all writes and verify them with a single IFCNT read
+            for reg_name, val in pending:
+                self.mcu_uart.reg_write(self.instance_id, self.addr,
+                                        self.name_to_reg[reg_name], val,
+                                        print_time)
+            self.ifcnt = self._do_get_register("IFCNT")
+            if self.ifcnt == (ifcnt + len(pending)) & 0xff:
+                self.written_regs.update(pending)
+                return
+            self.written_regs.clear()
+        # Fall back to verifying each write individually
+        for reg_name, val in pending:
+            self.set_register(reg_name, val, print_time)
@@ -56,6 +56,7 @@ class PrinterExtruder:
         toolhead.register_step_generator(self.stepper.generate_steps)
         self.extruder_set_smooth_time = ffi_lib.extruder_set_smooth_time
         self._set_pressure_advance(pressure_advance, smooth_time)
+        self.move_pressure_advance = pressure_advance
         # Register commands
         gcode = self.printer.lookup_object('gcode')
         if self.name == 'extruder':
@@ -83,12 +84,16 @@ class PrinterExtruder:
         new_smooth_time = smooth_time
         if not pressure_advance:
             new_smooth_time = 0.
-        toolhead = self.printer.lookup_object("toolhead")
-        toolhead.note_step_generation_scan_time(new_smooth_time * .5,
-                                                old_delay=old_smooth_time * .5)
-        self.extruder_set_smooth_time(self.sk_extruder, new_smooth_time)
+        if new_smooth_time != old_smooth_time:
+            # The smoothing window applies to all queued moves
+            toolhead = self.printer.lookup_object("toolhead")
+            toolhead.note_step_generation_scan_time(
+                new_smooth_time * .5, old_delay=old_smooth_time * .5)
+            self.extruder_set_smooth_time(self.sk_extruder, new_smooth_time)
         self.pressure_advance = pressure_advance
         self.pressure_advance_smooth_time = smooth_time
+    def _set_move_pressure_advance(self, pressure_advance):
+        self.move_pressure_advance = pressure_advance
     def get_status(self, eventtime):
         return dict(self.heater.get_status(eventtime),
                     can_extrude=self.heater.can_extrude,
@@ -150,7 +155,7 @@ class PrinterExtruder:
         cruise_v = move.cruise_v * axis_r
         pressure_advance = 0.
         if axis_r > 0. and (move.axes_d[0] or move.axes_d[1]):
-            pressure_advance = self.pressure_advance
+            pressure_advance = self.move_pressure_advance
         # Queue movement (x is extruder movement, y is pressure advance)
         self.trapq_append(self.trapq, print_time,
                           move.accel_t, move.cruise_t, move.decel_t,
@@ -191,6 +196,12 @@ class PrinterExtruder:
                                      self.pressure_advance_smooth_time,
                                      minval=0., maxval=.200)
         self._set_pressure_advance(pressure_advance, smooth_time)
+        # Moves already in the lookahead queue keep the old pressure
+        # advance - the new value applies to moves queued after this point
+        toolhead = self.printer.lookup_object('toolhead')
+        toolhead.register_lookahead_callback(
+            lambda print_time: self._set_move_pressure_advance(
+                pressure_advance))
         msg = ("pressure_advance: %.6f\n"
                "pressure_advance_smooth_time: %.6f"
                % (pressure_advance, smooth_time))
@@ -46,6 +46,12 @@ Printer is shutdown
 api_server_index = None
 MULTI_PRINTER_PATH = "/mnt/UDISK/.crealityprint/multiprinter.yaml"
 
+def _get_func_name(func):
+    obj = getattr(func, '__self__', None)
+    if obj is not None:
+        return "%s.%s" % (obj.__class__.__name__, func.__name__)
+    return getattr(func, '__name__', str(func))
+
 class Printer:
     config_error = configfile.error
     command_error = gcode.CommandError
@@ -59,6 +65,11 @@ class Printer:
         self.run_result = None
         self.event_handlers = {}
         self.objects = collections.OrderedDict()
+        # Startup timing statistics
+        self.load_times = {}
+        self.import_times = {}
+        self.load_child_times = []
+        self.phase_times = []
         # Init printer components that must be setup prior to config
         for m in [gcode, webhooks]:
             m.add_early_printer_objects(self)
@@ -107,6 +118,18 @@ class Printer:
     def load_object(self, config, section, default=configfile.sentinel):
         if section in self.objects:
             return self.objects[section]
+        # Track the time spent loading each module (excluding the time
+        # spent loading any other modules it requires)
+        start_time = self.reactor.monotonic()
+        self.load_child_times.append(0.)
+        try:
+            return self._load_object(config, section, default)
+        finally:
+            load_time = self.reactor.monotonic() - start_time
+            self.load_times[section] = load_time - self.load_child_times.pop()
+            if self.load_child_times:
+                self.load_child_times[-1] += load_time
+    def _load_object(self, config, section, default):
         module_parts = section.split()
         module_name = module_parts[0]
         py_name = os.path.join(os.path.dirname(__file__),
@@ -117,7 +140,9 @@ class Printer:
             if default is not configfile.sentinel:
                 return default
             raise self.config_error("""{"code":"key124", "msg": "Unable to load module '%s'", "values": ["%s"]}""" % (section, section))
+        import_start = self.reactor.monotonic()
         mod = importlib.import_module('extras.' + module_name)
+        self.import_times[section] = self.reactor.monotonic() - import_start
         init_func = 'load_config'
         if len(module_parts) > 1:
             init_func = 'load_config_prefix'
@@ -151,17 +176,43 @@ class Printer:
         except:
             logging.exception("Error in _get_versions()")
             return ""
+    def _run_timed(self, phase, func, *args):
+        start_time = self.reactor.monotonic()
+        try:
+            return func(*args)
+        finally:
+            self.phase_times.append((phase, func,
+                                     self.reactor.monotonic() - start_time))
+    def _log_startup_times(self):
+        phases = collections.OrderedDict()
+        for phase, func, phase_time in self.phase_times:
+            phases[phase] = phases.get(phase, 0.) + phase_time
+        out = ["Startup timing: %s" % (" ".join(
+            ["%s=%.3f" % (p, t) for p, t in phases.items()]),)]
+        handlers = [p for p in self.phase_times
+                    if p[0] in ('connect', 'ready')]
+        slow_handlers = sorted(handlers, key=lambda p: -p[2])[:5]
+        out.append("Slowest handlers: %s" % (", ".join(
+            ["%s:%s=%.3f" % (phase, _get_func_name(func), t)
+             for phase, func, t in slow_handlers]),))
+        slow_modules = sorted(self.load_times.items(), key=lambda m: -m[1])
+        out.append("Slowest modules: %s" % (", ".join(
+            ["%s=%.3f (import %.3f)" % (n, t, self.import_times.get(n, 0.))
+             for n, t in slow_modules[:8]]),))
+        logging.info("\n".join(out))
+        self.phase_times = []
     def _connect(self, eventtime):
         try:
             import threading
             t = threading.Thread(target=self._record_log_to_remote_server, args=("reconnect",))
             t.start()
-            self._read_config()
-            self.send_event("klippy:mcu_identify")
+            self._run_timed("config", self._read_config)
+            self._run_timed("mcu_identify", self.send_event,
+                            "klippy:mcu_identify")
             for cb in self.event_handlers.get("klippy:connect", []):
                 if self.state_message is not message_startup:
                     return
-                cb()
+                self._run_timed("connect", cb)
         except (self.config_error, pins.error) as e:
             # logging.exception("Config error")^M
             logging.error(e)
@@ -227,7 +278,8 @@ class Printer:
             for cb in self.event_handlers.get("klippy:ready", []):
                 if self.state_message is not message_ready:
                     return
-                cb()
+                self._run_timed("ready", cb)
+            self._log_startup_times()
         except Exception as e:
             logging.exception("Unhandled exception during ready callback")
             self.invoke_shutdown("Internal error during ready callback: %s"
@@ -114,16 +114,26 @@ class MCU_trsync:
                                           reqclock=expire_clock)
     def set_home_end_time(self, home_end_time):
         self._home_end_clock = self._mcu.print_time_to_clock(home_end_time)
-    def stop(self):
+    def add_stop_query(self, batches):
+        # Queue the trsync stop on an MCUQueryBatches - the returned
+        # function reports the trigger reason once the batches are sent
         self._mcu.register_response(None, "trsync_state", self._oid)
         self._trigger_completion = None
+        batch = batches.get_batch(self._mcu)
+        index = batch.add_query(self._trsync_query_cmd,
+                                [self._oid, self.REASON_HOST_REQUEST])
+        def get_reason():
+            params = batch.get_response(index)
+            if params is None:
+                return self.REASON_ENDSTOP_HIT
+            return params['trigger_reason']
+        return get_reason
+    def note_homing_end(self, batches):
+        # Reset the step clocks and queue the stepper position queries
+        # (not done in batch mode)
         if self._mcu.is_fileoutput():
-            return self.REASON_ENDSTOP_HIT
-        params = self._trsync_query_cmd.send([self._oid,
-                                              self.REASON_HOST_REQUEST])
-        for s in self._steppers:
-            s.note_homing_end()
-        return params['trigger_reason']
+            return []
+        return [s.note_homing_end(batches) for s in self._steppers]
 
 TRSYNC_TIMEOUT = 0.025
 TRSYNC_SINGLE_MCU_TIMEOUT = 0.250
@@ -201,7 +211,11 @@ class MCU_endstop:
              sample_count, rest_ticks, triggered ^ self._invert,
              etrsync.get_oid(), etrsync.REASON_ENDSTOP_HIT], reqclock=clock)
         return self._trigger_completion
-    def home_wait(self, home_end_time):
+    def home_wait_batch(self, home_end_time, batches):
+        # Wait for the homing move to end and queue the trsync stop
+        # queries.  After 'batches' is sent, the returned function queues
+        # the stepper position and endstop queries and returns a
+        # function that reports the trigger time (once sent again).
         etrsync = self._trsyncs[0]
         etrsync.set_home_end_time(home_end_time)
         if self._mcu.is_fileoutput():
@@ -210,22 +224,59 @@ class MCU_endstop:
         self._home_cmd.send([self._oid, 0, 0, 0, 0, 0, 0, 0])
         ffi_main, ffi_lib = chelper.get_ffi()
         ffi_lib.trdispatch_stop(self._trdispatch)
-        res = [trsync.stop() for trsync in self._trsyncs]
-        if any([r == etrsync.REASON_COMMS_TIMEOUT for r in res]):
-            return -1.
-        if res[0] != etrsync.REASON_ENDSTOP_HIT:
-            return 0.
-        if self._mcu.is_fileoutput():
-            return home_end_time
-        params = self._query_cmd.send([self._oid])
-        next_clock = self._mcu.clock32_to_clock64(params['next_clock'])
-        return self._mcu.clock_to_print_time(next_clock - self._rest_ticks)
+        get_reasons = [trsync.add_stop_query(batches)
+                       for trsync in self._trsyncs]
+        def note_stopped(batches):
+            res = [get_reason() for get_reason in get_reasons]
+            sync_positions = [sync_position for trsync in self._trsyncs
+                              for sync_position in trsync.note_homing_end(
+                                  batches)]
+            get_trigger_clock = None
+            if any([r == etrsync.REASON_COMMS_TIMEOUT for r in res]):
+                trigger_time = -1.
+            elif res[0] != etrsync.REASON_ENDSTOP_HIT:
+                trigger_time = 0.
+            elif self._mcu.is_fileoutput():
+                trigger_time = home_end_time
+            else:
+                batch = batches.get_batch(self._mcu)
+                index = batch.add_query(self._query_cmd, [self._oid])
+                get_trigger_clock = lambda: batch.get_response(index)
+            def get_trigger_time():
+                for sync_position in sync_positions:
+                    sync_position()
+                if get_trigger_clock is None:
+                    return trigger_time
+                params = get_trigger_clock()
+                next_clock = self._mcu.clock32_to_clock64(params['next_clock'])
+                return self._mcu.clock_to_print_time(
+                    next_clock - self._rest_ticks)
+            return get_trigger_time
+        return note_stopped
+    def home_wait(self, home_end_time):
+        batches = MCUQueryBatches(self._mcu.get_printer())
+        note_stopped = self.home_wait_batch(home_end_time, batches)
+        batches.send()
+        get_trigger_time = note_stopped(batches)
+        batches.send()
+        return get_trigger_time()
     def query_endstop(self, print_time):
         clock = self._mcu.print_time_to_clock(print_time)
         if self._mcu.is_fileoutput():
             return 0
         params = self._query_cmd.send([self._oid], minclock=clock)
         return params['pin_value'] ^ self._invert
+    def add_query_endstop(self, batch, print_time):
+        # Queue a state query on a CommandQueryBatch - the returned
+        # function reports the endstop state once the batch is sent
+        clock = self._mcu.print_time_to_clock(print_time)
+        index = batch.add_query(self._query_cmd, [self._oid], minclock=clock)
+        def get_state():
+            params = batch.get_response(index)
+            if params is None:
+                return 0
+            return params['pin_value'] ^ self._invert
+        return get_state
 
 class MCU_digital_out:
     def __init__(self, mcu, pin_params):
@@ -517,6 +568,67 @@ class CommandQueryWrapper:
                           minclock=0, reqclock=0):
         cmds = [preface_cmd._cmd.encode(preface_data), self._cmd.encode(data)]
         return self._do_send(cmds, minclock, reqclock)
+    def add_to_batch(self, batch, data=(), minclock=0, reqclock=0):
+        return batch.add_query(self._cmd.encode(data), self._response,
+                               self._oid, self._cmd_queue, minclock,
+                               max(minclock, reqclock))
+
+# Wrapper around sending several query commands before waiting for
+# their responses
+class CommandQueryBatch:
+    def __init__(self, serial, is_fileoutput=False, error=serialhdl.error):
+        self._batch = serialhdl.SerialBatchCommand(serial)
+        self._is_fileoutput = is_fileoutput
+        self._error = error
+        self._count = 0
+        self._responses = None
+    def add_query(self, query_cmd, data=(), minclock=0, reqclock=0):
+        self._count += 1
+        return query_cmd.add_to_batch(self._batch, data, minclock, reqclock)
+    def send(self):
+        if self._is_fileoutput:
+            self._responses = [None] * self._count
+            return self._responses
+        try:
+            self._responses = self._batch.get_responses()
+        except serialhdl.error as e:
+            raise self._error(str(e))
+        return self._responses
+    def get_response(self, index):
+        return self._responses[index]
+
+# Query batches for several mcus that are sent (and waited on) together
+class MCUQueryBatches:
+    def __init__(self, printer):
+        self._reactor = printer.get_reactor()
+        self._batches = []
+    def get_batch(self, mcu):
+        for m, batch in self._batches:
+            if m is mcu:
+                return batch
+        batch = mcu.create_query_batch()
+        self._batches.append((mcu, batch))
+        return batch
+    def _send_batch(self, batch):
+        try:
+            batch.send()
+        except Exception as e:
+            return e
+        return None
+    def send(self):
+        batches = [batch for m, batch in self._batches]
+        self._batches = []
+        if len(batches) <= 1:
+            for batch in batches:
+                batch.send()
+            return
+        completions = [self._reactor.register_callback(
+                           (lambda e, b=batch: self._send_batch(b)))
+                       for batch in batches]
+        errors = [c.wait() for c in completions]
+        for e in errors:
+            if e is not None:
+                raise e
 
 # Wrapper around command sending
 class CommandWrapper:
@@ -530,6 +642,8 @@ class CommandWrapper:
         cmd = self._cmd.encode(data)
         self._serial.raw_send(cmd, minclock, reqclock, self._cmd_queue)
 
+DICTIONARY_CACHE_DIR = "~/.cache/klipper/mcu_dicts"
+
 class MCU:
     error = error
     def __init__(self, config, clocksync):
@@ -541,7 +655,11 @@ class MCU:
             self._name = self._name[4:]
         # Serial port
         wp = "mcu '%s': " % (self._name)
-        self._serial = serialhdl.SerialReader(self._reactor, warn_prefix=wp)
+        dict_cache = None
+        if config.getboolean('dictionary_cache', True):
+            dict_cache = DICTIONARY_CACHE_DIR
+        self._serial = serialhdl.SerialReader(self._reactor, warn_prefix=wp,
+                                              dict_cache=dict_cache)
         self._baud = 0
         self._canbus_iface = None
         canbus_uuid = config.get('canbus_uuid', None)
@@ -588,10 +706,8 @@ class MCU:
         self._mcu_tick_avg = 0.
         self._mcu_tick_stddev = 0.
         self._mcu_tick_awake = 0.
-        # Register handlers
-        printer.register_event_handler("klippy:connect", self._connect)
-        printer.register_event_handler("klippy:mcu_identify",
-                                       self._mcu_identify)
+        self._connect_times = []
+        # Register handlers (connection is handled by MCUConnectHelper)
         printer.register_event_handler("klippy:shutdown", self._shutdown)
         printer.register_event_handler("klippy:disconnect", self._disconnect)
     # Serial callbacks
@@ -698,20 +814,14 @@ class MCU:
         if prev_crc is not None and config_crc != prev_crc:
             self._check_restart("CRC mismatch")
             raise error("""{"code": "key296", "msg": "MCU '%s' CRC does not match config", "values":["%s"]}""" % (self._name, self._name))
-        # Transmit config messages (if needed)
-        self.register_response(self._handle_starting, 'starting')
+        # Encode all config messages before transmitting any of them
+        if prev_crc is None:
+            cmdlist = self._config_cmds + self._init_cmds
+        else:
+            cmdlist = self._restart_cmds + self._init_cmds
+        msgparser = self._serial.get_msgparser()
         try:
-            if prev_crc is None:
-                logging.info("Sending MCU '%s' printer configuration...",
-                             self._name)
-                for c in self._config_cmds:
-                    self._serial.send(c)
-            else:
-                for c in self._restart_cmds:
-                    self._serial.send(c)
-            # Transmit init messages
-            for c in self._init_cmds:
-                self._serial.send(c)
+            cmds = [msgparser.create_command(c) for c in cmdlist]
         except msgproto.enumeration_error as e:
             enum_name, enum_value = e.get_enum_params()
             if enum_name == 'pin':
@@ -720,6 +830,14 @@ class MCU:
                     """{"code": "key297", "msg": "Pin '%s' is not a valid pin name on mcu '%s'", "values":["%s", "%s"]}"""
                     % (enum_value, self._name, enum_value, self._name))
             raise
+        # Transmit config messages (the serial queue pipelines the blocks)
+        self.register_response(self._handle_starting, 'starting')
+        if prev_crc is None:
+            logging.info("Sending MCU '%s' printer configuration"
+                         " (%d commands)...", self._name, len(cmds))
+        cmd_queue = self._serial.get_default_command_queue()
+        for cmd in cmds:
+            self._serial.raw_send(cmd, 0, 0, cmd_queue)
     def _send_get_config(self):
         get_config_cmd = self.lookup_query_command(
             "get_config",
@@ -778,7 +896,12 @@ class MCU:
         logging.info(move_msg)
         log_info = self._log_info() + "\n" + move_msg
         self._printer.set_rollover_info(self._name, log_info, log=False)
-    def _mcu_identify(self):
+    def _note_connect_time(self, phase, phase_time):
+        self._connect_times.append((phase, phase_time))
+    def _log_connect_times(self):
+        logging.info("MCU '%s' startup timing: %s", self._name, " ".join(
+            ["%s=%.3f" % (phase, t) for phase, t in self._connect_times]))
+    def _connect_serial(self):
         if self.is_fileoutput():
             self._connect_file()
         else:
@@ -799,9 +922,16 @@ class MCU:
                     self._serial.connect_uart(self._serialport, self._baud, rts)
                 else:
                     self._serial.connect_pipe(self._serialport)
-                self._clocksync.connect(self._serial)
             except serialhdl.error as e:
                 raise error(str(e))
+    def _connect_clock(self):
+        if self.is_fileoutput():
+            return
+        try:
+            self._clocksync.connect(self._serial)
+        except serialhdl.error as e:
+            raise error(str(e))
+    def _mcu_identify(self):
         logging.info(self._log_info())
         ppins = self._printer.lookup_object('pins')
         pin_resolver = ppins.get_pin_resolver(self._name)
@@ -872,6 +1002,9 @@ class MCU:
                              cq=None, is_async=False):
         return CommandQueryWrapper(self._serial, msgformat, respformat, oid,
                                    cq, is_async, self._printer.command_error)
+    def create_query_batch(self):
+        return CommandQueryBatch(self._serial, self.is_fileoutput(),
+                                 self._printer.command_error)
     def try_lookup_command(self, msgformat):
         try:
             return self.lookup_command(msgformat)
@@ -1015,14 +1148,70 @@ def error_help(msg):
                 return help_msg
     return ""
 
+# Connect and configure all micro-controllers, with the slow
+# communication phases of the mcus running concurrently
+class MCUConnectHelper:
+    def __init__(self, printer, mcus):
+        self.printer = printer
+        self.reactor = printer.get_reactor()
+        self.mcus = mcus
+        printer.register_event_handler("klippy:mcu_identify",
+                                       self._mcu_identify)
+        printer.register_event_handler("klippy:connect", self._connect)
+    def _run_phase(self, phase, mcus, method):
+        def run_mcu(mcu, eventtime):
+            start_time = self.reactor.monotonic()
+            try:
+                method(mcu)
+            except Exception as e:
+                if not isinstance(e, (error, self.printer.config_error)):
+                    logging.exception("Error during mcu %s", phase)
+                return e
+            finally:
+                mcu._note_connect_time(phase,
+                                       self.reactor.monotonic() - start_time)
+            return None
+        if len(mcus) == 1:
+            # Avoid greenlet switching (and keep tracebacks) for single mcu
+            mcu = mcus[0]
+            start_time = self.reactor.monotonic()
+            try:
+                method(mcu)
+            finally:
+                mcu._note_connect_time(phase,
+                                       self.reactor.monotonic() - start_time)
+            return
+        completions = [self.reactor.register_callback(
+                           (lambda e, m=mcu: run_mcu(m, e)))
+                       for mcu in mcus]
+        # Wait for all mcus before reporting the first error
+        errors = [c.wait() for c in completions]
+        for e in errors:
+            if e is not None:
+                raise e
+    def _mcu_identify(self):
+        self._run_phase("identify", self.mcus, MCU._connect_serial)
+        # Secondary mcu clocks are synchronized to the main mcu clock
+        self._run_phase("clock", self.mcus[:1], MCU._connect_clock)
+        if len(self.mcus) > 1:
+            self._run_phase("clock", self.mcus[1:], MCU._connect_clock)
+        for mcu in self.mcus:
+            mcu._mcu_identify()
+    def _connect(self):
+        self._run_phase("config", self.mcus, MCU._connect)
+        for mcu in self.mcus:
+            mcu._log_connect_times()
+
 def add_printer_objects(config):
     printer = config.get_printer()
     reactor = printer.get_reactor()
     mainsync = clocksync.ClockSync(reactor)
-    printer.add_object('mcu', MCU(config.getsection('mcu'), mainsync))
+    mcus = [MCU(config.getsection('mcu'), mainsync)]
+    printer.add_object('mcu', mcus[0])
     for s in config.get_prefix_sections('mcu '):
-        printer.add_object(s.section, MCU(
-            s, clocksync.SecondarySync(reactor, mainsync)))
+        mcus.append(MCU(s, clocksync.SecondarySync(reactor, mainsync)))
+        printer.add_object(s.section, mcus[-1])
+    MCUConnectHelper(printer, mcus)
 
 def get_printer_mcu(printer, name):
     if name == 'mcu':
@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, threading, os
+import logging, threading, os, hashlib, zlib
 import serial
 
 import msgproto, chelper, util
@@ -11,11 +11,16 @@ import msgproto, chelper, util
 class error(Exception):
     pass
 
+IDENTIFY_CHUNK = 40
+
 class SerialReader:
     BITS_PER_BYTE = 10.
-    def __init__(self, reactor, warn_prefix=""):
+    def __init__(self, reactor, warn_prefix="", dict_cache=None):
         self.reactor = reactor
         self.warn_prefix = warn_prefix
+        self.dict_cache = None
+        if dict_cache is not None:
+            self.dict_cache = DictionaryCache(dict_cache, warn_prefix)
         # Serial port
         self.serial_dev = None
         self.msgparser = msgproto.MessageParser(warn_prefix=warn_prefix)
@@ -61,23 +66,47 @@ class SerialReader:
                                   self.warn_prefix)
     def _error(self, msg, *params):
         raise error(self.warn_prefix + (msg % params))
+    def _get_identify_chunk(self, offset, count=IDENTIFY_CHUNK):
+        while 1:
+            msg = "identify offset=%d count=%d" % (offset, count)
+            params = self.send_with_response(msg, 'identify_response')
+            if params['offset'] == offset:
+                return params['data']
+    def _check_cached_identify(self, first_chunk):
+        # Confirm a cached dictionary by checking the end of the mcu's
+        # dictionary (the zlib trailer contains a checksum of the content)
+        cached_data = self.dict_cache.lookup(first_chunk)
+        if cached_data is None:
+            return None
+        tail_offset = max(0, len(cached_data) - IDENTIFY_CHUNK)
+        if (self._get_identify_chunk(tail_offset) != cached_data[tail_offset:]
+            or self._get_identify_chunk(len(cached_data))):
+            logging.info("%sCached data dictionary does not match mcu",
+                         self.warn_prefix)
+            return None
+        logging.info("%sUsing cached data dictionary (%d bytes)",
+                     self.warn_prefix, len(cached_data))
+        return cached_data
     def _get_identify_data(self, eventtime):
         # Query the "data dictionary" from the micro-controller
-        identify_data = b""
-        while 1:
-            msg = "identify offset=%d count=%d" % (len(identify_data), 40)
-            try:
-                params = self.send_with_response(msg, 'identify_response')
-            except error as e:
-                logging.exception("%sWait for identify_response",
-                                  self.warn_prefix)
-                return None
-            if params['offset'] == len(identify_data):
-                msgdata = params['data']
+        try:
+            identify_data = self._get_identify_chunk(0)
+            if self.dict_cache is not None and identify_data:
+                cached_data = self._check_cached_identify(identify_data)
+                if cached_data is not None:
+                    return cached_data
+            while 1:
+                msgdata = self._get_identify_chunk(len(identify_data))
                 if not msgdata:
-                    # Done
-                    return identify_data
+                    break
                 identify_data += msgdata
+        except error as e:
+            logging.exception("%sWait for identify_response",
+                              self.warn_prefix)
+            return None
+        if self.dict_cache is not None:
+            self.dict_cache.store(identify_data)
+        return identify_data
     def _start_session(self, serial_dev, serial_fd_type=b'u', client_id=0):
         self.serial_dev = serial_dev
         self.serialqueue = self.ffi_main.gc(
@@ -298,6 +327,43 @@ class SerialReader:
     def handle_default(self, params):
         logging.warn("%sgot %s", self.warn_prefix, params)
 
+# Host side storage of mcu data dictionaries (indexed by the first
+# block of the compressed dictionary)
+class DictionaryCache:
+    def __init__(self, dirname, warn_prefix=""):
+        self.dirname = os.path.expanduser(dirname)
+        self.warn_prefix = warn_prefix
+    def _get_filename(self, first_chunk):
+        fp = hashlib.sha1(first_chunk).hexdigest()
+        return os.path.join(self.dirname, "dict-%s.zlib" % (fp,))
+    def lookup(self, first_chunk):
+        try:
+            f = open(self._get_filename(first_chunk), 'rb')
+            data = f.read()
+            f.close()
+            # Decompressing validates the stored content
+            zlib.decompress(data)
+        except (IOError, OSError, zlib.error) as e:
+            return None
+        if not data.startswith(first_chunk):
+            return None
+        return data
+    def store(self, data):
+        if not data:
+            return
+        filename = self._get_filename(data[:IDENTIFY_CHUNK])
+        temp_name = filename + ".tmp"
+        try:
+            if not os.path.isdir(self.dirname):
+                os.makedirs(self.dirname)
+            f = open(temp_name, 'wb')
+            f.write(data)
+            f.close()
+            os.rename(temp_name, filename)
+        except (IOError, OSError) as e:
+            logging.warn("%sUnable to store data dictionary: %s",
+                         self.warn_prefix, e)
+
 # Class to send a query command and return the received response
 class SerialRetryCommand:
     def __init__(self, serial, name, oid=None):
@@ -328,6 +394,91 @@ class SerialRetryCommand:
             retries -= 1
             retry_delay *= 2.
 
+# Class to send several query commands and wait for all of the responses.
+# Responses are matched to queries by response name and oid, and in
+# order of transmission for queries sharing the same name and oid.
+class SerialBatchCommand:
+    TIMEOUT_TIME = 5.0
+    RETRY_TIME = 0.500
+    def __init__(self, serial):
+        self.serial = serial
+        self.reactor = serial.get_reactor()
+        self.queries = []
+        self.responses = []
+        self.key_queries = {}
+        self.pending = {}
+        self.pending_count = 0
+        self.completion = self.reactor.completion()
+        self.min_query_times = {}
+    def add_query(self, cmd, name, oid=None, cmd_queue=None,
+                  minclock=0, reqclock=0):
+        if cmd_queue is None:
+            cmd_queue = self.serial.get_default_command_queue()
+        self.queries.append((cmd, (name, oid), cmd_queue, minclock, reqclock))
+        return len(self.queries) - 1
+    def handle_callback(self, params):
+        key = (params['#name'], params.get('oid'))
+        if params['#sent_time'] < self.min_query_times.get(key,
+                                                           self.reactor.NEVER):
+            return
+        pending = self.pending.get(key)
+        if not pending:
+            return
+        self.responses[pending.pop(0)] = params
+        self.pending_count -= 1
+        if not self.pending_count:
+            self.min_query_times.clear()
+            self.reactor.async_complete(self.completion, True)
+    def _send_pending(self, query_time):
+        with self.serial.lock:
+            # A lost response would shift the order based matching of
+            # all later responses with the same key, so every query
+            # sharing that key is sent again and earlier replies ignored
+            for key, pending in self.pending.items():
+                if not pending:
+                    continue
+                indexes = self.key_queries[key]
+                self.pending_count += len(indexes) - len(pending)
+                self.pending[key] = list(indexes)
+                self.min_query_times[key] = query_time
+            indexes = sorted([i for p in self.pending.values() for i in p])
+        for pos, i in enumerate(indexes):
+            cmd, key, cmd_queue, minclock, reqclock = self.queries[i]
+            if pos == len(indexes) - 1:
+                self.serial.raw_send_wait_ack(cmd, minclock, reqclock,
+                                              cmd_queue)
+            else:
+                self.serial.raw_send(cmd, minclock, reqclock, cmd_queue)
+    def get_responses(self):
+        if not self.queries:
+            return []
+        self.responses = [None] * len(self.queries)
+        for i, (cmd, key, cmd_queue, minclock, reqclock) in enumerate(
+                self.queries):
+            self.key_queries.setdefault(key, []).append(i)
+        self.pending = {key: list(indexes)
+                        for key, indexes in self.key_queries.items()}
+        self.pending_count = len(self.queries)
+        for name, oid in self.key_queries:
+            self.serial.register_response(self.handle_callback, name, oid)
+        try:
+            self._send_pending(self.reactor.monotonic())
+            first_query_time = query_time = self.reactor.monotonic()
+            while 1:
+                if self.completion.wait(query_time + self.RETRY_TIME):
+                    return self.responses
+                query_time = self.reactor.monotonic()
+                if query_time > first_query_time + self.TIMEOUT_TIME:
+                    with self.serial.lock:
+                        names = sorted(set([name for (name, oid), p
+                                            in self.pending.items() if p]))
+                    raise error("Timeout on wait for '%s' response"
+                                % ("', '".join(names),))
+                self._send_pending(query_time)
+        finally:
+            for name, oid in self.key_queries:
+                self.serial.register_response(None, name, oid)
+
 # Attempt to place an AVR stk500v2 style programmer into normal mode
 def stk500v2_leave(ser, reactor):
     logging.debug("Starting stk500v2 leave programmer sequence")
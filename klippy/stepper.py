@@ -156,7 +156,7 @@ class MCU_stepper:
         self.set_trapq(self._trapq)
         self._set_mcu_position(mcu_pos)
         return old_sk
-    def note_homing_end(self):
+    def note_homing_end(self, batches=None):
         ffi_main, ffi_lib = chelper.get_ffi()
         ret = ffi_lib.stepcompress_reset(self._stepqueue, 0)
         if ret:
@@ -165,11 +165,24 @@ class MCU_stepper:
         ret = ffi_lib.stepcompress_queue_msg(self._stepqueue, data, len(data))
         if ret:
             raise error("Internal error in stepcompress")
-        self._query_mcu_position()
+        if batches is None:
+            self._query_mcu_position()
+            return None
+        # Queue the position query - the returned function applies it
+        # once the batch has been sent
+        batch = batches.get_batch(self._mcu)
+        index = batch.add_query(self._get_position_cmd, [self._oid])
+        def sync_position():
+            params = batch.get_response(index)
+            if params is not None:
+                self._sync_mcu_position(params)
+        return sync_position
     def _query_mcu_position(self):
         if self._mcu.is_fileoutput():
             return
         params = self._get_position_cmd.send([self._oid])
+        self._sync_mcu_position(params)
+    def _sync_mcu_position(self, params):
         last_pos = params['pos']
         if self._invert_dir:
             last_pos = -last_pos
@@ -211,6 +211,10 @@ class ClientConnection:
     def is_closed(self):
         return self.fd_handle is None
 
+    def get_pending_bytes(self):
+        # Amount of data queued but not yet sent to the client
+        return len(self.send_buffer)
+
     def process_received(self, eventtime):
         try:
             data = self.sock.recv(4096)
@@ -258,6 +262,10 @@ class ClientConnection:
 
     def send(self, data):
         jmsg = json.dumps(data, separators=(',', ':'))
+        self.send_encoded(jmsg)
+
+    def send_encoded(self, jmsg):
+        # Send an already json encoded message
         self.send_buffer += jmsg.encode() + b"\x03"
         if not self.is_sending_data:
             self.is_sending_data = True
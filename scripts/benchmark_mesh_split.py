@@ -0,0 +1,106 @@
+#!/usr/bin/env python2
+# Compare bed_mesh move splitting methods
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+from __future__ import print_function
+import importlib, optparse, os, sys, math, random, time
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+bed_mesh = importlib.import_module('.bed_mesh', 'extras')
+
+# Minimal config wrapper providing the options used by the splitters
+class BenchConfig:
+    def __init__(self, options):
+        self.options = options
+    def getfloat(self, option, default, minval=None):
+        return self.options.get(option, default)
+
+def build_mesh(options):
+    count = options.probe_count
+    params = {
+        'min_x': 10., 'max_x': 10. + options.size,
+        'min_y': 10., 'max_y': 10. + options.size,
+        'x_count': count, 'y_count': count,
+        'mesh_x_pps': options.mesh_pps, 'mesh_y_pps': options.mesh_pps,
+        'algo': options.algo, 'tension': .2}
+    # Synthetic warped bed: a bowl with some ripple
+    z_matrix = []
+    for j in range(count):
+        row = []
+        for i in range(count):
+            u = 2. * i / (count - 1) - 1.
+            v = 2. * j / (count - 1) - 1.
+            row.append(.15 * (u*u + v*v) + .05 * math.sin(3. * u + 2. * v))
+        z_matrix.append(row)
+    mesh = bed_mesh.ZMesh(params)
+    mesh.build_mesh(z_matrix)
+    return mesh
+
+def gen_moves(options):
+    random.seed(options.seed)
+    lo, hi = 0., options.size + 20.
+    pos = [lo, lo, .2, 0.]
+    moves = []
+    for i in range(options.moves):
+        npos = [random.uniform(lo, hi), random.uniform(lo, hi), .2,
+                pos[3] + 1.]
+        moves.append((pos, npos))
+        pos = npos
+    return moves
+
+# Maximum difference between the split path and the mesh along the move
+def calc_max_error(mesh, start, splits):
+    max_err = 0.
+    prev = start[:2] + [start[2] + mesh.calc_z(start[0], start[1])]
+    for pos in splits:
+        for k in range(1, 20):
+            t = k / 20.
+            x = bed_mesh.lerp(t, prev[0], pos[0])
+            y = bed_mesh.lerp(t, prev[1], pos[1])
+            z = bed_mesh.lerp(t, prev[2], pos[2]) - start[2]
+            max_err = max(max_err, abs(z - mesh.calc_z(x, y)))
+        prev = pos
+    return max_err
+
+def run_splitter(name, splitter, mesh, moves):
+    splitter.initialize(mesh, 0.)
+    start_time = time.time()
+    results = [splitter.split_move(start, end, 1.) for start, end in moves]
+    duration = time.time() - start_time
+    segments = sum([len(r) for r in results])
+    max_err = max([calc_max_error(mesh, start, r)
+                   for (start, end), r in zip(moves, results)])
+    print("%-10s segments=%-8d cpu=%.3fs max_error=%.4fmm"
+          % (name, segments, duration, max_err))
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--probe_count", type="int", default=5,
+                    help="number of probe points per axis")
+    opts.add_option("-p", "--mesh_pps", type="int", default=2,
+                    help="interpolated points per mesh segment")
+    opts.add_option("-a", "--algo", type="string", default="bicubic",
+                    help="mesh interpolation algorithm")
+    opts.add_option("-s", "--size", type="float", default=200.,
+                    help="size of the meshed area")
+    opts.add_option("-n", "--moves", type="int", default=2000,
+                    help="number of random moves")
+    opts.add_option("--seed", type="int", default=0,
+                    help="random seed")
+    opts.add_option("--split_delta_z", type="float", default=.025,
+                    help="split_delta_z setting")
+    opts.add_option("--move_check_distance", type="float", default=5.,
+                    help="move_check_distance setting")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    config = BenchConfig({'split_delta_z': options.split_delta_z,
+                          'move_check_distance': options.move_check_distance})
+    mesh = build_mesh(options)
+    moves = gen_moves(options)
+    run_splitter("distance", bed_mesh.MoveSplitter(config, None), mesh, moves)
+    run_splitter("cell", bed_mesh.CellMoveSplitter(config, None), mesh, moves)
+
+if __name__ == '__main__':
+    main()
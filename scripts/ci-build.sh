@@ -79,3 +79,8 @@ finish_test klippy "Test invoke klippy (Python3)"
 start_test klippy "Test invoke klippy (Python2)"
 $PYTHON2 scripts/test_klippy.py -d ${DICTDIR} test/klippy/*.test
 finish_test klippy "Test invoke klippy (Python2)"
+
+start_test klippy "Test MPC model fit"
+$PYTHON2 scripts/mpc_fit.py -p 40 test/mpc/extruder_stats.log \
+    | diff -u test/mpc/extruder_stats.expected -
+finish_test klippy "Test MPC model fit"
@@ -50,6 +50,31 @@ def parse_log(logname, mcu):
     f.close()
     return out
 
+# Load the stats from the logindex.py column file (building it if needed)
+def parse_log_index(logname, mcu):
+    import logindex
+    if mcu is None:
+        mcu = "mcu"
+    mcu_prefix = mcu + ":"
+    index = logindex.load_index(logname)
+    names = index.get_stats_columns()
+    if 'print_time' not in names:
+        return []
+    columns = []
+    for name in names:
+        key = name
+        if key.startswith(mcu_prefix):
+            key = key[len(mcu_prefix):]
+        columns.append((key, index.get_stats_column(name)))
+    print_times = index.get_stats_column('print_time')
+    out = []
+    for i, pt in enumerate(print_times):
+        if pt != pt:
+            continue
+        out.append({ key: col[i] for key, col in columns
+                     if col[i] == col[i] and key != '#offset' })
+    return out
+
 def setup_matplotlib(output_to_file):
     global matplotlib
     if output_to_file:
@@ -267,13 +292,18 @@ def main():
                     default=None, help="graph heater temperature")
     opts.add_option("-m", "--mcu", type="string", dest="mcu", default=None,
                     help="limit stats to the given mcu")
+    opts.add_option("-i", "--index", action="store_true",
+                    help="read stats from a logindex.py index of the log")
     options, args = opts.parse_args()
     if len(args) != 1:
         opts.error("Incorrect number of arguments")
     logname = args[0]
 
     # Parse data
-    data = parse_log(logname, options.mcu)
+    if options.index:
+        data = parse_log_index(logname, options.mcu)
+    else:
+        data = parse_log(logname, options.mcu)
     if not data:
         return
 
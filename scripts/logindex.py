@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# Build an on-disk index of a klippy.log file for fast queries
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+from __future__ import print_function
+import sys, os, optparse, json, array, collections
+
+INDEX_VERSION = 1
+CONTEXT_LINES = 200
+
+# Stats names that are qualified with the preceding "prefix:" field
+APPLY_PREFIX = [
+    'mcu_awake', 'mcu_task_avg', 'mcu_task_stddev', 'bytes_write',
+    'bytes_read', 'bytes_retransmit', 'freq', 'adj',
+    'target', 'temp', 'pwm'
+]
+
+class error(Exception):
+    pass
+
+
+######################################################################
+# Index generation
+######################################################################
+
+# Store the "Stats" lines as columns of doubles (missing values are NaN)
+class StatsColumns:
+    def __init__(self):
+        self.apply_prefix = { p: 1 for p in APPLY_PREFIX }
+        self.rows = 0
+        self.columns = collections.OrderedDict()
+        self.add_column('#sampletime')
+        self.add_column('#offset')
+    def add_column(self, name):
+        col = array.array('d', [float('nan')]) * self.rows
+        self.columns[name] = col
+        return col
+    def add_line(self, offset, parts):
+        vals = {'#sampletime': float(parts[1][:-1]), '#offset': offset}
+        prefix = ""
+        for p in parts[2:]:
+            if '=' not in p:
+                prefix = p
+                continue
+            name, val = p.split('=', 1)
+            if name in self.apply_prefix:
+                name = prefix + name
+            try:
+                vals[name] = float(val)
+            except ValueError:
+                continue
+        nan = float('nan')
+        for name, col in self.columns.items():
+            col.append(vals.pop(name, nan))
+        for name in sorted(vals):
+            self.add_column(name).append(vals[name])
+        self.rows += 1
+    def write_file(self, filename):
+        f = open(filename, 'wb')
+        for col in self.columns.values():
+            col.tofile(f)
+        f.close()
+        return {'rows': self.rows, 'columns': list(self.columns.keys())}
+
+def build_index(logname):
+    info = {'version': INDEX_VERSION, 'starts': [], 'configs': [],
+            'shutdowns': [], 'gcode_states': []}
+    stats = StatsColumns()
+    recent = collections.deque([], CONTEXT_LINES)
+    config = shutdown = None
+    last_stat_time = None
+    offset = 0
+    f = open(logname, 'rb')
+    for line_num, line in enumerate(f):
+        line_num += 1
+        line_offset = offset
+        offset += len(line)
+        if not isinstance(line, str):
+            line = line.decode('utf-8', 'replace')
+        line = line.rstrip()
+        recent.append((line_num, line_offset))
+        if line.startswith('Stats ') or line.startswith('INFO:root:Stats '):
+            parts = line.split()
+            try:
+                stats.add_line(line_offset, parts)
+            except (ValueError, IndexError):
+                continue
+            last_stat_time = float(parts[1][:-1])
+            if shutdown is not None:
+                # Same termination rule as logextract.py
+                if shutdown['#first_stat'] is None:
+                    shutdown['#first_stat'] = last_stat_time
+                elif last_stat_time > shutdown['#first_stat'] + 5.:
+                    shutdown['end'] = offset
+                    del shutdown['#first_stat']
+                    shutdown = None
+            continue
+        if config is not None:
+            if line == '=======================':
+                config['end'] = line_offset
+                config = None
+            continue
+        is_start = (line.startswith('Git version')
+                    or line.startswith('Start printer at'))
+        if shutdown is not None and (
+                is_start or line == '===== Config file ====='):
+            shutdown['end'] = line_offset
+            del shutdown['#first_stat']
+            shutdown = None
+        if is_start:
+            info['starts'].append({'line': line_num, 'offset': line_offset,
+                                   'text': line})
+        elif line == '===== Config file =====':
+            config = {'line': line_num, 'offset': offset, 'end': offset}
+            info['configs'].append(config)
+        elif line.startswith('gcode state: '):
+            info['gcode_states'].append({'line': line_num,
+                                         'offset': line_offset})
+        elif shutdown is None and ('shutdown: ' in line
+                                   or line.startswith('Dumping ')):
+            context_line, context_offset = recent[0]
+            shutdown = {'line': line_num, 'offset': line_offset,
+                        'context_line': context_line,
+                        'context_offset': context_offset,
+                        'end': None, 'text': line,
+                        '#first_stat': last_stat_time}
+            info['shutdowns'].append(shutdown)
+    f.close()
+    if shutdown is not None:
+        shutdown['end'] = offset
+        del shutdown['#first_stat']
+    info['stats'] = stats.write_file(logname + '.stats')
+    st = os.stat(logname)
+    info['size'] = st.st_size
+    info['mtime'] = st.st_mtime
+    f = open(logname + '.index', 'w')
+    json.dump(info, f, indent=1)
+    f.close()
+    return info
+
+
+######################################################################
+# Index queries
+######################################################################
+
+class LogIndex:
+    def __init__(self, logname, info):
+        self.logname = logname
+        self.info = info
+    def get_stats_columns(self):
+        return self.info['stats']['columns']
+    def get_stats_column(self, name):
+        stats = self.info['stats']
+        columns = stats['columns']
+        if name not in columns:
+            raise error("Unknown stats column '%s'" % (name,))
+        rows = stats['rows']
+        col = array.array('d')
+        f = open(self.logname + '.stats', 'rb')
+        f.seek(columns.index(name) * rows * col.itemsize)
+        col.fromfile(f, rows)
+        f.close()
+        return col
+    def read_lines(self, offset, end, line_num=None):
+        f = open(self.logname, 'rb')
+        f.seek(offset)
+        out = []
+        while offset < end:
+            line = f.readline()
+            if not line:
+                break
+            offset += len(line)
+            if not isinstance(line, str):
+                line = line.decode('utf-8', 'replace')
+            if line_num is None:
+                out.append(line.rstrip())
+            else:
+                out.append((line_num, line.rstrip()))
+                line_num += 1
+        f.close()
+        return out
+
+# Open the index for a log file, (re)building it if it is out of date
+def load_index(logname, rebuild=False):
+    st = os.stat(logname)
+    info = None
+    if not rebuild:
+        try:
+            f = open(logname + '.index', 'r')
+            info = json.load(f)
+            f.close()
+        except (IOError, ValueError):
+            info = None
+    if (info is None or info.get('version') != INDEX_VERSION
+        or info.get('size') != st.st_size or info.get('mtime') != st.st_mtime
+        or not os.path.exists(logname + '.stats')):
+        info = build_index(logname)
+    return LogIndex(logname, info)
+
+
+######################################################################
+# Command handlers
+######################################################################
+
+def show_summary(index):
+    info = index.info
+    for start in info['starts']:
+        print("# %6d: %s" % (start['line'], start['text']))
+    for i, config in enumerate(info['configs']):
+        print("config %d: line %d" % (i + 1, config['line']))
+    for i, shutdown in enumerate(info['shutdowns']):
+        print("shutdown %d: line %d: %s" % (i + 1, shutdown['line'],
+                                            shutdown['text']))
+    print("gcode state blocks: %d" % (len(info['gcode_states']),))
+    stats = info['stats']
+    if stats['rows']:
+        times = index.get_stats_column('#sampletime')
+        print("stats: %d samples from %.3f to %.3f (%d columns)" % (
+            stats['rows'], times[0], times[-1], len(stats['columns'])))
+
+def show_stats(index, names, start_time, end_time):
+    times = index.get_stats_column('#sampletime')
+    cols = [index.get_stats_column(name) for name in names]
+    print("#sampletime " + " ".join(names))
+    for i, st in enumerate(times):
+        if st < start_time or st > end_time:
+            continue
+        print("%.3f %s" % (st, " ".join(["%.6g" % (c[i],) for c in cols])))
+
+def get_entry(index, kind, num):
+    entries = index.info[kind]
+    if num < 1 or num > len(entries):
+        raise error("Invalid %s number %d" % (kind[:-1], num))
+    return entries[num - 1]
+
+def show_config(index, num):
+    config = get_entry(index, 'configs', num)
+    for line in index.read_lines(config['offset'], config['end']):
+        print(line)
+
+def extract_shutdown(index, num):
+    # Reuse the logextract.py shutdown processing on just this region
+    import logextract
+    shutdown = get_entry(index, 'shutdowns', num)
+    lines = index.read_lines(shutdown['context_offset'], shutdown['end'],
+                             shutdown['context_line'])
+    recent_lines = collections.deque([], CONTEXT_LINES)
+    handler = None
+    for line_num, line in lines:
+        if handler is None:
+            recent_lines.append((line_num, line))
+            if line_num == shutdown['line']:
+                handler = logextract.GatherShutdown(
+                    {}, line_num, recent_lines, index.logname)
+                for prefix in ['Git version', 'Start printer at']:
+                    starts = [s for s in index.info['starts']
+                              if s['line'] < line_num
+                              and s['text'].startswith(prefix)]
+                    if starts:
+                        handler.add_comment(logextract.format_comment(
+                            starts[-1]['line'], starts[-1]['text']))
+            continue
+        if not handler.add_line(line_num, line):
+            break
+    else:
+        if handler is not None:
+            handler.finalize()
+    if handler is None or not os.path.exists(handler.filename):
+        raise error("No serial dump found for shutdown %d" % (num,))
+    print("Wrote %s" % (handler.filename,))
+
+
+######################################################################
+# Startup
+######################################################################
+
+def main():
+    usage = ("%prog [options] <logfile> [summary | stats <names> |"
+             " config <num> | shutdown <num>]")
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-r", "--rebuild", action="store_true",
+                    help="rebuild the index even if it is up to date")
+    opts.add_option("-s", "--start", type="float", default=float('-inf'),
+                    help="ignore stats before this log time")
+    opts.add_option("-e", "--end", type="float", default=float('inf'),
+                    help="ignore stats after this log time")
+    options, args = opts.parse_args()
+    if len(args) < 1:
+        opts.error("Incorrect number of arguments")
+    logname = args[0]
+    cmd = 'summary'
+    if len(args) > 1:
+        cmd = args[1]
+    index = load_index(logname, options.rebuild)
+    try:
+        if cmd == 'summary' and len(args) <= 2:
+            show_summary(index)
+        elif cmd == 'stats' and len(args) == 2:
+            print(" ".join(index.get_stats_columns()))
+        elif cmd == 'stats' and len(args) == 3:
+            show_stats(index, args[2].split(','), options.start, options.end)
+        elif cmd == 'config' and len(args) == 3:
+            show_config(index, int(args[2]))
+        elif cmd == 'shutdown' and len(args) == 3:
+            extract_shutdown(index, int(args[2]))
+        else:
+            opts.error("Invalid command")
+    except error as e:
+        sys.stderr.write("%s\n" % (str(e),))
+        sys.exit(-1)
+
+if __name__ == '__main__':
+    main()
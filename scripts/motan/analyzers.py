@@ -4,6 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import math, collections
+import numpy
 import readlog
 
 
@@ -40,10 +41,9 @@ class GenDerivative:
         return {'label': lname, 'units': units}
     def generate_data(self):
         inv_seg_time = 1. / self.amanager.get_segment_time()
-        data = self.amanager.get_datasets()[self.source]
-        deriv = [(data[i+1] - data[i]) * inv_seg_time
-                 for i in range(len(data)-1)]
-        return [deriv[0]] + deriv
+        data = self.amanager.get_dataset(self.source)
+        deriv = numpy.diff(data) * inv_seg_time
+        return numpy.concatenate((deriv[:1], deriv))
 AHandlers["derivative"] = GenDerivative
 
 # Calculate an integral (accel to velocity, or velocity to position)
@@ -84,25 +84,24 @@ class GenIntegral:
         return {'label': lname, 'units': units}
     def generate_data(self):
         seg_time = self.amanager.get_segment_time()
-        src = self.amanager.get_datasets()[self.source]
-        offset = sum(src) / len(src)
-        total = 0.
-        ref = None
-        if self.ref is not None:
-            ref = self.amanager.get_datasets()[self.ref]
-            offset -= (ref[-1] - ref[0]) / (len(src) * seg_time)
-            total = ref[0]
-            src_weight = 1.
-            if self.half_life:
-                src_weight = math.exp(math.log(.5) * seg_time / self.half_life)
-            ref_weight = 1. - src_weight
-        data = [0.] * len(src)
-        for i, v in enumerate(src):
-            total += (v - offset) * seg_time
-            if ref is not None:
-                total = src_weight * total + ref_weight * ref[i]
+        src = self.amanager.get_dataset(self.source)
+        offset = numpy.mean(src)
+        if self.ref is None:
+            return numpy.cumsum((src - offset) * seg_time)
+        ref = self.amanager.get_dataset(self.ref)
+        offset -= (ref[-1] - ref[0]) / (len(src) * seg_time)
+        total = ref[0]
+        src_weight = 1.
+        if self.half_life:
+            src_weight = math.exp(math.log(.5) * seg_time / self.half_life)
+        ref_weight = 1. - src_weight
+        # Weighted integration is recursive - operate on native floats
+        deltas = ((src - offset) * seg_time).tolist()
+        data = [0.] * len(deltas)
+        for i, r in enumerate(ref.tolist()):
+            total = src_weight * (total + deltas[i]) + ref_weight * r
             data[i] = total
-        return data
+        return numpy.array(data)
 AHandlers["integral"] = GenIntegral
 
 # Calculate a kinematic stepper position from the toolhead requested position
@@ -137,17 +136,15 @@ class GenKinematicPosition:
     def get_label(self):
         return {'label': 'Position', 'units': 'Position\n(mm)'}
     def generate_data_corexy_plus(self):
-        datasets = self.amanager.get_datasets()
-        data1 = datasets[self.source1]
-        data2 = datasets[self.source2]
-        return [d1 + d2 for d1, d2 in zip(data1, data2)]
+        data1 = self.amanager.get_dataset(self.source1)
+        data2 = self.amanager.get_dataset(self.source2)
+        return data1 + data2
     def generate_data_corexy_minus(self):
-        datasets = self.amanager.get_datasets()
-        data1 = datasets[self.source1]
-        data2 = datasets[self.source2]
-        return [d1 - d2 for d1, d2 in zip(data1, data2)]
+        data1 = self.amanager.get_dataset(self.source1)
+        data2 = self.amanager.get_dataset(self.source2)
+        return data1 - data2
     def generate_data_passthrough(self):
-        return self.amanager.get_datasets()[self.source1]
+        return self.amanager.get_dataset(self.source1)
 AHandlers["kin"] = GenKinematicPosition
 
 # Calculate a toolhead x/y position from corexy stepper positions
@@ -170,12 +167,11 @@ class GenCorexyPosition:
         return {'label': 'Derived %s position' % (axis,),
                 'units': 'Position\n(mm)'}
     def generate_data(self):
-        datasets = self.amanager.get_datasets()
-        data1 = datasets[self.source1]
-        data2 = datasets[self.source2]
+        data1 = self.amanager.get_dataset(self.source1)
+        data2 = self.amanager.get_dataset(self.source2)
         if self.is_plus:
-            return [.5 * (d1 + d2) for d1, d2 in zip(data1, data2)]
-        return [.5 * (d1 - d2) for d1, d2 in zip(data1, data2)]
+            return .5 * (data1 + data2)
+        return .5 * (data1 - data2)
 AHandlers["corexy"] = GenCorexyPosition
 
 # Calculate a position deviation
@@ -198,10 +194,9 @@ class GenDeviation:
         units = '\n'.join([parts[0]] + ['Deviation'] + parts[1:])
         return {'label': label1['label'] + ' deviation', 'units': units}
     def generate_data(self):
-        datasets = self.amanager.get_datasets()
-        data1 = datasets[self.source1]
-        data2 = datasets[self.source2]
-        return [d1 - d2 for d1, d2 in zip(data1, data2)]
+        data1 = self.amanager.get_dataset(self.source1)
+        data2 = self.amanager.get_dataset(self.source2)
+        return data1 - data2
 AHandlers["deviation"] = GenDeviation
 
 
@@ -226,14 +221,21 @@ class AnalyzerManager:
         self.raw_datasets = collections.OrderedDict()
         self.gen_datasets = collections.OrderedDict()
         self.datasets = {}
-        self.dataset_times = []
+        self.dataset_times = None
         self.duration = 5.
     def set_duration(self, duration):
         self.duration = duration
     def get_segment_time(self):
         return self.segment_time
-    def get_datasets(self):
-        return self.datasets
+    def get_dataset(self, name):
+        # Generated datasets are only calculated on first use
+        data = self.datasets.get(name)
+        if data is None:
+            hdl = self.gen_datasets.get(name)
+            if hdl is None:
+                raise self.error("Unknown dataset '%s'" % (name,))
+            self.datasets[name] = data = hdl.generate_data()
+        return data
     def get_dataset_times(self):
         return self.dataset_times
     def get_initial_status(self):
@@ -257,7 +259,6 @@ class AnalyzerManager:
                 raise self.error("Invalid parameters to dataset '%s'" % (name,))
             hdl = cls(self, name_parts)
             self.gen_datasets[name] = hdl
-        self.datasets[name] = []
         return hdl
     def get_label(self, dataset):
         hdl = self.raw_datasets.get(dataset)
@@ -268,16 +269,15 @@ class AnalyzerManager:
         return hdl.get_label()
     def generate_datasets(self):
         # Generate raw data
-        list_hdls = [(self.datasets[name], hdl)
-                     for name, hdl in self.raw_datasets.items()]
         initial_start_time = self.lmanager.get_initial_start_time()
-        start_time = t = self.lmanager.get_start_time()
-        end_time = start_time + self.duration
-        while t < end_time:
-            t += self.segment_time
-            self.dataset_times.append(t - initial_start_time)
-            for dl, hdl in list_hdls:
-                dl.append(hdl.pull_data(t))
-        # Generate analyzer data
-        for name, hdl in self.gen_datasets.items():
-            self.datasets[name] = hdl.generate_data()
+        start_time = self.lmanager.get_start_time()
+        count = int(math.ceil(self.duration / self.segment_time))
+        times = start_time + self.segment_time * numpy.arange(1, count + 1)
+        self.dataset_times = times - initial_start_time
+        list_hdls = []
+        for name, hdl in self.raw_datasets.items():
+            self.datasets[name] = data = numpy.empty(count)
+            list_hdls.append((data, hdl.pull_data))
+        for pos, t in enumerate(times.tolist()):
+            for data, pull_data in list_hdls:
+                data[pos] = pull_data(t)
@@ -4,9 +4,12 @@
 # Copyright (C) 2020-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import sys, os, optparse, socket, select, json, errno, time, zlib
+import sys, os, optparse, socket, select, json, errno, time, zlib, struct
 
 INDEX_UPDATE_TIME = 5.0
+CHUNK_MAX_SIZE = 1024 * 1024
+CHUNK_MAGIC = b"MOTC"
+CHUNK_HEADER = struct.Struct("<4sII")
 ClientInfo = {'program': 'motan_data_logger', 'version': 'v0.1'}
 
 def webhook_socket_create(uds_filename):
@@ -52,15 +55,47 @@ class LogWriter:
         self.file = None
         self.comp = None
 
+# Write messages as a series of independently compressed chunks.  Each
+# chunk has a header containing its compressed and uncompressed size so
+# that readers may seek to any chunk and skip chunks without decoding.
+class ChunkLogWriter:
+    def __init__(self, filename):
+        self.file = open(filename, "wb")
+        self.pending = []
+        self.pending_size = self.file_pos = 0
+    def add_data(self, data):
+        self.pending.append(data + b"\x03")
+        self.pending_size += len(data) + 1
+        if self.pending_size >= CHUNK_MAX_SIZE:
+            self.flush()
+    def flush(self):
+        if not self.pending:
+            return self.file_pos
+        raw = b"".join(self.pending)
+        comp = zlib.compress(raw)
+        self.file.write(CHUNK_HEADER.pack(CHUNK_MAGIC, len(comp), len(raw)))
+        self.file.write(comp)
+        self.file_pos += CHUNK_HEADER.size + len(comp)
+        self.pending = []
+        self.pending_size = 0
+        return self.file_pos
+    def close(self):
+        self.flush()
+        self.file.close()
+        self.file = None
+
 class DataLogger:
-    def __init__(self, uds_filename, log_prefix):
+    def __init__(self, uds_filename, log_prefix, chunked=False):
         # IO
         self.webhook_socket = webhook_socket_create(uds_filename)
         self.poll = select.poll()
         self.poll.register(self.webhook_socket, select.POLLIN | select.POLLHUP)
         self.socket_data = b""
         # Data log
-        self.logger = LogWriter(log_prefix + ".json.gz")
+        if chunked:
+            self.logger = ChunkLogWriter(log_prefix + ".json.chunks")
+        else:
+            self.logger = LogWriter(log_prefix + ".json.gz")
         self.index = LogWriter(log_prefix + ".index.gz")
         # Handlers
         self.query_handlers = {}
@@ -188,12 +223,14 @@ def nice():
 def main():
     usage = "%prog [options] <socket filename> <log name>"
     opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--chunked", action="store_true",
+                    help="write a seekable chunked log (.json.chunks)")
     options, args = opts.parse_args()
     if len(args) != 2:
         opts.error("Incorrect number of arguments")
 
     nice()
-    dl = DataLogger(args[0], args[1])
+    dl = DataLogger(args[0], args[1], options.chunked)
     dl.run()
 
 if __name__ == '__main__':
@@ -23,7 +23,6 @@ def plot_motion(amanager, graphs, log_prefix):
         for dataset, plot_params in graph:
             amanager.setup_dataset(dataset)
     amanager.generate_datasets()
-    datasets = amanager.get_datasets()
     times = amanager.get_dataset_times()
     # Build plot
     fontP = matplotlib.font_manager.FontProperties()
@@ -52,7 +51,7 @@ def plot_motion(amanager, graphs, log_prefix):
                     ax.set_ylabel(graph_units)
             pparams = {'label': label['label'], 'alpha': 0.8}
             pparams.update(plot_params)
-            ax.plot(times, datasets[dataset], **pparams)
+            ax.plot(times, amanager.get_dataset(dataset), **pparams)
         if twin_ax is not None:
             li1, la1 = graph_ax.get_legend_handles_labels()
             li2, la2 = twin_ax.get_legend_handles_labels()
@@ -3,7 +3,7 @@
 # Copyright (C) 2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import json, zlib
+import os, logging, json, zlib, struct
 
 class error(Exception):
     pass
@@ -407,13 +407,51 @@ class JsonLogReader:
             parts[0] = msgs[0] + parts[0]
             self.msgs = msgs = parts
 
+# Read messages from a chunked log built by "data_logger.py --chunked"
+CHUNK_MAGIC = b"MOTC"
+CHUNK_HEADER = struct.Struct("<4sII")
+
+class ChunkLogReader:
+    def __init__(self, filename):
+        self.file = open(filename, "rb")
+        self.msgs = []
+    def seek(self, pos):
+        self.file.seek(pos)
+        self.msgs = []
+    def _read_chunk(self):
+        hdr = self.file.read(CHUNK_HEADER.size)
+        if len(hdr) < CHUNK_HEADER.size:
+            return False
+        magic, comp_size, raw_size = CHUNK_HEADER.unpack(hdr)
+        if magic != CHUNK_MAGIC:
+            raise error("Invalid chunk header in log")
+        data = zlib.decompress(self.file.read(comp_size))
+        self.msgs = data.split(b'\x03')[:-1]
+        self.msgs.reverse()
+        return True
+    def pull_msg(self):
+        while 1:
+            if self.msgs:
+                msg = self.msgs.pop()
+                try:
+                    json_msg = json.loads(msg)
+                except:
+                    logging.exception("Unable to parse line")
+                    continue
+                return json_msg
+            if not self._read_chunk():
+                return None
+
 # Store messages in per-subscription queues until handlers are ready for them
 class JsonDispatcher:
     def __init__(self, log_prefix):
         self.names = {}
         self.queues = {}
         self.last_read_time = 0.
-        self.log_reader = JsonLogReader(log_prefix + ".json.gz")
+        if os.path.exists(log_prefix + ".json.chunks"):
+            self.log_reader = ChunkLogReader(log_prefix + ".json.chunks")
+        else:
+            self.log_reader = JsonLogReader(log_prefix + ".json.gz")
         self.is_eof = False
     def check_end_of_data(self):
         return self.is_eof and not any(self.queues.values())
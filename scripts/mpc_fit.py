@@ -0,0 +1,73 @@
+#!/usr/bin/env python2
+# Fit an MPC heater thermal model from the stats in a klippy log
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+from __future__ import print_function
+import importlib, optparse, os, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+mpc_calibrate = importlib.import_module('.mpc_calibrate', 'extras')
+
+# Extract (time, temp, pwm) samples for a heater from "Stats" lines
+def parse_log(logname, heater, start_time, end_time):
+    heater_prefix = heater + ":"
+    out = []
+    f = open(logname, 'r')
+    for line in f:
+        parts = line.split()
+        if not parts or parts[0] not in ('Stats', 'INFO:root:Stats'):
+            continue
+        sample_time = float(parts[1][:-1])
+        if sample_time < start_time or sample_time > end_time:
+            continue
+        prefix = ""
+        vals = {}
+        for p in parts[2:]:
+            if '=' not in p:
+                prefix = p
+                continue
+            if prefix == heater_prefix:
+                name, val = p.split('=', 1)
+                vals[name] = val
+        if 'temp' not in vals or 'pwm' not in vals:
+            continue
+        out.append((sample_time, float(vals['temp']), float(vals['pwm']),
+                    0.))
+    f.close()
+    return out
+
+def main():
+    usage = "%prog [options] <logfile>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-H", "--heater", type="string", default="extruder",
+                    help="name of heater to fit")
+    opts.add_option("-p", "--heater_power", type="float", default=None,
+                    help="heater power (in Watts)")
+    opts.add_option("-a", "--ambient_temp", type="float", default=None,
+                    help="ambient temperature (default is to fit it)")
+    opts.add_option("-s", "--start", type="float", default=0.,
+                    help="ignore stats before this log time")
+    opts.add_option("-e", "--end", type="float", default=float('inf'),
+                    help="ignore stats after this log time")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    samples = parse_log(args[0], options.heater, options.start, options.end)
+    try:
+        model = mpc_calibrate.fit_thermal_model(
+            samples, options.heater_power, options.ambient_temp)
+    except ValueError as e:
+        print("Unable to fit model: %s" % (str(e),))
+        sys.exit(-1)
+    print("Fitted %d samples (rms error %.3f C/s, ambient %.1f C)"
+          % (len(samples), model['rms_error'], model['ambient_temp']))
+    if options.heater_power is None:
+        print("Heater power not specified - model is relative to"
+              " heater_power=1.0")
+    print("[%s]" % (options.heater,))
+    print("control: mpc")
+    for name in ['heater_power', 'block_heat_capacity', 'ambient_transfer']:
+        print("%s: %.4f" % (name, model[name]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python2
+# Step generation regression and timing checks using the klippy tests
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+from __future__ import print_function
+import sys, os, optparse, hashlib, json, re, logging
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+import msgproto, test_klippy
+
+STEP_MESSAGES = ['config_stepper', 'queue_step', 'set_next_step_dir',
+                 'reset_step_clock']
+
+
+######################################################################
+# Output file decoding
+######################################################################
+
+# Iterate over the (name, params, text) of each message in an output file
+def iter_messages(dict_fname, data_fname):
+    f = open(dict_fname, 'rb')
+    dictionary = f.read()
+    f.close()
+    mp = msgproto.MessageParser()
+    mp.process_identify(dictionary, decompress=False)
+    f = open(data_fname, 'rb')
+    data = f.read()
+    f.close()
+    while data:
+        l = mp.check_packet(data)
+        if l == 0:
+            break
+        if l < 0:
+            raise test_klippy.error("Invalid data in %s" % (data_fname,))
+        s = bytearray(data[:l])
+        data = data[l:]
+        pos = msgproto.MESSAGE_HEADER_SIZE
+        while 1:
+            mid = mp.messages_by_id.get(s[pos], mp.unknown)
+            params, pos = mid.parse(s, pos)
+            yield mid.name, params, mid.format_params(params)
+            if pos >= len(s)-msgproto.MESSAGE_TRAILER_SIZE:
+                break
+
+# Produce a canonical summary of the step commands sent to an mcu
+def digest_steps(dict_fname, data_fname):
+    hash_obj = hashlib.sha1()
+    queue_msgs = total_steps = 0
+    for name, params, text in iter_messages(dict_fname, data_fname):
+        if name not in STEP_MESSAGES:
+            continue
+        hash_obj.update(text + '\n')
+        if name == 'queue_step':
+            queue_msgs += 1
+            total_steps += params['count']
+    return {'digest': hash_obj.hexdigest(), 'queue_step': queue_msgs,
+            'steps': total_steps}
+
+def get_kinematics(config_fname):
+    f = open(config_fname, 'r')
+    data = f.read()
+    f.close()
+    m = re.search(r'^\[printer\][^\[]*^kinematics\s*[:=]\s*(\S+)', data,
+                  re.MULTILINE)
+    if m is None:
+        return "unknown"
+    return m.group(1)
+
+
+######################################################################
+# Test running
+######################################################################
+
+class StepTestCase(test_klippy.TestCase):
+    def __init__(self, fname, dictdir, tempdir, verbose, results):
+        test_klippy.TestCase.__init__(self, fname, dictdir, tempdir,
+                                      verbose, False)
+        self.results = results
+    def process_output(self, config_fname, dict_fnames, cpu_time):
+        mcus = {}
+        for dict_fname in dict_fnames:
+            name, out_fname = 'mcu', test_klippy.TEMP_OUTPUT_FILE
+            if '=' in dict_fname:
+                name, dict_fname = dict_fname.split('=', 1)
+                out_fname = "%s-%s" % (test_klippy.TEMP_OUTPUT_FILE, name)
+            mcus[name] = digest_steps(dict_fname, out_fname)
+        hash_obj = hashlib.sha1()
+        for name in sorted(mcus):
+            hash_obj.update("%s:%s\n" % (name, mcus[name]['digest']))
+        key = "%s:%s" % (self.fname, os.path.basename(config_fname))
+        self.results[key] = {
+            'kinematics': get_kinematics(config_fname),
+            'digest': hash_obj.hexdigest(),
+            'steps': sum([m['steps'] for m in mcus.values()]),
+            'queue_step': sum([m['queue_step'] for m in mcus.values()]),
+            'cpu_time': cpu_time }
+
+
+######################################################################
+# Baseline comparison
+######################################################################
+
+def compare_results(results, baseline, threshold, min_delta):
+    failures = []
+    for key in sorted(results):
+        res = results[key]
+        base = baseline.get(key)
+        if base is None:
+            print("%s: no baseline entry" % (key,))
+            continue
+        if res['digest'] != base['digest']:
+            failures.append("%s: step stream changed (steps %d -> %d,"
+                            " queue_step %d -> %d)"
+                            % (key, base['steps'], res['steps'],
+                               base['queue_step'], res['queue_step']))
+        limit = max(base['cpu_time'] * (1. + threshold),
+                    base['cpu_time'] + min_delta)
+        if res['cpu_time'] > limit:
+            failures.append("%s: cpu time %.3fs exceeds baseline %.3fs"
+                            % (key, res['cpu_time'], base['cpu_time']))
+    return failures
+
+def summarize_kinematics(results, baseline):
+    kin_times = {}
+    for key, res in results.items():
+        kt = kin_times.setdefault(res['kinematics'], [0, 0., 0.])
+        kt[0] += 1
+        kt[1] += res['cpu_time']
+        if key in baseline:
+            kt[2] += baseline[key]['cpu_time']
+    for kin in sorted(kin_times):
+        count, cpu_time, base_time = kin_times[kin]
+        msg = "%-16s tests=%-3d cpu=%.3fs" % (kin, count, cpu_time)
+        if base_time:
+            msg += " baseline=%.3fs (%+.1f%%)" % (
+                base_time, 100. * (cpu_time - base_time) / base_time)
+        print(msg)
+
+
+######################################################################
+# Startup
+######################################################################
+
+def main():
+    usage = "%prog [options] <test cases>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-v", action="store_true", dest="verbose",
+                    help="show all output from tests")
+    opts.add_option("-d", "--dictdir", dest="dictdir", default=".",
+                    help="directory for dictionary files")
+    opts.add_option("-t", "--tempdir", dest="tempdir", default=".",
+                    help="directory for temporary files")
+    opts.add_option("-b", "--baseline", dest="baseline",
+                    help="baseline file to compare against")
+    opts.add_option("-u", "--update", action="store_true", dest="update",
+                    help="write the results to the baseline file")
+    opts.add_option("--threshold", type="float", default=0.25,
+                    help="allowed relative cpu time increase (default 0.25)")
+    opts.add_option("--min-delta", type="float", dest="min_delta",
+                    default=0.2,
+                    help="ignore cpu time increases below this many seconds")
+    options, args = opts.parse_args()
+    if len(args) < 1:
+        opts.error("Incorrect number of arguments")
+    logging.basicConfig(level=logging.DEBUG)
+    # Run each test and collect results
+    results = {}
+    for fname in args:
+        tc = StepTestCase(fname, options.dictdir, options.tempdir,
+                          options.verbose, results)
+        res = tc.run()
+        if res != 'success':
+            sys.stderr.write("\n\nTest case %s FAILED\n\n" % (fname,))
+            sys.exit(-1)
+    for key in sorted(results):
+        res = results[key]
+        print("%s: %s steps=%d cpu=%.3fs" % (key, res['digest'][:12],
+                                             res['steps'], res['cpu_time']))
+    # Compare with (or update) the baseline
+    baseline = {}
+    if options.baseline is not None and os.path.exists(options.baseline):
+        f = open(options.baseline, 'r')
+        baseline = json.load(f)
+        f.close()
+    summarize_kinematics(results, baseline)
+    if options.update:
+        if options.baseline is None:
+            opts.error("--update requires a baseline file")
+        baseline.update(results)
+        f = open(options.baseline, 'w')
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.close()
+        return
+    failures = compare_results(results, baseline, options.threshold,
+                               options.min_delta)
+    if failures:
+        sys.stderr.write("\n".join(failures) + "\n")
+        sys.exit(-1)
+
+if __name__ == '__main__':
+    main()
@@ -96,7 +96,10 @@ class TestCase:
             args += ['-d', df]
         if not self.verbose:
             args += ['-l', TEMP_LOG_FILE]
+        start_times = os.times()
         res = subprocess.call(args)
+        end_times = os.times()
+        cpu_time = sum(end_times[2:4]) - sum(start_times[2:4])
         is_fail = (should_fail and not res) or (not should_fail and res)
         if is_fail:
             if not self.verbose:
@@ -104,6 +107,8 @@ class TestCase:
             if should_fail:
                 raise error("Test failed to raise an error")
             raise error("Error during test")
+        if not should_fail:
+            self.process_output(config_fname, dict_fnames, cpu_time)
         # Do cleanup
         if self.keepfiles:
             return
@@ -125,6 +130,9 @@ class TestCase:
             logging.exception("Unhandled exception during test run")
             return "internal error"
         return "success"
+    def process_output(self, config_fname, dict_fnames, cpu_time):
+        # Hook for tools that inspect the generated output files
+        pass
     def show_log(self):
         f = open(TEMP_LOG_FILE, 'r')
         data = f.read()